@@ -0,0 +1,184 @@
+from components import TelemetrySubscriber, logger
+import glob
+import json
+import numbers
+import os
+import time
+import configparser
+import sys
+
+import numpy as np
+
+
+class DataLogger(TelemetrySubscriber):
+    """Writes the telemetry published by the drivers to disk.
+
+    Readings are buffered in memory and written in bulk, as one .npz chunk, once flush_size readings are waiting or
+    the oldest one has waited flush_interval seconds. Chunks go into one directory per day, e.g.
+    data/2020-01-31/235959_000123.npz, and a chunk never holds readings of two days.
+
+    Each series (source and command, e.g. LS218.KRDG.3) is stored as the columns <series>.t0, <series>.t1 and
+    <series>.value. Only numeric results are logged, as floats (lists of numbers as 2D arrays), so that every value
+    column is a float array. The numeric entries of a dict result are logged as series of their own, e.g.
+    SMS.OUTP.T.Output, and any other result is left out. Use load_series to read a series back.
+    """
+    def __init__(self, directory, flush_size=10000, flush_interval=60, compress=False, **kwargs):
+        super().__init__(**kwargs)
+        self.directory = directory
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.compress = compress
+        # Buffered readings as {series: [(t0, t1, result)]}
+        self.buffer = {}
+        self.buffer_count = 0
+        self.buffer_time = None
+        self.buffer_day = None
+
+    def setup_and_run_subscriber(self):
+        try:
+            super().setup_and_run_subscriber()
+        finally:
+            # Don't lose the readings that were received before closing
+            self.flush()
+
+    @staticmethod
+    def series_name(message):
+        return '.'.join([message['SOURCE']] + message['CMD'].replace('?', '').split())
+
+    def process_telemetry(self, message):
+        # Readings that failed are not logged
+        if message.get('error'):
+            return
+
+        now = time.time()
+        if self.buffer_day is not None and self.day(now) != self.buffer_day:
+            self.flush()
+
+        values = self.numeric_values(self.series_name(message), message['result'])
+        if not values:
+            logger.debug('Not logging the non-numeric result of {}'.format(self.series_name(message)))
+            return
+
+        if not self.buffer_count:
+            self.buffer_time = now
+            self.buffer_day = self.day(now)
+        for series, value in values:
+            self.buffer.setdefault(series, []).append((message['t0'], message['t1'], value))
+        self.buffer_count += 1
+
+        if self.buffer_count >= self.flush_size:
+            self.flush()
+        else:
+            self.process_timeout()
+
+    def process_timeout(self):
+        if self.buffer_count and time.time() - self.buffer_time >= self.flush_interval:
+            self.flush()
+
+    @staticmethod
+    def day(t):
+        return time.strftime('%Y-%m-%d', time.localtime(t))
+
+    @staticmethod
+    def is_numeric(result):
+        """Whether a result is a number, or a non-empty list of numbers"""
+        if isinstance(result, (list, tuple)):
+            return bool(result) and all(isinstance(value, numbers.Real) for value in result)
+        return isinstance(result, numbers.Real)
+
+    @classmethod
+    def numeric_values(cls, series, result):
+        """Get the (series, value) pairs to log for a result: the result itself if it is numeric, or the numeric
+        entries of a dict"""
+        if isinstance(result, dict):
+            return [('{}.{}'.format(series, str(key).replace(' ', '_')), value) for key, value in result.items()
+                    if cls.is_numeric(value)]
+        return [(series, result)] if cls.is_numeric(result) else []
+
+    @staticmethod
+    def make_columns(series, readings):
+        # Lists that don't have the length of the latest one (e.g. after a change of the instrument's settings) would
+        # make a ragged array
+        shape = np.shape(readings[-1][2])
+        t0, t1, results = zip(*(reading for reading in readings if np.shape(reading[2]) == shape))
+        values = np.asarray(results, dtype=np.float64)
+        return {series + '.t0': np.asarray(t0, dtype=np.float64),
+                series + '.t1': np.asarray(t1, dtype=np.float64),
+                series + '.value': values}
+
+    def flush(self):
+        """Write the buffered readings to a new chunk"""
+        if not self.buffer_count:
+            return
+
+        columns = {}
+        for series, readings in self.buffer.items():
+            columns.update(self.make_columns(series, readings))
+
+        # The chunk is named after the time its first reading was buffered, like its directory
+        directory = os.path.join(self.directory, self.buffer_day)
+        os.makedirs(directory, exist_ok=True)
+        name = time.strftime('%H%M%S', time.localtime(self.buffer_time))
+        filename = os.path.join(directory, '{}_{:06d}.npz'.format(name, int(self.buffer_time % 1 * 1e6)))
+        # Write to a temporary file first so that readers never see a partial chunk
+        with open(filename + '.tmp', 'wb') as f:
+            if self.compress:
+                np.savez_compressed(f, **columns)
+            else:
+                np.savez(f, **columns)
+        os.replace(filename + '.tmp', filename)
+        logger.info('Wrote {} readings to {}'.format(self.buffer_count, filename))
+
+        self.buffer = {}
+        self.buffer_count = 0
+        self.buffer_time = None
+        self.buffer_day = None
+
+
+def load_series(directory, series, days=None):
+    """Read a series back from the chunks written by a DataLogger. Returns (t0, t1, value) arrays in time order.
+
+    days is a list of days (e.g. ['2020-01-31']) to read, by default all of them are read. Like within a chunk, the
+    values of a series of lists are only read from the chunks where the lists have the length of the latest chunk.
+    """
+    if days is None:
+        filenames = glob.glob(os.path.join(directory, '*', '*.npz'))
+    else:
+        filenames = [filename for day in days for filename in glob.glob(os.path.join(directory, day, '*.npz'))]
+
+    chunks = []
+    for filename in sorted(filenames):
+        with np.load(filename) as chunk:
+            if series + '.t0' not in chunk or chunk[series + '.value'].dtype != np.float64:
+                continue
+            chunks.append(tuple(chunk['{}.{}'.format(series, column)] for column in ('t0', 't1', 'value')))
+
+    if not chunks:
+        return np.empty(0), np.empty(0), np.empty(0)
+    # Chunks of other shapes (e.g. before a change of the instrument's settings) can't be joined into one array
+    shape = chunks[-1][2].shape[1:]
+    chunks = [chunk for chunk in chunks if chunk[2].shape[1:] == shape]
+    t0, t1, value = (np.concatenate([chunk[column] for chunk in chunks]) for column in range(3))
+    order = np.argsort(t1, kind='stable')
+    return t0[order], t1[order], value[order]
+
+
+if __name__ == '__main__':
+    config = configparser.ConfigParser()
+    config.read(sys.argv[1])
+    DL_config = config['DataLogger']
+
+    data_logger = DataLogger(DL_config.get('directory', 'data'),
+                             flush_size=DL_config.getint('flush_size', 10000),
+                             flush_interval=DL_config.getfloat('flush_interval', 60),
+                             compress=DL_config.getboolean('compress', False),
+                             telemetry_keys=json.loads(DL_config.get('telemetry_keys', '["telemetry.#"]')))
+    data_logger.run_subscriber_thread()
+
+    try:
+        time.sleep(1000000)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pass
+        data_logger.close()
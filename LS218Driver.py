@@ -1,11 +1,31 @@
-from components import IEEE488_CommonCommands, DriverCommandRunner, \
-    DriverQueryCommand, DriverWriteCommand
+from components import IEEE488_CommonCommands, LakeShoreCurveCommands, DriverCommandRunner, \
+    DriverQueryCommand, DriverWriteCommand, CachePolicy, logger
 import time
 import configparser
+import json
 import sys
 
+import numpy as np
+
+
+class LS218Driver(IEEE488_CommonCommands, LakeShoreCurveCommands, DriverCommandRunner):
+    """Driver for the Lake Shore 218 temperature monitor.
+
+    The internal data log is downloaded with DownloadLog, which is split into log_chunk_records records at a time so
+    that other messages can run in between. Clients that send it with 'STREAM' get each part back as soon as it is
+    ready, see download_log.
+    """
+    # Standard diode (1-5) and platinum (6-9) curves, and the user curves
+    curves = list(range(1, 10)) + list(range(21, 29))
+    user_curves = range(21, 29)
+
+    # Input read at each position of a reading of all inputs (e.g. KRDG? 0)
+    all_inputs = np.arange(1, 9)
+
+    # Records of the internal data log, as read by DownloadLog
+    log_record_dtype = np.dtype([('record', np.int32), ('reading', np.int8), ('date', 'U8'), ('time', 'U8'),
+                                 ('value', np.float64), ('status', np.int16), ('source', np.int8)])
 
-class LS218Driver(IEEE488_CommonCommands, DriverCommandRunner):
     @staticmethod
     def validate_input_number(input, include_all=False):
         min = 0 if include_all else 1
@@ -89,9 +109,144 @@ class LS218Driver(IEEE488_CommonCommands, DriverCommandRunner):
         except ValueError as e:
             raise ValueError("Input group must be {}, instead got {}".format(['A', 'B'], input))
 
-    def __init__(self, driver_queue, driver_params, **kwargs):
+    @staticmethod
+    def validate_log_record(input):
+        try:
+            if int(input) < 1:
+                raise ValueError()
+        except ValueError:
+            raise ValueError("Log record must be a positive integer, instead got {}".format(input))
+
+    def __init__(self, driver_queue, driver_params, log_chunk_records=10, **kwargs):
         super().__init__(driver_queue, driver_params, **kwargs)
+        self.log_chunk_records = log_chunk_records
         self.run_server_thread()
+        self.run_telemetry_thread()
+        self.run_poller_thread()
+
+    @staticmethod
+    def parse_all_inputs(result):
+        """Parse a reading of all inputs into an array, where element i is the reading of input all_inputs[i]"""
+        return np.array(result.split(','), dtype=np.float64)
+
+    @classmethod
+    def all_inputs_to_array(cls, result):
+        """Turn the result of a reading of all inputs, as sent to clients, back into an array"""
+        return np.asarray(result, dtype=np.float64)
+
+    @classmethod
+    def input_index(cls, channel):
+        """Position of an input in a reading of all inputs"""
+        return int(np.flatnonzero(cls.all_inputs == int(channel))[0])
+
+    def read_all_inputs(self, reading_class=None):
+        """Read every input in one query (Kelvin by default). Returns the array of readings and the input of each one,
+        or raises the error of the query"""
+        if reading_class is None:
+            reading_class = self.GetKelvinReading
+        command_result, error = self.execute_parsed_command(reading_class.cmd, ['0'])
+        if error is not None:
+            raise error
+        return self.all_inputs_to_array(command_result['result']), self.all_inputs
+
+    def split_message(self, message):
+        try:
+            commands = message['CMD'].split(';')
+        except (AttributeError, KeyError, TypeError):
+            return [message]
+        cmd, pars = self.split_cmd(commands[0])
+        if len(commands) != 1 or cmd != self.DownloadLog.cmd or self.check_command(cmd, pars) is not None:
+            return super().split_message(message)
+
+        first, last = int(pars[0]), int(pars[1])
+        if last == 0:
+            last = self.execute_parsed_command(self.GetLogNumber.cmd, [])[0]['result']
+            if last == '':
+                return [message]
+        return [dict(message, CMD=self.DownloadLog.raw_command([start, min(start + self.log_chunk_records - 1, last)]))
+                for start in range(first, last + 1, self.log_chunk_records)] or [message]
+
+    def is_final_response(self, chunk, response):
+        # A failed part of a log download ends the download, so that the records sent back are always one run from
+        # the first record up to the record to resume from
+        if self.split_cmd(chunk['CMD'])[0] != self.DownloadLog.cmd:
+            return False
+        command_result = response[0]
+        return bool(command_result['error'] or command_result['result']['error'])
+
+    def read_log(self, first, last):
+        """Read records first to last of the data log. If the instrument fails part way, the records read so far are
+        returned along with the error and the record to resume from"""
+        records, next_record, error = self.read_log_records(first, last)
+        return {'first_record': first,
+                'last_record': last,
+                'next_record': next_record,
+                'error': error,
+                'columns': {name: records[name].tolist() for name in self.log_record_dtype.names}}
+
+    def read_log_records(self, first, last):
+        """Read records first to last of the data log into an array of log_record_dtype.
+        Returns the array, the first record that was not read and the error message, if any"""
+        rows = []
+        record = first
+        error = ''
+        try:
+            readings = self.GetLoggingParameters.execute(self, self.GetLoggingParameters.cmd, [])['readings']
+            for record in range(first, last + 1):
+                queries = [self.GetLoggedData.command([record, reading]) for reading in range(1, readings + 1)]
+                replies = []
+                for batch in self.batch_queries(queries):
+                    replies.extend(self.resource.query(';'.join(batch)).split(';'))
+                for reading, reply in enumerate(replies, 1):
+                    date, time_of_day, value, status, source = (field.strip() for field in reply.split(','))
+                    rows.append((record, reading, date, time_of_day, float(value), int(status), int(source)))
+            record = last + 1
+        except Exception as e:
+            logger.exception("Failed to read record {} of the data log".format(record))
+            error = str(e)
+            # Only keep complete records, so the download can resume from the one that failed
+            rows = [row for row in rows if row[0] < record]
+        return np.array(rows, dtype=self.log_record_dtype), record, error
+
+    @classmethod
+    def log_columns_to_array(cls, columns):
+        """Turn the columns sent by DownloadLog back into an array of log_record_dtype"""
+        records = np.empty(len(columns['record']), dtype=cls.log_record_dtype)
+        for name in cls.log_record_dtype.names:
+            records[name] = columns[name]
+        return records
+
+    @classmethod
+    def download_log(cls, client, queue_name, first=1, last=0, progress=None):
+        """Download records first to last (0 for all of them) of the data log of the driver at queue_name, using a
+        running RmqReq client. Whenever a part arrives, progress is called with the next record to read and the last
+        record of that part.
+
+        Returns the records as an array of log_record_dtype, and the record to resume from. This is last + 1 if every
+        record was downloaded, otherwise pass it as first to download the rest.
+        """
+        replies = []
+
+        def add_part(reply):
+            replies.append(reply)
+            if progress is not None and not reply[0]['error']:
+                progress(reply[0]['result']['next_record'], reply[0]['result']['last_record'])
+
+        message = {'CMD': cls.DownloadLog.raw_command([first, last]), 'STREAM': True}
+        add_part(client.send_direct_message(queue_name, message, partial_callback=add_part).result())
+
+        errors = [reply[0]['error'] for reply in replies if reply[0]['error']]
+        if errors:
+            raise ValueError(errors[0])
+        parts = [reply[0]['result'] for reply in replies]
+        # The driver ends the download at the first part that fails. The parts after it (from a driver that doesn't)
+        # are dropped, so the records run without a gap up to the record to resume from
+        for index, part in enumerate(parts):
+            if part['error']:
+                parts = parts[:index + 1]
+                break
+        records = np.concatenate([cls.log_columns_to_array(part['columns']) for part in parts])
+        return records, parts[-1]['next_record']
 
     class GetSensorReading(DriverQueryCommand):
         cmd = "SRDG?"
@@ -103,9 +258,8 @@ class LS218Driver(IEEE488_CommonCommands, DriverCommandRunner):
 
         @classmethod
         def process_result(cls, driver, cmd, pars, result):
-            print(result, pars)
             if int(pars[0]) == 0:
-                return list(map(lambda x: float(x), result.split(',')))
+                return LS218Driver.parse_all_inputs(result).tolist()
             else:
                 return float(result)
 
@@ -180,6 +334,8 @@ class LS218Driver(IEEE488_CommonCommands, DriverCommandRunner):
 
     class GetBaudRate(DriverQueryCommand):
         cmd = "BAUD?"
+        # The baud rate cannot change without breaking the connection
+        cache_policy = CachePolicy.UNTIL_INVALIDATED
 
         @classmethod
         def process_result(cls, driver, cmd, pars, result):
@@ -232,6 +388,9 @@ class LS218Driver(IEEE488_CommonCommands, DriverCommandRunner):
     class GetFilterParameters(DriverQueryCommand):
         cmd = "FILTER?"
         arguments = "{}"
+        # Settings that can only be changed from the front panel are cached for a while
+        cache_policy = CachePolicy.TTL
+        cache_ttl = 60
 
         @classmethod
         def _validate(cls, pars):
@@ -259,6 +418,8 @@ class LS218Driver(IEEE488_CommonCommands, DriverCommandRunner):
     class GetCurveNumber(DriverQueryCommand):
         cmd = "INCRV?"
         arguments = "{}"
+        cache_policy = CachePolicy.TTL
+        cache_ttl = 60
 
         @classmethod
         def _validate(cls, pars):
@@ -283,6 +444,8 @@ class LS218Driver(IEEE488_CommonCommands, DriverCommandRunner):
     class GetSensorType(DriverQueryCommand):
         cmd = "INTYPE?"
         arguments = "{}"
+        cache_policy = CachePolicy.TTL
+        cache_ttl = 60
 
         @classmethod
         def _validate(cls, pars):
@@ -364,7 +527,7 @@ class LS218Driver(IEEE488_CommonCommands, DriverCommandRunner):
 
         @classmethod
         def _validate(cls, pars):
-            LS218Driver.validate_input_number(pars[0])
+            LS218Driver.validate_log_record(pars[0])
             LS218Driver.validate_input_number(pars[1])
 
 
@@ -379,6 +542,27 @@ class LS218Driver(IEEE488_CommonCommands, DriverCommandRunner):
                     "source": int(resp[4])
                     }
 
+    class DownloadLog(DriverQueryCommand):
+        """Reads records {} to {} of the data log. A last record of 0 reads up to the last record that is stored"""
+        cmd = "LOGDOWNLOAD?"
+        arguments = "{},{}"
+        pipelined = False
+        coalesce = False
+        publish_telemetry = False
+
+        @classmethod
+        def _validate(cls, pars):
+            LS218Driver.validate_log_record(pars[0])
+            if int(pars[1]) != 0:
+                LS218Driver.validate_log_record(pars[1])
+
+        @classmethod
+        def execute(cls, driver, cmd, pars):
+            first, last = int(pars[0]), int(pars[1])
+            if last == 0:
+                last = driver.GetLogNumber.execute(driver, driver.GetLogNumber.cmd, [])
+            return driver.read_log(first, last)
+
     class GetLinearEquationData(DriverQueryCommand):
         cmd = "LRDG?"
         arguments = "{}"
@@ -482,7 +666,14 @@ if __name__ == '__main__':
                                                 'address': LS218_config['address'],
                                                 'baud_rate': LS218_config.getint('baud_rate'),
                                                 'parity': LS218_config['parity'],
-                                                'data_bits': LS218_config.getint('data_bits')})
+                                                'data_bits': LS218_config.getint('data_bits')},
+                         consumer_mode=LS218_config.getboolean('consumer_mode', True),
+                         pipelined=LS218_config.getboolean('pipelined', False),
+                         coalesce_window=LS218_config.getfloat('coalesce_window', 0),
+                         prefetch_count=LS218_config.getint('prefetch_count', 10),
+                         chunk_size=LS218_config.getint('chunk_size', None),
+                         poll_commands=json.loads(LS218_config.get('poll_commands', '{}')),
+                         telemetry_source=LS218_config.get('telemetry_source'))
 
     try:
         time.sleep(1000000)
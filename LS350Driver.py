@@ -3,11 +3,12 @@ import sys
 import logging
 import time
 
-from components import DriverQueryCommand, DriverWriteCommand, CommandRunner, DriverCommandRunner
+from components import DriverQueryCommand, DriverWriteCommand, CommandRunner, DriverCommandRunner, CachePolicy
 from components.ieee488_common_commands import IEEE488_CommonCommands
+from components.lakeshore_curve_commands import LakeShoreCurveCommands
 
 
-class LS350Driver(IEEE488_CommonCommands, DriverCommandRunner):
+class LS350Driver(IEEE488_CommonCommands, LakeShoreCurveCommands, DriverCommandRunner):
     def __init__(self, driver_queue, driver_params, command_delay=0.05, **kwargs):
         super().__init__(driver_queue, driver_params, command_delay, **kwargs)
         print(self.resource.query(self.GetIdentification.command()))
@@ -167,6 +168,8 @@ class LS350Driver(IEEE488_CommonCommands, DriverCommandRunner):
     class GetHeaterSetup(DriverQueryCommand):
         cmd = "HTRSET?"
         arguments = "{}"
+        cache_policy = CachePolicy.TTL
+        cache_ttl = 60
 
         @classmethod
         def _validate(cls, pars):
@@ -277,7 +280,12 @@ if __name__ == '__main__':
                                                  'parity': LS350_config['parity'],
                                                  'data_bits': LS350_config.getint('data_bits'),
                                                  'termination': LS350_config['termination']},
-                         float(LS350_config['command_delay']))
+                         float(LS350_config['command_delay']),
+                         consumer_mode=LS350_config.getboolean('consumer_mode', True),
+                         pipelined=LS350_config.getboolean('pipelined', False),
+                         coalesce_window=LS350_config.getfloat('coalesce_window', 0),
+                         prefetch_count=LS350_config.getint('prefetch_count', 10),
+                         chunk_size=LS350_config.getint('chunk_size', None))
 
     try:
         time.sleep(1000000)
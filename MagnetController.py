@@ -1,8 +1,10 @@
 from LS218Driver import LS218Driver
 from SMSPowerSupplyDriver import SMSPowerSupplyDriver
-from components import ControllerComponent, logger, QueryCommand, WriteCommand
+from components import ControllerComponent, logger, QueryCommand, WriteCommand, RmqTransport, JsonCodec, RingBuffer
 import time
 import json
+import threading
+import concurrent.futures
 import logging
 import configparser
 import sys
@@ -11,8 +13,7 @@ from state_machine.state_machine import StateMachine, State
 
 
 class StateInitialize(State):
-    def next(self, condition):
-        return StateIdle, False
+    tick_period = 0
 
     def run(self):
         self.component.get_magnet_temperature()
@@ -21,20 +22,15 @@ class StateInitialize(State):
 
 
 class StateIdle(State):
-    def next(self, condition):
-        state = {"start_ramp": StateRampInit}.get(condition, StateIdle)
-        return state, state != StateIdle
+    tick_period = 1
 
     def run(self):
-        self.component.get_persistent_mode_heater_switch_temperature()
-        self.component.get_magnet_temperature()
-        self.component.get_field()
+        self.component.acquire_temperatures_and_field()
         print("Idle")
 
 
 class StateRampInit(State):
-    def next(self, condition):
-        return StateWaitPersistentMode, False
+    tick_period = 0
 
     def run(self):
         self.component.set_persistent_mode_heater_switch(1)
@@ -43,35 +39,32 @@ class StateRampInit(State):
 
 
 class StateWaitPersistentMode(State):
-    def __init__(self, component):
-        super().__init__(component)
-        self.switch_on_time = time.time()
+    tick_period = 0.5
 
-    def next(self, condition):
-        state = {"stop_ramp": StateRampDone}.get(condition, StateWaitPersistentMode)
-        return state, state != StateWaitPersistentMode
+    def enter(self):
+        self.switch_on_time = time.time()
 
     def run(self):
-        temperature = self.component.get_persistent_mode_heater_switch_temperature()
-        self.component.get_magnet_temperature()
-        self.component.get_field()
+        self.component.acquire_temperatures_and_field()
+        temperature = self.component.persistent_mode_heater_switch_temperature.value
         print(time.time() - self.switch_on_time)
         print("Wait Persistent Mode Temperature:", temperature)
 
 
 class StateQuenched(State):
-    @staticmethod
-    def next(condition):
-        return StateIdle
+    tick_period = 1
 
-    @staticmethod
-    def run(controller):
+    def run(self):
+        self.component.acquire_temperatures_and_field()
+        # Stay here until the quench monitor would no longer trip
+        if self.component.check_quench(time.time()) is None:
+            self.component.reset_trip()
+            self.done = True
         print("Quenched")
 
 
 class StateRampDone(State):
-    def next(self, condition):
-        return StateIdle, False
+    tick_period = 0
 
     def run(self):
         self.component.set_persistent_mode_heater_switch(0)
@@ -80,13 +73,9 @@ class StateRampDone(State):
 
 
 class StateRamping(State):
-    @staticmethod
-    def next(condition):
-        state = {'stop_ramp': StateRampDone}.get(condition, StateRamping)
-        return state
+    tick_period = 0.5
 
-    @staticmethod
-    def run(controller):
+    def run(self):
         #while not controller.at_setpoint:
         #    magnet_temperature = controller.get_magnet_temperature()
         #    if controller.safe_temperature(magnet_temperature):
@@ -95,74 +84,337 @@ class StateRamping(State):
         print("Ramping")
 
 
+# Transitions between the states, on a condition set by MagnetController or when a state is done. The quench
+# monitor can send any state to StateQuenched
+StateInitialize.done_state = StateIdle
+StateIdle.transitions = {"start_ramp": StateRampInit, "quench": StateQuenched}
+StateRampInit.done_state = StateWaitPersistentMode
+StateRampInit.transitions = {"quench": StateQuenched}
+StateWaitPersistentMode.transitions = {"stop_ramp": StateRampDone, "quench": StateQuenched}
+StateQuenched.done_state = StateIdle
+StateRampDone.done_state = StateIdle
+StateRampDone.transitions = {"quench": StateQuenched}
+StateRamping.transitions = {"stop_ramp": StateRampDone, "quench": StateQuenched}
+
+
 class Measurement(object):
-    def __init__(self):
+    """The latest reading of a quantity, and the history of its readings. Thread safe, the state machine and the
+    quench monitor both update the measurements"""
+    def __init__(self, history_length=1000):
         self.value = None
         self.t0 = -1
         self.t1 = -1
+        self.history = RingBuffer(history_length)
+        self.lock = threading.Lock()
+
+    def update(self, t0, t1, value):
+        with self.lock:
+            # A reading that finished before the latest one (made from another thread) is out of date, and one that
+            # finished at the same time is the same reading again (e.g. a cached or polled result)
+            if t1 <= self.t1:
+                return
+            self.t0 = t0
+            self.t1 = t1
+            self.value = value
+            # Failed readings have an empty result and are left out of the history
+            try:
+                self.history.append(t0, t1, float(value))
+            except (TypeError, ValueError):
+                pass
+
+    def rate_of_change(self, duration):
+        with self.lock:
+            return self.history.rate_of_change(duration)
+
+    def rolling_mean(self, duration):
+        with self.lock:
+            return self.history.rolling_mean(duration)
+
+    def window_since(self, t):
+        """Copy of the readings of the history made at or after time t"""
+        with self.lock:
+            return self.history.window_since(t).copy()
 
     def __repr__(self):
         return "{}-{}: {}".format(self.t0, self.t1, self.value)
 
 
 import numpy as np
-import scipy as sp
-from scipy.interpolate import interp1d
 
 
 class MagnetController(ControllerComponent):
-    def __init__(self, config):
-        super().__init__(config['controller_queue'])
+    """Controls the field of a superconducting magnet.
+
+    The state machine does the slow work (ramping, the persistent switch), while the quench monitor checks the magnet
+    on its own thread every quench_check_period seconds. It trips when the magnet temperature stays above the safe
+    temperature at the present field (magnet_safe_temperatures, as field, temperature pairs) for quench_trip_count
+    readings in a row, when the magnet temperature rises faster than quench_temperature_rate (K/s) over the last
+    quench_window seconds, or when the readings stop coming. Tripping pauses the ramp and switches off the persistent
+    switch heater.
+    """
+    # Priority of the reads that the quench safety depends on. The drivers serve these before bulk requests
+    safety_priority = 9
+    # Priority of the commands that make the magnet safe, served before everything else
+    trip_priority = 10
+
+    def __init__(self, config, **kwargs):
+        # Seconds to wait for a driver's reply before giving up on it
+        kwargs.setdefault('request_timeout', float(config.get('request_timeout', 10)))
+        super().__init__(config['controller_queue'], **kwargs)
         self.power_supply_driver = config['power_supply_driver']
         self.magnet_temperature_driver = config['magnet_temperature_driver']
         self.hall_sensor_driver = config['hall_sensor_driver']
         self.persistent_heater_switch_temperature_channel = config['persistent_heater_switch_temperature_channel']
 
         self.magnet_temperature_channel = config['magnet_temperature_channel']
-        self.magnet_safe_temperatures = np.array(json.loads(config['magnet_safe_temperatures'])).reshape((-1, 2))
-        self.magnet_safe_temperatures_interp = interp1d(self.magnet_safe_temperatures[:,0], self.magnet_safe_temperatures[:,1])
-        print(self.magnet_safe_temperatures)
-
-        self.magnet_temperature = Measurement()
-        self.field = Measurement()
-        self.persistent_mode_heater_switch_temperature = Measurement()
+        self.magnet_safe_temperatures = np.array(json.loads(config['magnet_safe_temperatures']),
+                                                 dtype=np.float64).reshape((-1, 2))
+        # np.interp needs the fields in increasing order
+        order = np.argsort(self.magnet_safe_temperatures[:, 0])
+        self.safe_fields = self.magnet_safe_temperatures[order, 0]
+        self.safe_temperatures = self.magnet_safe_temperatures[order, 1]
+
+        # Quench monitor settings. A check period of 0 turns the monitor off
+        self.quench_check_period = float(config.get('quench_check_period', 0.2))
+        self.quench_window = float(config.get('quench_window', 5))
+        self.quench_trip_count = int(config.get('quench_trip_count', 3))
+        self.quench_temperature_rate = float(config.get('quench_temperature_rate', 0.1))
+        self.quench_max_temperature_age = float(config.get('quench_max_temperature_age', 2))
+        self.quench_max_field_age = float(config.get('quench_max_field_age', 10))
+        self.tripped = False
+
+        # Number of readings of each measured quantity that are kept
+        history_length = int(config.get('history_length', 1000))
+        self.magnet_temperature = Measurement(history_length)
+        self.field = Measurement(history_length)
+        self.persistent_mode_heater_switch_temperature = Measurement(history_length)
 
         self.state_machine = StateMachine(self, StateInitialize)
 
         self.run_client_thread()
         self.run_server_thread()
+        self.run_quench_monitor_thread()
 
-    def send_message_and_get_reply(self, queue, command):
-        self.send_direct_message(queue, json.dumps({"CMD": command}))
-        return self.wait_for_response()
+    def send_message(self, queue, command, priority=None):
+        """Send a command without waiting for the reply. Returns a Future that can be passed to wait_for_response"""
+        return self.send_direct_message(queue, {"CMD": command}, priority=priority)
 
-    def wait_for_response(self):
-        while self.server_response is None:
-            pass
-        response = json.loads(self.server_response.decode('utf-8'))
-        self.server_response = None
-        return response
+    def send_message_and_get_reply(self, queue, command, priority=None):
+        return self.wait_for_response(self.send_message(queue, command, priority))
+
+    def wait_for_response(self, future, timeout=None):
+        """Wait for the reply to a message, for up to timeout seconds (request_timeout by default). Raises
+        concurrent.futures.TimeoutError if it doesn't arrive in time, and the request is then forgotten"""
+        if timeout is None:
+            timeout = self.request_timeout
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            self.cancel_request(future)
+            raise
 
     def get_magnet_temperature(self):
         val = self.send_message_and_get_reply(self.magnet_temperature_driver,
-                                               LS218Driver.GetKelvinReading.raw_command([self.magnet_temperature_channel]))[0]
-        self.magnet_temperature.t0 = val['t0']
-        self.magnet_temperature.t1 = val['t1']
-        self.magnet_temperature.value = val['result']
+                                               LS218Driver.GetKelvinReading.raw_command([self.magnet_temperature_channel]),
+                                               self.safety_priority)[0]
+        self.magnet_temperature.update(val['t0'], val['t1'], val['result'])
+
+    def acquire(self, reads, priority=None):
+        """Make several reads at once. reads is a list of (queue, command, handler).
+
+        The reads to the same queue are merged into one message, and the messages to the different queues are all
+        sent before waiting for any reply, so this takes as long as the slowest driver rather than the sum of them.
+        Once every reply is in, each handler is called with the reply of its command (t0, t1, error and result), in
+        the order of reads. If the controller closes in the meantime, no handler is called.
+        """
+        commands = {}
+        for queue, command, handler in reads:
+            # A command read more than once is only sent once
+            queue_commands = commands.setdefault(queue, [])
+            if command not in queue_commands:
+                queue_commands.append(command)
+
+        futures = {queue: self.send_message(queue, ';'.join(queue_commands), priority)
+                   for queue, queue_commands in commands.items()}
+        replies = {}
+        for queue, future in futures.items():
+            try:
+                queue_replies = self.wait_for_response(future)
+            except concurrent.futures.TimeoutError:
+                # The readings of the other drivers are still used
+                logger.error('No reply from {} to {}'.format(queue, ';'.join(commands[queue])))
+                queue_replies = []
+            except concurrent.futures.CancelledError:
+                # The controller is closing and dropped its requests, the readings are left as they were
+                logger.info('Acquisition stopped while waiting for {}'.format(queue))
+                return
+            for index, command in enumerate(commands[queue]):
+                if index < len(queue_replies):
+                    replies[queue, command] = queue_replies[index]
+                else:
+                    replies[queue, command] = {'t0': -1, 't1': -1, 'error': 'No reply', 'result': ''}
+
+        for queue, command, handler in reads:
+            handler(replies[queue, command])
+
+    def acquire_temperatures_and_field(self):
+        """Read the temperatures and the field together"""
+        self.acquire([(self.magnet_temperature_driver, LS218Driver.GetKelvinReading.raw_command([0]),
+                       self.update_temperatures),
+                      (self.power_supply_driver, SMSPowerSupplyDriver.GetOutput.raw_command(['T']),
+                       self.update_field)],
+                     self.safety_priority)
+
+    def get_temperatures(self):
+        """Read the magnet and persistent mode heater switch temperatures with a single query of all the inputs"""
+        val = self.send_message_and_get_reply(self.magnet_temperature_driver,
+                                              LS218Driver.GetKelvinReading.raw_command([0]),
+                                              self.safety_priority)[0]
+        self.update_temperatures(val)
+
+    def update_temperatures(self, val):
+        if val['error']:
+            self.magnet_temperature.update(val['t0'], val['t1'], '')
+            self.persistent_mode_heater_switch_temperature.update(val['t0'], val['t1'], '')
+            return
+
+        temperatures = LS218Driver.all_inputs_to_array(val['result'])
+        magnet_index = LS218Driver.input_index(self.magnet_temperature_channel)
+        switch_index = LS218Driver.input_index(self.persistent_heater_switch_temperature_channel)
+        self.magnet_temperature.update(val['t0'], val['t1'], float(temperatures[magnet_index]))
+        self.persistent_mode_heater_switch_temperature.update(val['t0'], val['t1'], float(temperatures[switch_index]))
+
+    def max_safe_temperature(self, field):
+        """Highest safe magnet temperature (K) at field (T), interpolated between the magnet_safe_temperatures. Works
+        on arrays of fields"""
+        return np.interp(np.abs(field), self.safe_fields, self.safe_temperatures)
 
     def safe_temperature(self):
-        self.get_magnet_temperature()
-        self.get_field()
+        """Whether the latest magnet temperature is safe at the latest field, or None if either is unknown"""
+        try:
+            temperature = float(self.magnet_temperature.value)
+            field = float(self.field.value)
+        except (TypeError, ValueError):
+            return None
+        return temperature <= self.max_safe_temperature(field)
+
+    def run_quench_monitor_thread(self):
+        if not self.quench_check_period:
+            return
+        thread = threading.Thread(target=self.run_quench_monitor)
+        thread.start()
+
+    def run_quench_monitor(self):
+        """Read and check the magnet every quench_check_period seconds, independently of the state machine.
+
+        The temperatures come from the LS218, which answers quickly. The SMS can take seconds to answer while it is
+        busy with settings, so the field read is not waited for: each check uses the latest field that has arrived.
+        A new read of either is only sent once the previous one is back (or has expired), so a driver that stalls
+        doesn't pile up reads.
+        """
+        start_time = time.time()
+        field_future = None
+        temperature_future = None
+        while not self.done:
+            check_time = time.time()
+            try:
+                field_future = self.take_reply(field_future, self.update_field)
+                if field_future is None:
+                    field_future = self.send_message(self.power_supply_driver,
+                                                     SMSPowerSupplyDriver.GetOutput.raw_command(['T']),
+                                                     self.safety_priority)
+
+                temperature_future = self.take_reply(temperature_future, self.update_temperatures)
+                if temperature_future is None:
+                    temperature_future = self.send_message(self.magnet_temperature_driver,
+                                                           LS218Driver.GetKelvinReading.raw_command([0]),
+                                                           self.safety_priority)
+                # Missing readings are caught by check_quench once they are too old
+                concurrent.futures.wait([temperature_future], self.quench_check_period)
+                temperature_future = self.take_reply(temperature_future, self.update_temperatures)
+
+                if not self.tripped:
+                    reason = self.check_quench(time.time(), start_time)
+                    if reason is not None:
+                        self.trip(reason)
+            except Exception:
+                logger.exception('Quench monitor check failed')
+
+            delay = check_time + self.quench_check_period - time.time()
+            if delay > 0:
+                time.sleep(delay)
 
-        if self.field.value:
-            pass
+    @staticmethod
+    def take_reply(future, handler):
+        """Hand the reply of a finished read to handler. Returns None once the read is over (whether or not it got a
+        reply), or the future if it is still waiting"""
+        if future is None:
+            return None
+        if not future.done():
+            return future
+        if not future.cancelled() and future.exception() is None:
+            handler(future.result()[0])
+        return None
+
+    def check_quench(self, now, start_time=0):
+        """Check the readings of the last quench_window seconds. Returns the reason to trip, or None if all is well.
+        Readings are only expected from start_time on"""
+        temperatures = self.magnet_temperature.window_since(now - self.quench_window)
+        fields = self.field.window_since(now - self.quench_window)
+
+        temperature_time = max(temperatures['t1'][-1] if len(temperatures) else -1, start_time)
+        if now - temperature_time > self.quench_max_temperature_age:
+            return "No magnet temperature for {:.1f} s".format(now - temperature_time)
+        field_time = max(self.field.t1, start_time)
+        if now - field_time > self.quench_max_field_age:
+            return "No field reading for {:.1f} s".format(now - field_time)
+        if not len(temperatures):
+            return None
+
+        # Compare each temperature with the safe temperature at the field of the time it was read. The field only
+        # changes slowly, so it is interpolated between its readings (or the latest one is used)
+        if len(fields):
+            field = np.interp(temperatures['t1'], fields['t1'], fields['value'])
+        else:
+            field = float(self.field.value) if self.field.value not in (None, '') else 0.0
+        limit = self.max_safe_temperature(field)
+        unsafe = temperatures['value'] > limit
+        if len(unsafe) >= self.quench_trip_count and unsafe[-self.quench_trip_count:].all():
+            return "Magnet temperature {:.3f} K is above the safe temperature {:.3f} K".format(
+                temperatures['value'][-1], limit[-1] if np.ndim(limit) else limit)
+
+        rate = self.magnet_temperature.rate_of_change(self.quench_window)
+        if rate is not None and rate > self.quench_temperature_rate:
+            return "Magnet temperature is rising at {:.3f} K/s".format(rate)
+        return None
+
+    def trip(self, reason):
+        """Make the magnet safe: pause the ramp and switch off the persistent switch heater.
+
+        The commands are sent at the highest priority and are not waited for, so that the monitor keeps checking.
+        """
+        logger.error('Quench monitor tripped: {}'.format(reason))
+        self.tripped = True
+        self.send_message(self.power_supply_driver, SMSPowerSupplyDriver.SetPauseState.raw_command([1]),
+                          self.trip_priority)
+        self.send_message(self.power_supply_driver, SMSPowerSupplyDriver.SetPersistentHeaterStatus.raw_command([0]),
+                          self.trip_priority)
+        self.state_machine.set_condition('quench')
+
+    def reset_trip(self):
+        """Allow the monitor to trip again, once the magnet is safe"""
+        self.tripped = False
 
     def get_field(self):
         val = self.send_message_and_get_reply(self.power_supply_driver,
-                                              SMSPowerSupplyDriver.GetOutput.raw_command(['T']))[0]
-        self.field.t0 = val['t0']
-        self.field.t1 = val['t1']
-        self.field.value = val['result']
+                                              SMSPowerSupplyDriver.GetOutput.raw_command(['T']),
+                                              self.safety_priority)[0]
+        self.update_field(val)
+
+    def update_field(self, val):
+        # The field is the output of the supply, in T
+        result = val['result']
+        self.field.update(val['t0'], val['t1'], result['Output'] if isinstance(result, dict) else '')
 
     def get_mid(self):
         return self.send_message_and_get_reply(self.power_supply_driver, SMSPowerSupplyDriver.GetMid.raw_command(['A']))
@@ -176,7 +428,7 @@ class MagnetController(ControllerComponent):
                                                SMSPowerSupplyDriver.SetRampRate.raw_command([ramp_rate, 'T']))
 
     def ramp(self, ramp_status):
-        self.state_machine.condition = ['stop_ramp', 'start_ramp'][int(ramp_status)]
+        self.state_machine.set_condition(['stop_ramp', 'start_ramp'][int(ramp_status)])
 
     def set_persistent_mode_heater_switch(self, on_off):
         # On = 1, Off = 0
@@ -185,10 +437,9 @@ class MagnetController(ControllerComponent):
 
     def get_persistent_mode_heater_switch_temperature(self):
         val = self.send_message_and_get_reply(self.magnet_temperature_driver,
-                                        LS218Driver.GetKelvinReading.raw_command([self.persistent_heater_switch_temperature_channel]))[0]
-        self.persistent_mode_heater_switch_temperature.t0 = val['t0']
-        self.persistent_mode_heater_switch_temperature.t1 = val['t1']
-        self.persistent_mode_heater_switch_temperature.value = val['result']
+                                        LS218Driver.GetKelvinReading.raw_command([self.persistent_heater_switch_temperature_channel]),
+                                        self.safety_priority)[0]
+        self.persistent_mode_heater_switch_temperature.update(val['t0'], val['t1'], val['result'])
         return self.persistent_mode_heater_switch_temperature.value
 
     def process_message(self, message):
@@ -207,6 +458,10 @@ class MagnetController(ControllerComponent):
     def run_state_machine(self):
         self.state_machine.run()
 
+    def close(self):
+        self.state_machine.stop()
+        super().close()
+
     class GetField(QueryCommand):
         cmd = "GetField"
         arguments = ""
@@ -215,6 +470,32 @@ class MagnetController(ControllerComponent):
         def execute(cls, controller, cmd, pars):
             return controller.field.value
 
+    class GetFieldRate(QueryCommand):
+        """Rate of change of the field (per second) over the last {} seconds"""
+        cmd = "GetFieldRate"
+        arguments = "{}"
+
+        @classmethod
+        def _validate(cls, pars):
+            MagnetController.validate_duration(pars[0])
+
+        @classmethod
+        def execute(cls, controller, cmd, pars):
+            return controller.field.rate_of_change(float(pars[0]))
+
+    class GetFieldMean(QueryCommand):
+        """Mean field over the last {} seconds"""
+        cmd = "GetFieldMean"
+        arguments = "{}"
+
+        @classmethod
+        def _validate(cls, pars):
+            MagnetController.validate_duration(pars[0])
+
+        @classmethod
+        def execute(cls, controller, cmd, pars):
+            return controller.field.rolling_mean(float(pars[0]))
+
     class GetMagnetTemperature(QueryCommand):
         cmd = "GetMagnetTemperature"
         arguments = ""
@@ -223,6 +504,37 @@ class MagnetController(ControllerComponent):
         def execute(cls, controller, cmd, pars):
             return controller.magnet_temperature.value
 
+    class GetMagnetTemperatureRate(QueryCommand):
+        """Rate of change of the magnet temperature (per second) over the last {} seconds"""
+        cmd = "GetMagnetTemperatureRate"
+        arguments = "{}"
+
+        @classmethod
+        def _validate(cls, pars):
+            MagnetController.validate_duration(pars[0])
+
+        @classmethod
+        def execute(cls, controller, cmd, pars):
+            return controller.magnet_temperature.rate_of_change(float(pars[0]))
+
+    class GetMagnetTemperatureMean(QueryCommand):
+        """Mean magnet temperature over the last {} seconds"""
+        cmd = "GetMagnetTemperatureMean"
+        arguments = "{}"
+
+        @classmethod
+        def _validate(cls, pars):
+            MagnetController.validate_duration(pars[0])
+
+        @classmethod
+        def execute(cls, controller, cmd, pars):
+            return controller.magnet_temperature.rolling_mean(float(pars[0]))
+
+    @staticmethod
+    def validate_duration(duration):
+        if float(duration) <= 0:
+            raise ValueError("Duration must be a positive number of seconds, instead got {}".format(duration))
+
     class SetSetpoint(WriteCommand):
         cmd = "SetSetpoint"
         arguments = "{}"
@@ -261,7 +573,9 @@ if __name__ == '__main__':
     config.read(sys.argv[1])
     MC_config = config['MagnetController']
 
-    controller = MagnetController(MC_config)
+    # Requests (and therefore the drivers' replies) are encoded with this content type, e.g. application/msgpack
+    transport = RmqTransport(content_type=MC_config.get('content_type', JsonCodec.content_type))
+    controller = MagnetController(MC_config, transport=transport)
     try:
         controller.run_state_machine()
     except KeyboardInterrupt:
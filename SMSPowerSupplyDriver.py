@@ -1,29 +1,76 @@
 import pyvisa
 
 import components as cmp
-from components import QueryCommand, DriverQueryCommand, DriverCommandRunner
+from components import QueryCommand, DriverQueryCommand, DriverCommandRunner, CachePolicy, CommandType, logger
 import time
 import re
 import configparser
+import json
 import sys
-
-
-def find_number(string):
-    return re.search(r'[-+]?[0-9]*\.?[0-9]+([eE][-+]?[0-9]+)?', string)
-
-
-def find_numbers(string):
-    return list(re.finditer(r'[-+]?[0-9]*\.?[0-9]+([eE][-+]?[0-9]+)?', string))
+import threading
+from collections import namedtuple
+
+
+# Message types of the eight character heads of the SMS replies. Any other head is the time (HH:MM:SS) of a status
+# update
+MESSAGE_TYPES = {
+    "........": "status_confirmation",
+    "=======>": "fault_report",
+    "------->": "command_information",
+    "        ": "controller identification",
+}
+COMMAND_INFORMATION_PREFIX = "!!------->"
+
+# The numbers, units and ON/OFF states of a reply, matched in a single pass
+TOKEN_PATTERN = re.compile(r'(?P<units>\bTESLA\b|\bAMPS\b)|(?P<switch>\bON\b|\bOFF\b)|'
+                           r'(?P<number>[-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)')
+
+SMSReply = namedtuple('SMSReply', ['message_type', 'message', 'numbers', 'units', 'switch'])
+
+
+def parse_reply(reply):
+    """Parse a reply of the SMS into an SMSReply: its message type, the message without the head, the numbers in the
+    message, and the first units (TESLA or AMPS) and ON/OFF state in it (None if there are none)"""
+    # Remove the special \x13 character and any whitespace around the message
+    message = reply.replace('\x13', '').strip()
+    message_type = MESSAGE_TYPES.get(message[:8], "status_update")
+    message = message[9:]
+    if message.startswith(COMMAND_INFORMATION_PREFIX):
+        message = message[len(COMMAND_INFORMATION_PREFIX) + 1:]
+        message_type = "command_information"
+
+    numbers = []
+    units = switch = None
+    for token in TOKEN_PATTERN.finditer(message):
+        kind = token.lastgroup
+        if kind == 'number':
+            numbers.append(float(token.group()))
+        elif kind == 'units':
+            if units is None:
+                units = token.group()
+        elif switch is None:
+            switch = token.group()
+    return SMSReply(message_type, message, numbers, units, switch)
+
+
+def get_units(driver):
+    """Get the units of the instrument, 'T' or 'A'. They only change with the UNITS command, so they are cached"""
+    command_result = driver.get_cached_result(driver.GetUnits.cmd, [])
+    if command_result is None:
+        # The caller holds the resource lock, so the query is run rather than shared with another thread's
+        command_result, error = driver.run_parsed_command(driver.GetUnits.cmd, [])
+        if error is not None:
+            raise ValueError("Could not get the instrument's units: {}".format(error))
+        driver.update_cache(driver.GetUnits.cmd, [], command_result)
+        # The command that needed the units waits for the instrument like any other
+        driver.pacer.wait()
+    if command_result['result'] not in ('T', 'A'):
+        raise ValueError("Could not get the instrument's units")
+    return command_result['result']
 
 
 def convert_units(driver, value, units):
-    result = driver.resource.query(driver.GetUnits.command())
-    found = re.search(r'(TESLA|AMPS)', result)
-    if found:
-        instr_units = found.group()
-        instr_units = 'T' if instr_units == 'TESLA' else 'A'
-    else:
-        raise ValueError("Could not get the instrument's units")
+    instr_units = get_units(driver)
 
     if units == 'T':
         if instr_units == 'A':
@@ -34,24 +81,124 @@ def convert_units(driver, value, units):
     return value
 
 
+RampSegment = namedtuple('RampSegment', ['mid', 'rate', 'duration'])
+
+
+class RampPlanner(object):
+    """Splits a ramp of the SMS into segments of constant ramp rate.
+
+    The safe ramp rate of a magnet depends on the field, and on how cold the magnet is. rate_tables gives the rates as
+    {temperature: [(field, rate), ...]}: at magnet temperatures up to temperature (K), fields up to field (T) are
+    ramped at rate (T/s). The table of the lowest temperature at or above the magnet temperature is used, and fields
+    beyond the last field of the table can't be ramped to.
+
+    The MID of the SMS is a magnitude, and the polarity is switched separately, so only ramps between fields of zero
+    or more are planned.
+
+    A ramp is planned as the RampSegments it goes through: the MID (T) at the end of the segment, its rate (T/s) and
+    its expected duration (s). Consecutive parts of the ramp with the same rate are merged into one segment.
+    """
+    def __init__(self, rate_tables):
+        if not rate_tables:
+            raise ValueError("At least one rate table is needed")
+        self.rate_tables = []
+        for temperature, table in sorted((float(temperature), table) for temperature, table in rate_tables.items()):
+            table = sorted((float(field), float(rate)) for field, rate in table)
+            if not table or any(rate <= 0 for field, rate in table):
+                raise ValueError("The rate table for {} K must have positive rates, instead got {}".format(
+                    temperature, table))
+            self.rate_tables.append((temperature, table))
+
+    def rate_table(self, temperature):
+        for max_temperature, table in self.rate_tables:
+            if temperature <= max_temperature:
+                return table
+        raise ValueError("There are no ramp rates for a magnet temperature of {} K".format(temperature))
+
+    @staticmethod
+    def rate_at(table, field):
+        """Ramp rate up to the field"""
+        for max_field, rate in table:
+            if field <= max_field:
+                return rate
+        raise ValueError("There is no ramp rate for {} T".format(field))
+
+    def plan(self, start_field, target_field, temperature):
+        """Get the segments of a ramp from start_field to target_field (T), at the magnet temperature (K)"""
+        if start_field < 0 or target_field < 0:
+            raise ValueError("Can't ramp from {} T to {} T, the polarity of the supply can't be reversed by a "
+                             "ramp".format(start_field, target_field))
+        table = self.rate_table(temperature)
+        if target_field > table[-1][0]:
+            raise ValueError("Can't ramp to {} T at {} K, the highest field is {} T".format(
+                target_field, temperature, table[-1][0]))
+
+        # The rate can only change where the ramp crosses one of the fields of the table
+        crossed = [field for field, rate in table if min(start_field, target_field) < field < max(start_field,
+                                                                                                target_field)]
+        if target_field < start_field:
+            crossed.reverse()
+        path = [start_field] + crossed + [target_field]
+
+        segments = []
+        for start, end in zip(path[:-1], path[1:]):
+            if start == end:
+                continue
+            # Between two breakpoints, the rate is the one of the higher field
+            rate = self.rate_at(table, max(start, end))
+            duration = abs(end - start) / rate
+            if segments and segments[-1].rate == rate:
+                segments[-1] = RampSegment(end, rate, segments[-1].duration + duration)
+            else:
+                segments.append(RampSegment(end, rate, duration))
+        return segments
+
+
 class SMSQueryCommand(DriverQueryCommand):
+    """Commands of the SMS. The reply is parsed with parse_reply, and process_result gets the SMSReply"""
+    # The SMS only accepts one command at a time
+    pipelined = False
+
     @classmethod
-    def execute(cls, driver, cmd, pars):
+    def query(cls, driver, message):
+        """Send a message and parse the reply. Returns None if the instrument is not in remote mode"""
         try:
-            result = driver.resource.query(cls.command(pars))
-        except pyvisa.errors.VisaIOError as e:
-            #print("Could not connect to the instrument. Set the instrument to remote mode and restart the driver")
-            #print(e)
+            reply = parse_reply(driver.resource.query(message))
+        except pyvisa.errors.VisaIOError:
+            return None
+        if reply.message.startswith('REMOTE CONTROL:'):
             return None
-        # Remove the special \x13 character before processing
-        result = result.replace('\x13', '')
-        print("RES", result)
-        message_type, result = SMSPowerSupplyDriver.strip_message_type(result)
-        print(message_type, result)
-        if 'REMOTE CONTROL: DISABLED' in result or 'REMOTE CONTROL: ENABLED' in result:
+        return reply
+
+    @classmethod
+    def execute(cls, driver, cmd, pars):
+        reply = cls.query(driver, cls.command(pars))
+        if reply is None:
             return None
-        print(result)
-        return cls.process_result(driver, cmd, pars, result)
+        return cls.process_result(driver, cmd, pars, reply)
+
+    @classmethod
+    def unexpected_reply(cls, reply):
+        return ValueError("The result '{}' did not match the expected format for the '{}' command".format(
+            reply.message, cls.cmd_alias or cls.cmd))
+
+
+class SMSSetCommand(SMSQueryCommand):
+    """Commands that change a setting. The SMS is slow to act on these, so the next command has to wait a while.
+
+    Every command of the SMS is sent as a query, since the SMS confirms settings, but these are set commands: they
+    are never coalesced, cached or published as readings.
+    """
+    type = CommandType.SET
+    coalesce = False
+    command_delay = 1
+
+    @classmethod
+    def process_result(cls, driver, cmd, pars, result):
+        # The SMS reports a setting it refused (e.g. a value out of range) as a fault, and leaves the setting as it was
+        if result.message_type == "fault_report":
+            raise ValueError("The SMS refused the '{}' command: {}".format(cls.cmd, result.message))
+        return ""
 
 
 class SMSPowerSupplyDriver(DriverCommandRunner):
@@ -62,35 +209,135 @@ class SMSPowerSupplyDriver(DriverCommandRunner):
     Since there is no way to get the setpoint on the SMS120C we have to use a workaround. The MID point can be used to
     track the setpoint as long as MAX is set to the maximum value that the power supply can output. Then MID can be
     set to the same value as MAX to initiate a ramp to maximum value. This works the same way for ZERO.
-    """
-
-    def write(self, command):
-        time.sleep(1)
-        return 0, None
 
-    def query(self, command):
-        time.sleep(1)
-        return 0, None
+    RAMPTO ramps to a field in segments planned by a RampPlanner from ramp_rate_tables. Each setting takes the SMS
+    about a second, so the segments are fed to the supply while it ramps: going into a slower segment, the slower rate
+    is sent ramp_lead_time seconds before the end of the current segment; going into a faster one, the new MID is
+    sent early and the faster rate once the boundary is passed. The ramp never runs faster than the plan, and doesn't
+    stop at the segment boundaries as long as ramp_lead_time covers two settings.
+    """
 
-    def __init__(self, driver_queue, driver_params, **kwargs):
+    def __init__(self, driver_queue, driver_params, ramp_rate_tables=None, ramp_lead_time=3, ramp_check_interval=10,
+                 **kwargs):
         super().__init__(driver_queue, driver_params, **kwargs)
         self.tesla_per_amp = 0
+        self.ramp_planner = RampPlanner(ramp_rate_tables) if ramp_rate_tables else None
+        self.ramp_lead_time = ramp_lead_time
+        # Longest time between two readings of the output while waiting for the end of a segment
+        self.ramp_check_interval = ramp_check_interval
+        self.ramp_abort = threading.Event()
+        self.ramp_progress = {'Segment': 0, 'Segments': 0, 'Active': 0, 'Error': ''}
 
         self.run_server_thread()
         self.startup()
+        self.run_telemetry_thread()
+        self.run_poller_thread()
+
+    def close(self):
+        self.ramp_abort.set()
+        super().close()
+
+    def run_command(self, command_class, pars):
+        """Run a command from the driver itself. Returns the result, or raises the command's error"""
+        command_result, error = self.execute_parsed_command(command_class.cmd, pars)
+        if error is not None:
+            raise error if isinstance(error, Exception) else RuntimeError(error)
+        return command_result['result']
+
+    def get_output_field(self):
+        output = self.run_command(self.GetOutput, ['T'])
+        if not isinstance(output, dict):
+            raise RuntimeError("Could not read the output of the supply")
+        return output['Output']
+
+    def plan_ramp(self, target_field, temperature):
+        """Plan a ramp from the present output to target_field (T) at the magnet temperature (K)"""
+        if self.ramp_planner is None:
+            raise ValueError("The driver has no ramp rate tables to plan ramps with")
+        return self.ramp_planner.plan(self.get_output_field(), target_field, temperature)
+
+    def start_ramp(self, target_field, temperature):
+        """Plan a ramp and start feeding its segments to the supply. Returns the segments"""
+        segments = self.plan_ramp(target_field, temperature)
+        self.stop_ramp()
+        # Every ramp has its own abort event, so that a stopped ramp can't send anything once the next one started
+        self.ramp_abort = threading.Event()
+        self.ramp_progress = {'Segment': 0, 'Segments': len(segments), 'Active': 1 if segments else 0, 'Error': ''}
+        if segments:
+            threading.Thread(target=self.run_ramp, args=(segments, self.ramp_abort)).start()
+        return segments
+
+    def stop_ramp(self):
+        """Stop feeding segments. The supply finishes ramping to the MID of the segment it is in"""
+        self.ramp_abort.set()
+        self.ramp_progress['Active'] = 0
+
+    def run_ramp_command(self, abort, command_class, pars):
+        """Run a command of a ramp, unless the ramp was stopped. Returns False if it was"""
+        with self.resource_lock:
+            if abort.is_set():
+                return False
+            self.run_command(command_class, pars)
+            return True
+
+    def wait_for_field(self, abort, field, direction, rate, lead_time):
+        """Wait until the output is lead_time seconds (at rate) from passing field, going in direction (+1 or -1).
+        Returns False if the ramp was stopped"""
+        while not abort.is_set():
+            remaining = (field - self.get_output_field()) * direction / rate
+            if remaining <= lead_time:
+                return True
+            abort.wait(min(remaining - lead_time, self.ramp_check_interval))
+        return False
+
+    def run_ramp(self, segments, abort):
+        try:
+            field = self.get_output_field()
+            if not (self.run_ramp_command(abort, self.SetRampRate, [segments[0].rate, 'T']) and
+                    self.run_ramp_command(abort, self.SetMid, [segments[0].mid, 'T']) and
+                    self.run_ramp_command(abort, self.SetRamp, ['MID'])):
+                return
+
+            for index in range(1, len(segments)):
+                previous, segment = segments[index - 1], segments[index]
+                direction = 1 if previous.mid >= field else -1
+                field = previous.mid
+                if not self.wait_for_field(abort, previous.mid, direction, previous.rate, self.ramp_lead_time):
+                    return
+                if segment.rate < previous.rate:
+                    # Slow down before the boundary, then move the MID on
+                    if not (self.run_ramp_command(abort, self.SetRampRate, [segment.rate, 'T']) and
+                            self.run_ramp_command(abort, self.SetMid, [segment.mid, 'T'])):
+                        return
+                else:
+                    # Move the MID on before the boundary, and only speed up once it is passed
+                    if not (self.run_ramp_command(abort, self.SetMid, [segment.mid, 'T']) and
+                            self.wait_for_field(abort, previous.mid, direction, previous.rate, 0) and
+                            self.run_ramp_command(abort, self.SetRampRate, [segment.rate, 'T'])):
+                        return
+                self.ramp_progress['Segment'] = index
+        except Exception as e:
+            # E.g. a setting the supply refused. The error is reported with the progress of the ramp
+            logger.exception("Ramp stopped")
+            if not abort.is_set():
+                self.ramp_progress['Error'] = str(e)
+        finally:
+            if not abort.is_set():
+                self.ramp_progress['Active'] = 0
 
     def set_tesla_per_amp(self, tesla_per_amp):
         self.tesla_per_amp = tesla_per_amp
 
     def startup(self):
-        try:
-            self.tesla_per_amp = float(self.GetTeslaPerAmp.execute(self, self.GetTeslaPerAmp.cmd, []))
-            print(self.tesla_per_amp)
-        except TypeError:
-            print("Could not start the driver because the instrument was not set to remote mode")
-            quit(-1)
+        # The server thread is already running, so the instrument has to be locked
+        with self.resource_lock:
+            try:
+                self.tesla_per_amp = float(self.GetTeslaPerAmp.execute(self, self.GetTeslaPerAmp.cmd, []))
+            except TypeError:
+                logger.error("Could not start the driver because the instrument was not set to remote mode")
+                quit(-1)
 
-        self.resource.query(self.GetMid.command(['T']))
+            self.resource.query(self.GetMid.command(['T']))
 
     @staticmethod
     def validate_units_T_A(units):
@@ -109,38 +356,68 @@ class SMSPowerSupplyDriver(DriverCommandRunner):
         Messages come from the SMS in the format '******** Message'
         The 8 * characters represent the message_type and is always followed by a space.
         """
-        # Remove any unwanted whitespace at start and end of message
-        message = message.strip()
-        message = message.replace('\x13', '')
-        message_head = message[:8]
-        message = message[9:]
-        if message[:10] == "!!------->":
-            message = message[11:]
-            message_type = "command_information"
-        else:
-            if message_head == "........":
-                message_type = "status_confirmation"
-            elif message_head == "=======>":
-                message_type = "fault_report"
-            elif message_head == "------->":
-                message_type = "command_information"
-            elif message_head == "        ":  # 8 spaces
-                message_type = "controller identification"
-            else:  # Should have the format HH:MM:SS
-                message_type = "status_update"
-        return message_type, message
+        reply = parse_reply(message)
+        return reply.message_type, reply.message
+
+    class PlanRamp(SMSQueryCommand):
+        """Plans a ramp to a field (T) at a magnet temperature (K), without starting it"""
+        cmd = "RAMPPLAN?"
+        arguments = "{},{}"
+        coalesce = False
+        publish_telemetry = False
+
+        @classmethod
+        def _validate(cls, pars):
+            float(pars[0])
+            float(pars[1])
+
+        @classmethod
+        def execute(cls, driver, cmd, pars):
+            return [segment._asdict() for segment in driver.plan_ramp(float(pars[0]), float(pars[1]))]
+
+    class StartRamp(SMSSetCommand):
+        """Ramps to a field (T, zero or more) at a magnet temperature (K) in planned segments, see RampPlanner"""
+        cmd = "RAMPTO"
+        arguments = "{},{}"
+        # The settings of the segments are paced by the ramp itself
+        command_delay = 0
+
+        @classmethod
+        def _validate(cls, pars):
+            SMSPowerSupplyDriver.PlanRamp._validate(pars)
+
+        @classmethod
+        def execute(cls, driver, cmd, pars):
+            return [segment._asdict() for segment in driver.start_ramp(float(pars[0]), float(pars[1]))]
+
+    class StopRamp(SMSSetCommand):
+        cmd = "RAMPSTOP"
+        command_delay = 0
+
+        @classmethod
+        def execute(cls, driver, cmd, pars):
+            driver.stop_ramp()
+            return ""
+
+    class GetRampProgress(SMSQueryCommand):
+        """The segment the ramp is in, whether segments are still being fed, and the error that stopped the ramp"""
+        cmd = "RAMPSTATUS?"
+
+        @classmethod
+        def execute(cls, driver, cmd, pars):
+            return dict(driver.ramp_progress)
 
     class GetFilterStatus(SMSQueryCommand):
         cmd = "FILTER?"
         cmd_alias = "FILTER"
+        cache_policy = CachePolicy.UNTIL_INVALIDATED
+        invalidated_by = ("FILTER",)
 
         @classmethod
         def process_result(cls, driver, cmd, pars, result):
-            found = re.search(r'(ON|OFF)', result)
-            if not found:
-                raise ValueError("The result '{}' did not match the expected format for the '{}' command".format(
-                    result, cls.cmd))
-            return 0 if found.group() == 'OFF' else 1
+            if result.switch is None:
+                raise cls.unexpected_reply(result)
+            return 0 if result.switch == 'OFF' else 1
 
     class GetOutput(SMSQueryCommand):
         cmd = "OUTP?"
@@ -148,74 +425,50 @@ class SMSPowerSupplyDriver(DriverCommandRunner):
         cmd_alias = "GET OUTPUT"
         arguments_alias = ""
 
-        #@classmethod
-        #def execute(cls, driver, cmd, pars, method):
-        ##    value = convert_units(driver, float(pars[0]), pars[1])
-        #    result = method(cls.cmd_alias + " " + cls.arguments_alias.format(value))
-        #    return cls.process_result(driver, cmd, pars, result)
-
         @classmethod
         def process_result(cls, driver, cmd, pars, result):
-            print(result)
-            values = find_numbers(result)
-            units = re.search(r'(TESLA|AMPS)', result)
-            if not values or not units:
-                raise ValueError("The result '{}' did not match the expected format for the '{}' command".
-                                 format(result, cls.cmd_alias))
-            output = float(values[0].group())
-            print("OUTPUT VALUE:", output, units)
-            units = units.group()
-
-            if pars[0] == 'T' and units == 'AMPS':
+            if len(result.numbers) < 2 or result.units is None:
+                raise cls.unexpected_reply(result)
+            output = result.numbers[0]
+
+            if pars[0] == 'T' and result.units == 'AMPS':
                 output *= driver.tesla_per_amp
-            elif pars[0] == 'A' and units == 'TESLA':  # pars[0] == 'A' is the only other option because we validated the command before this
+            elif pars[0] == 'A' and result.units == 'TESLA':  # pars[0] == 'A' is the only other option because we validated the command before this
                 output /= driver.tesla_per_amp
-            print("OUTPUT VALUE:", output)
 
             return {'Output': output,
-                    'Voltage': float(values[1].group()),
+                    'Voltage': result.numbers[1],
                     'Persistent': 0}
 
-    class SetFilterStatus(SMSQueryCommand):
+    class SetFilterStatus(SMSSetCommand):
         cmd = "FILTER"
         arguments = "{}"
 
-        @classmethod
-        def process_result(cls, driver, cmd, pars, result):
-            return ""
-
     class GetUnits(SMSQueryCommand):
         cmd = "UNITS?"
         arguments = ""
         cmd_alias = "TESLA"
         arguments_alias = ""
+        cache_policy = CachePolicy.UNTIL_INVALIDATED
+        invalidated_by = ("UNITS",)
 
         @classmethod
         def process_result(cls, driver, cmd, pars, result):
+            if result.units is None:
+                raise cls.unexpected_reply(result)
+            return 'T' if result.units == 'TESLA' else 'A'
 
-            found = re.search(r'(TESLA|AMPS)', result)
-            if found:
-                units = found.group()
-                return 'T' if units == 'TESLA' else 'A'
-            else:
-                raise ValueError("The result '{}' did not match the expected format for the '{}' command".
-                                 format(result, cls.cmd_alias))
-
-    class SetUnits(SMSQueryCommand):
+    class SetUnits(SMSSetCommand):
         cmd = "UNITS"
         arguments = "{}"
         cmd_alias = "TESLA"
         arguments_alias = "{}"
 
         @classmethod
-        def execute(cls, driver, cmd, pars, resource):
+        def execute(cls, driver, cmd, pars):
             value = 1 if pars[0] == 'T' else 0
-            result = resource.query(cls.cmd_alias + " " + cls.arguments_alias.format(value))
-            return cls.process_result(driver, cmd, pars, result)
-
-        @classmethod
-        def process_result(cls, driver, cmd, pars, result):
-            return ""
+            result = cls.query(driver, cls.cmd_alias + " " + cls.arguments_alias.format(value))
+            return None if result is None else cls.process_result(driver, cmd, pars, result)
 
     class GetMid(SMSQueryCommand):
         cmd = "MID?"
@@ -229,13 +482,10 @@ class SMSPowerSupplyDriver(DriverCommandRunner):
 
         @classmethod
         def process_result(cls, driver, cmd, pars, result):
-            value = find_number(result)
-            units = re.search(r'(TESLA|AMPS)', result)
-            if not value or not units:
-                raise ValueError("The result '{}' did not match the expected format for the '{}' command".
-                                 format(result, cls.cmd_alias))
-            value = float(value.group())
-            units = units.group()
+            if not result.numbers or result.units is None:
+                raise cls.unexpected_reply(result)
+            value = result.numbers[0]
+            units = result.units
 
             if pars[0] == 'T':
                 if units == 'TESLA':
@@ -248,7 +498,7 @@ class SMSPowerSupplyDriver(DriverCommandRunner):
                 else:
                     return value
 
-    class SetMid(SMSQueryCommand):
+    class SetMid(SMSSetCommand):
         cmd = "MID"
         arguments = "{},{}"
         cmd_alias = "SET MID"
@@ -259,16 +509,16 @@ class SMSPowerSupplyDriver(DriverCommandRunner):
             SMSPowerSupplyDriver.validate_units_T_A(pars[1])
 
         @classmethod
-        def execute(cls, driver, cmd, pars, resource):
+        def execute(cls, driver, cmd, pars):
             value = convert_units(driver, float(pars[0]), pars[1])
-            result = resource.query(cls.cmd_alias + " " + cls.arguments_alias.format(value))
-            return cls.process_result(driver, cmd, pars, result)
+            result = cls.query(driver, cls.cmd_alias + " " + cls.arguments_alias.format(value))
+            return None if result is None else cls.process_result(driver, cmd, pars, result)
 
         @classmethod
         def process_result(cls, driver, cmd, pars, result):
-            if message_type == "command_information":
-                return result
-            return ""
+            if result.message_type == "command_information":
+                return result.message
+            return super().process_result(driver, cmd, pars, result)
 
     class GetSetpoint(GetMid):
         """The get setpoint command returns the MID value in order to get around the limitation of not being able to
@@ -277,7 +527,7 @@ class SMSPowerSupplyDriver(DriverCommandRunner):
         """
         cmd = "SETP?"
 
-    class SetSetpoing(SetMid):
+    class SetSetpoint(SetMid):
         """The set setpoint command sets the MID value in order to get around the limitation of not being able to
         query the setpoint on the SMS120C. This command is purely for clarity when using the driver and does exactly the
         same thing that "SET MID" does
@@ -292,7 +542,7 @@ class SMSPowerSupplyDriver(DriverCommandRunner):
         cmd = "MAX"
         cmd_alias = "SET MAX"
 
-    class SetRamp(SMSQueryCommand):
+    class SetRamp(SMSSetCommand):
         cmd = "RAMP"
         arguments = "{}"
 
@@ -300,15 +550,6 @@ class SMSPowerSupplyDriver(DriverCommandRunner):
         def _validate(cls, pars):
             SMSPowerSupplyDriver.validate_ramp_to(pars[0])
 
-        @classmethod
-        def execute(cls, driver, cmd, pars, method):
-            result = driver.resource.write(cls.command(pars))
-            return cls.process_result(driver, cmd, pars, '')
-
-        @classmethod
-        def process_result(cls, driver, cmd, pars, result):
-            return result
-
     class GetRampRate(SMSQueryCommand):
         cmd = "RATE?"
         arguments = "{}"
@@ -321,18 +562,16 @@ class SMSPowerSupplyDriver(DriverCommandRunner):
 
         @classmethod
         def process_result(cls, driver, cmd, pars, result):
-            value = find_number(result)
-            if not value:
-                raise ValueError("The result '{}' did not match the expected format for the '{}' command".
-                                 format(result, cls.cmd_alias))
-            value = float(value.group())
+            if not result.numbers:
+                raise cls.unexpected_reply(result)
+            value = result.numbers[0]
 
             if pars[0] == 'T':
                 return value * driver.tesla_per_amp
             else:
                 return value
 
-    class SetRampRate(SMSQueryCommand):
+    class SetRampRate(SMSSetCommand):
         cmd = "RATE"
         arguments = "{},{}"
         cmd_alias = "SET RAMP"
@@ -343,19 +582,12 @@ class SMSPowerSupplyDriver(DriverCommandRunner):
             SMSPowerSupplyDriver.validate_units_T_A(pars[1])
 
         @classmethod
-        def execute(cls, driver, cmd, pars, resource):
+        def execute(cls, driver, cmd, pars):
             value = float(pars[0])
             if pars[1] == 'T':
                 value /= driver.tesla_per_amp
-            result = resource.query(cls.cmd_alias + " " + cls.arguments_alias.format(value))
-            return cls.process_result(driver, cmd, pars, result)
-
-        @classmethod
-        def process_result(cls, driver, cmd, pars, result):
-            #message_type, result = SMSPowerSupplyDriver.strip_message_type(result)
-            #if message_type == "command_information":
-            #    return result
-            return ""
+            result = cls.query(driver, cls.cmd_alias + " " + cls.arguments_alias.format(value))
+            return None if result is None else cls.process_result(driver, cmd, pars, result)
 
     class GetVoltageLimit(SMSQueryCommand):
         cmd = "VLIM?"
@@ -365,64 +597,46 @@ class SMSPowerSupplyDriver(DriverCommandRunner):
 
         @classmethod
         def process_result(cls, driver, cmd, pars, result):
-            value = find_number(result)
-            if not value:
-                raise ValueError("The result '{}' did not match the expected format for the '{}' command".
-                                 format(result, cls.cmd_alias))
-            return float(value.group())
+            if not result.numbers:
+                raise cls.unexpected_reply(result)
+            return result.numbers[0]
 
-    class SetVoltageLimit(SMSQueryCommand):
+    class SetVoltageLimit(SMSSetCommand):
         cmd = "VLIM"
         arguments = "{}"
         cmd_alias = "SET LIMIT"
         arguments_alias = "{}"
 
-        @classmethod
-        def process_result(cls, driver, cmd, pars, result):
-            return ""
-
     class GetHeaterVoltage(SMSQueryCommand):
         cmd = "HTRV?"
         cmd_alias = "GET HV"
 
         @classmethod
         def process_result(cls, driver, cmd, pars, result):
-            value = find_number(result)
-            if not value:
-                raise ValueError("The result '{}' did not match the expected format for the '{}' command".
-                                 format(result, cls.cmd_alias))
-            return float(value.group())
+            if not result.numbers:
+                raise cls.unexpected_reply(result)
+            return result.numbers[0]
 
-    class SetHeaterVoltage(SMSQueryCommand):
+    class SetHeaterVoltage(SMSSetCommand):
         cmd = "HTRV"
         arguments = "{}"
         cmd_alias = "SET HEATER"
         arguments_alias = "{}"
 
-        @classmethod
-        def process_result(cls, driver, cmd, pars, result):
-            return ""
-
     class GetPauseState(SMSQueryCommand):
         cmd = "PAUSE?"
         cmd_alias = "PAUSE"
 
         @classmethod
         def process_result(cls, driver, cmd, pars, result):
-            status = re.search(r'(ON|OFF)', result)
-            if not status:
-                raise ValueError("The result '{}' did not match the expected format for the '{}' command".
-                                 format(result, cls.cmd_alias))
-            return 0 if status.group() == 'OFF' else 1
+            if result.switch is None:
+                raise cls.unexpected_reply(result)
+            return 0 if result.switch == 'OFF' else 1
 
-    class SetPauseState(SMSQueryCommand):
+    class SetPauseState(SMSSetCommand):
         cmd = "PAUSE"
         arguments = "{}"
 
-        @classmethod
-        def process_result(cls, driver, cmd, pars, result):
-            return ""
-
     class GetPersistentHeaterStatus(SMSQueryCommand):
         cmd = "HTR?"
         arguments = "{}"
@@ -430,34 +644,26 @@ class SMSPowerSupplyDriver(DriverCommandRunner):
 
         @classmethod
         def process_result(cls, driver, cmd, pars, result):
-            value = find_number(result)
-            units = re.search(r'(TESLA|AMPS)', result)
-            status = re.search(r'(ON|OFF)', result)
-            if not status:
-                raise ValueError("The result '{}' did not match the expected format for the '{}' command".
-                                 format(result, cls.cmd_alias))
-            if value:
-                value = float(value.group())
-                if units == 'TESLA' and pars[0] == 'A':
+            if result.switch is None:
+                raise cls.unexpected_reply(result)
+            if result.numbers:
+                value = result.numbers[0]
+                if result.units == 'TESLA' and pars[0] == 'A':
                     value /= driver.tesla_per_amp
-                elif units == 'AMPS' and pars[0] == 'T':
+                elif result.units == 'AMPS' and pars[0] == 'T':
                     value *= driver.tesla_per_amp
             else:
                 value = 0
-            return {'Status': 0 if status.group() == 'OFF' else 1,
+            return {'Status': 0 if result.switch == 'OFF' else 1,
                     'Switched off at': value}
 
-    class SetPersistentHeaterStatus(SMSQueryCommand):
+    class SetPersistentHeaterStatus(SMSSetCommand):
         cmd = "HTR"
         arguments = "{}"
         cmd_alias = "HEATER"
         arguments_alias = "{}"
 
-        @classmethod
-        def process_result(cls, driver, cmd, pars, result):
-            return ""
-
-    class SetTeslaPerAmp(SMSQueryCommand):
+    class SetTeslaPerAmp(SMSSetCommand):
         cmd = "TPA"
         arguments = "{}"
         cmd_alias = "SET TPA"
@@ -471,27 +677,26 @@ class SMSPowerSupplyDriver(DriverCommandRunner):
 
         @classmethod
         def process_result(cls, driver, cmd, pars, result):
-            print(result)
-            return result
+            super().process_result(driver, cmd, pars, result)
+            return result.message
 
     class GetTeslaPerAmp(SMSQueryCommand):
         cmd = "TPA?"
         arguments = ""
         cmd_alias = "GET TPA"
         arguments_alias = ""
+        cache_policy = CachePolicy.UNTIL_INVALIDATED
+        invalidated_by = ("TPA",)
 
         @classmethod
         def process_result(cls, driver, cmd, pars, result):
-            found = find_number(result)
-            if found:
-                tesla_per_amp = float(found.group())
-                # Record the T/A setting on the driver. The user should never set this via the instrument front panel
-                # so it should be OK to store this whenever it is read
-                driver.set_tesla_per_amp(tesla_per_amp)
-                return tesla_per_amp
-            else:
-                raise ValueError("The result '{}' did not match the expected format for the '{}' command".
-                                 format(result, cls.cmd_alias))
+            if not result.numbers:
+                raise cls.unexpected_reply(result)
+            tesla_per_amp = result.numbers[0]
+            # Record the T/A setting on the driver. The user should never set this via the instrument front panel
+            # so it should be OK to store this whenever it is read
+            driver.set_tesla_per_amp(tesla_per_amp)
+            return tesla_per_amp
 
 
 if __name__ == '__main__':
@@ -504,7 +709,12 @@ if __name__ == '__main__':
                                                  'baud_rate': SMS_config.getint('baud_rate'),
                                                  'parity': SMS_config['parity'],
                                                  'data_bits': SMS_config.getint('data_bits'),
-                                                 'termination': SMS_config['termination']})
+                                                 'termination': SMS_config['termination']},
+                                  consumer_mode=SMS_config.getboolean('consumer_mode', True),
+                                  coalesce_window=SMS_config.getfloat('coalesce_window', 0),
+                                  poll_commands=json.loads(SMS_config.get('poll_commands', '{}')),
+                                  ramp_rate_tables=json.loads(SMS_config.get('ramp_rate_tables', '{}')),
+                                  telemetry_source=SMS_config.get('telemetry_source'))
 
     try:
         time.sleep(1000000)
@@ -2,4 +2,10 @@ from .driver import *
 from .controller import *
 from .command_runner import *
 from .ieee488_common_commands import *
+from .lakeshore_curve_commands import *
+from .serialization import *
+from .transport import *
 from .rmq_component import *
+from .telemetry import *
+from .ring_buffer import *
+from .aio_rmq_component import *
@@ -0,0 +1,467 @@
+import asyncio
+import inspect
+import uuid
+from queue import PriorityQueue
+
+try:
+    import aio_pika
+except ImportError:
+    aio_pika = None
+
+from .command_runner import CommandProcessor
+from .components import Component
+from .rmq_component import logger, RmqResp
+from .serialization import JsonCodec, DecodeError, get_codec, decode, codecs
+from .transport import LocalConnection, default_broker
+
+
+class AioTransport(object):
+    """Asyncio version of Transport. connect is a coroutine, and so are the methods of the connections it opens
+    (declare_queue, set_prefetch, consume, acknowledge, publish, consume_replies and close, with the same contract as
+    the Connection methods). Messages are handed to the connection as Python objects, and a connection must only be
+    used by the event loop that opened it.
+    """
+    async def connect(self):
+        raise NotImplementedError()
+
+    async def close(self):
+        """Close whatever the connections share, once every role is done"""
+        pass
+
+
+class AioRmqTransport(AioTransport):
+    """Transport through a RabbitMQ broker, with aio_pika. The connections are channels on one shared connection.
+
+    Messages are encoded and decoded like with RmqTransport: with the codec for content_type when sending, with the
+    codec of their own content_type when receiving, and messages that can't be decoded are rejected and dropped.
+    """
+    def __init__(self, url='amqp://localhost/', content_type=JsonCodec.content_type):
+        if aio_pika is None:
+            raise ImportError('AioRmqTransport needs aio_pika')
+        self.url = url
+        if content_type not in codecs:
+            logger.warning('Content type {} is not supported, using {}'.format(content_type, JsonCodec.content_type))
+            content_type = JsonCodec.content_type
+        self.content_type = content_type
+        # Every role connects at start up, only the first one opens the connection
+        self.connection_task = None
+
+    async def connect(self):
+        if self.connection_task is None:
+            self.connection_task = asyncio.ensure_future(aio_pika.connect_robust(self.url))
+        connection = await self.connection_task
+        channel = await connection.channel()
+        logger.info('Created a new channel')
+        return AioRmqConnection(channel, self.content_type)
+
+    async def close(self):
+        if self.connection_task is not None:
+            connection = await self.connection_task
+            self.connection_task = None
+            await connection.close()
+            logger.info('Connection closed')
+
+
+class AioRmqConnection(object):
+    def __init__(self, channel, content_type=JsonCodec.content_type):
+        self.channel = channel
+        self.content_type = content_type
+        self.queues = {}
+        # Messages pushed by the broker to the consumer of each queue, waiting to be consumed
+        self.received = {}
+
+    async def declare_queue(self, queue, max_priority=None):
+        await self.channel.queue_delete(queue)
+        arguments = {'x-max-priority': max_priority} if max_priority else None
+        self.queues[queue] = await self.channel.declare_queue(queue, arguments=arguments)
+
+    async def set_prefetch(self, prefetch_count):
+        await self.channel.set_qos(prefetch_count=prefetch_count)
+
+    async def consume(self, queue, timeout):
+        if queue not in self.received:
+            self.received[queue] = asyncio.Queue()
+            await self.queues[queue].consume(self.received[queue].put)
+        try:
+            if timeout:
+                amqp_message = await asyncio.wait_for(self.received[queue].get(), timeout)
+            else:
+                amqp_message = self.received[queue].get_nowait()
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return None, None
+        try:
+            message = decode(amqp_message.body, amqp_message.content_type)
+        except DecodeError as e:
+            logger.error('Rejected a message from {}: {}'.format(queue, e))
+            await amqp_message.reject(requeue=False)
+            return None, None
+        # The AMQP message has the reply_to, correlation_id, content_type, priority and headers properties, and it is
+        # acknowledged once the response has been sent
+        return message, amqp_message
+
+    async def acknowledge(self, properties):
+        await properties.ack()
+
+    async def publish(self, queue, message, reply_to=None, correlation_id=None, content_type=None, priority=None,
+                      headers=None):
+        if content_type is None:
+            content_type = self.content_type
+        codec = get_codec(content_type)
+        await self.channel.default_exchange.publish(
+            aio_pika.Message(body=codec.encode(message),
+                             content_type=codec.content_type,
+                             correlation_id=correlation_id,
+                             reply_to=reply_to,
+                             priority=priority,
+                             headers=headers),
+            routing_key=queue)
+
+    async def consume_replies(self, callback):
+        """Create an exclusive queue to receive the replies on"""
+        async def on_reply(amqp_message):
+            try:
+                message = decode(amqp_message.body, amqp_message.content_type)
+            except DecodeError as e:
+                logger.error('Dropped the reply to {}: {}'.format(amqp_message.correlation_id, e))
+                return
+            callback(message, amqp_message)
+
+        reply_queue = await self.channel.declare_queue(exclusive=True)
+        await reply_queue.consume(on_reply, no_ack=True)
+        return reply_queue.name
+
+    async def close(self):
+        await self.channel.close()
+        logger.info('Channel closed')
+
+
+class AioLocalTransport(AioTransport):
+    """In-process transport for asyncio components. The queues are those of a LocalBroker, so asyncio components can
+    exchange messages with threaded components on a LocalTransport with the same broker (by default, the one of the
+    process)."""
+    def __init__(self, broker=None):
+        self.broker = broker if broker is not None else default_broker
+
+    async def connect(self):
+        return AioLocalConnection(self.broker)
+
+
+class AioLocalConnection(object):
+    """Does what a LocalConnection does, but waits for messages without blocking the event loop"""
+    def __init__(self, broker):
+        self.connection = LocalConnection(broker)
+        self.reply_task = None
+
+    async def declare_queue(self, queue, max_priority=None):
+        self.connection.declare_queue(queue, max_priority)
+
+    async def set_prefetch(self, prefetch_count):
+        pass
+
+    async def consume(self, queue, timeout):
+        message, properties = self.connection.consume(queue, 0)
+        if properties is not None or not timeout:
+            return message, properties
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        # Another consumer of the queue (e.g. a thread) may take the message first, so wait again until the deadline
+        while properties is None and loop.time() < deadline:
+            if not await self.connection.broker.get_queue(queue).wait_async(deadline - loop.time()):
+                break
+            message, properties = self.connection.consume(queue, 0)
+        return message, properties
+
+    async def acknowledge(self, properties):
+        pass
+
+    async def publish(self, queue, message, reply_to=None, correlation_id=None, content_type=None, priority=None,
+                      headers=None):
+        self.connection.publish(queue, message, reply_to, correlation_id, content_type, priority, headers)
+
+    async def consume_replies(self, callback):
+        reply_to = self.connection.consume_replies(callback)
+        self.reply_task = asyncio.ensure_future(self.dispatch_replies(reply_to, callback))
+        return reply_to
+
+    async def dispatch_replies(self, reply_to, callback):
+        while True:
+            message, properties = await self.consume(reply_to, 1)
+            if properties is not None:
+                callback(message, properties)
+
+    async def close(self):
+        if self.reply_task is not None:
+            self.reply_task.cancel()
+        self.connection.close()
+
+
+class AioRmqComponent(object):
+    """Base class for asyncio RabbitMQ components.
+
+    Unlike RmqComponent, all the roles of an asyncio component (server, client, state machine) run as tasks in one
+    event loop, so no extra threads are needed. Each role opens its own connection with the component's transport. By
+    default this is an AioRmqTransport (which needs aio_pika) connected to the broker on localhost, where the
+    connections are channels on one shared connection. An AioLocalTransport runs without a broker.
+    """
+    def __init__(self, transport=None, **kwargs):
+        super().__init__(**kwargs)
+        self.transport = transport if transport is not None else AioRmqTransport()
+        self.done = False   # Flag to tell if the component should be shut down
+        self.closed = None
+
+    def closed_event(self):
+        # Created on first use, from the event loop that runs the component
+        if self.closed is None:
+            self.closed = asyncio.Event()
+        return self.closed
+
+    async def run(self, *coroutines):
+        """Run the given coroutines (e.g. run_response_server, setup_client, a state machine's run_async) until close
+        is called or one of them fails"""
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Let the roles close their connections
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.transport.close()
+
+    def close(self):
+        # Request that the component close. Must be called from the component's event loop
+        logger.info('Requesting server close')
+        self.done = True
+        self.closed_event().set()
+
+
+class AioRmqResp(AioRmqComponent):
+    """Asyncio version of RmqResp, always in consumer mode.
+
+    Messages are scheduled like RmqResp schedules them: by priority (with up to prefetch_count received messages
+    waiting), split into chunks with split_message, and answered with merge_responses, or chunk by chunk if the
+    message is streamed. Replies are sent in the content type of the request.
+
+    process_message has the same contract as RmqResp.process_message, but it may also be a coroutine function. Other
+    tasks of the event loop only run while it awaits.
+    """
+    def __init__(self, server_queue, prefetch_count=10, consumer_timeout=1, max_priority=10, **kwargs):
+        super().__init__(**kwargs)
+        self.response_server_queue = server_queue
+        # Messages waiting to be processed, ordered by (-priority, arrival order)
+        self.response_thread_queue = PriorityQueue()
+        self.prefetch_count = prefetch_count
+        self.consumer_timeout = consumer_timeout
+        self.max_priority = max_priority
+        self.message_count = 0
+
+    schedule_message = RmqResp.schedule_message
+    get_priority = RmqResp.get_priority
+    split_message = RmqResp.split_message
+    merge_responses = RmqResp.merge_responses
+    is_final_response = RmqResp.is_final_response
+
+    async def init_server_queues(self):
+        await self.server_connection.declare_queue(self.response_server_queue, max_priority=self.max_priority)
+        logger.info('Declared queue: {}'.format(self.response_server_queue))
+
+    async def run_response_server(self):
+        self.server_connection = await self.transport.connect()
+        logger.info('Server Connection opened')
+        try:
+            await self.init_server_queues()
+            await self.server_connection.set_prefetch(self.prefetch_count)
+            while not self.done:
+                if self.response_thread_queue.empty():
+                    # The wait is interrupted every consumer_timeout seconds so that a close request is noticed
+                    message, properties = await self.server_connection.consume(self.response_server_queue,
+                                                                               self.consumer_timeout)
+                    if properties is None:
+                        continue
+                    logger.info('Received a message: {} | {}'.format(message, properties.reply_to))
+                    self.schedule_message(message, properties)
+                # Pick up the messages that have already arrived so that the most urgent one is processed first
+                await self.receive_waiting_messages()
+                await self.process_next_chunk()
+        finally:
+            await self.server_connection.close()
+            logger.info('Server Connection closed')
+
+    async def receive_waiting_messages(self):
+        while self.response_thread_queue.qsize() < self.prefetch_count:
+            message, properties = await self.server_connection.consume(self.response_server_queue, 0)
+            if properties is None:
+                break
+            logger.info('Received a message: {} | {}'.format(message, properties.reply_to))
+            self.schedule_message(message, properties)
+
+    async def process_next_chunk(self):
+        priority, count, scheduled_message = self.response_thread_queue.get_nowait()
+        chunk = scheduled_message.chunks.pop(0)
+        response = self.process_message(chunk)
+        if inspect.isawaitable(response):
+            response = await response
+        if scheduled_message.chunks and self.is_final_response(chunk, response):
+            scheduled_message.chunks = []
+
+        if scheduled_message.stream:
+            await self.send_response(response, scheduled_message.properties, partial=bool(scheduled_message.chunks))
+        else:
+            scheduled_message.responses.append(response)
+
+        if scheduled_message.chunks:
+            # Let more urgent messages run before the next chunk
+            self.response_thread_queue.put((priority, count, scheduled_message))
+        else:
+            if not scheduled_message.stream:
+                await self.send_response(self.merge_responses(scheduled_message.responses),
+                                         scheduled_message.properties)
+            await self.server_connection.acknowledge(scheduled_message.properties)
+
+    def process_message(self, message):
+        return None
+
+    async def send_response(self, response, properties, partial=False):
+        logger.info('Sending response: {}'.format(response))
+        # Reply in the encoding the client used for the request
+        await self.server_connection.publish(properties.reply_to, response,
+                                             correlation_id=properties.correlation_id,
+                                             content_type=properties.content_type,
+                                             headers={'partial': True} if partial else None)
+
+
+class AioRmqReq(AioRmqComponent):
+    """Asyncio version of RmqReq.
+
+    send_direct_message returns an asyncio Future that is resolved with the reply, as RmqReq.send_direct_message
+    does, and takes the same callback, priority, partial_callback and timeout. request sends a message and waits for
+    the reply. A request expires after request_timeout seconds without a reply (or the timeout it was sent with), and
+    its Future raises asyncio.TimeoutError. A request whose Future is cancelled is forgotten, so a late reply is
+    dropped.
+    """
+    def __init__(self, request_timeout=30, **kwargs):
+        super().__init__(**kwargs)
+        # Requests that have been sent but not yet replied to, keyed by correlation id, as
+        # (future, callback, partial_callback, timeout, expiry timer)
+        self.pending_requests = {}
+        self.request_timeout = request_timeout
+        self.client_ready = None
+
+    def client_ready_event(self):
+        if self.client_ready is None:
+            self.client_ready = asyncio.Event()
+        return self.client_ready
+
+    async def setup_client(self):
+        self.client_connection = await self.transport.connect()
+        logger.info('Client Connection opened')
+        try:
+            await self.init_client_queues()
+            self.client_ready_event().set()
+            await self.closed_event().wait()
+        finally:
+            self.client_ready_event().clear()
+            self.cancel_pending_requests()
+            await self.client_connection.close()
+            logger.info('Client Connection closed')
+
+    async def init_client_queues(self):
+        self.reply_to = await self.client_connection.consume_replies(self.process_direct_reply)
+
+    def send_direct_message(self, queue_name, message, callback=None, priority=None, partial_callback=None,
+                            timeout=None):
+        """Send a message to queue_name and return a Future for the reply. Must be called from the client's event
+        loop"""
+        if timeout is None:
+            timeout = self.request_timeout
+        correlation_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self.pending_requests[correlation_id] = (future, callback, partial_callback, timeout,
+                                                 self.schedule_expiry(correlation_id, timeout))
+        future.add_done_callback(lambda f: self.forget_request(correlation_id))
+        asyncio.ensure_future(self.publish_request(queue_name, message, correlation_id, priority))
+        return future
+
+    async def publish_request(self, queue_name, message, correlation_id, priority):
+        await self.client_ready_event().wait()
+        try:
+            await self.client_connection.publish(queue_name, message, reply_to=self.reply_to,
+                                                 correlation_id=correlation_id, priority=priority)
+        except Exception as e:
+            request = self.pending_requests.pop(correlation_id, None)
+            if request is not None and not request[0].done():
+                request[0].set_exception(e)
+
+    async def request(self, queue_name, message, priority=None, timeout=None):
+        """Send a message and wait for the reply, raising asyncio.TimeoutError if it does not arrive in time"""
+        return await self.send_direct_message(queue_name, message, priority=priority, timeout=timeout)
+
+    def schedule_expiry(self, correlation_id, timeout):
+        if not timeout:
+            return None
+        return asyncio.get_running_loop().call_later(timeout, self.expire_request, correlation_id)
+
+    def expire_request(self, correlation_id):
+        request = self.pending_requests.pop(correlation_id, None)
+        if request is not None and not request[0].done():
+            request[0].set_exception(asyncio.TimeoutError('No reply within {} s'.format(request[3])))
+
+    def forget_request(self, correlation_id):
+        # The request was replied to, expired, or its Future was cancelled
+        request = self.pending_requests.pop(correlation_id, None)
+        if request is not None and request[4] is not None:
+            request[4].cancel()
+
+    def cancel_pending_requests(self):
+        for future, callback, partial_callback, timeout, expiry in list(self.pending_requests.values()):
+            future.cancel()
+
+    def process_direct_reply(self, message, properties):
+        """Resolve the request that the reply belongs to"""
+        partial = bool((getattr(properties, 'headers', None) or {}).get('partial'))
+        if partial:
+            request = self.pending_requests.get(properties.correlation_id)
+        else:
+            request = self.pending_requests.pop(properties.correlation_id, None)
+        if request is None:
+            logger.warning('Received a reply with an unknown correlation id: {}'.format(properties.correlation_id))
+            return
+
+        future, callback, partial_callback, timeout, expiry = request
+        if expiry is not None:
+            expiry.cancel()
+        if partial:
+            # The stream is still alive, so its timeout starts again
+            self.pending_requests[properties.correlation_id] = (future, callback, partial_callback, timeout,
+                                                                self.schedule_expiry(properties.correlation_id,
+                                                                                     timeout))
+            if partial_callback is not None:
+                partial_callback(message)
+            return
+        if future.done():
+            return
+        if callback is not None:
+            callback(message)
+        future.set_result(message)
+
+
+class AioCommandRunner(CommandProcessor, AioRmqResp):
+    """Serves the commands of a CommandProcessor on command_queue from an event loop.
+
+    The commands run in the event loop, so they must not block: the commands of a controller should only read or
+    change its state, and whatever waits for a driver belongs in a coroutine state of its state machine. Commands
+    are not paced unless a command_delay is given.
+    """
+    def __init__(self, command_queue='', command_delay=0, **kwargs):
+        super().__init__(server_queue=command_queue, command_delay=command_delay, **kwargs)
+
+
+class AioControllerComponent(AioRmqReq, AioCommandRunner, Component):
+    """Asyncio version of ControllerComponent. The controller's command server, its requests to the drivers and its
+    state machine (StateMachine.run_async) run in one event loop:
+
+        await controller.run(controller.run_response_server(), controller.setup_client(),
+                             controller.state_machine.run_async())
+    """
+    def __init__(self, controller_queue, **kwargs):
+        super().__init__(command_queue=controller_queue, **kwargs)
@@ -1,20 +1,29 @@
 import re
+import threading
 import time
+from concurrent.futures import Future
 from enum import Enum
 
 from components import Driver, logger, RmqResp
+from .pacing import CommandPacer
+from .telemetry import TelemetryPublisher
 
 
-def find_subclasses(obj, type):
+# Matches the '{}' placeholders of an argument template
+ARGUMENT_PATTERN = re.compile(r"{(\s*)}")
+
+# Separators between a command and its parameters. '?' is part of the command, and is added back after splitting
+COMMAND_SEPARATORS = str.maketrans(',?', '  ')
+
+
+def find_subclasses(obj, command_type):
+    """Find the commands of type command_type defined on obj (a class or an instance), keyed by their cmd"""
+    cls = obj if isinstance(obj, type) else obj.__class__
     results = {}
-    for attrname in dir(obj.__class__):
-        o = getattr(obj, attrname)
-        try:
-            if issubclass(o, type):
-                o.calc_num_args()
-                results[o.cmd] = o
-        except TypeError:
-            pass
+    for attrname in dir(cls):
+        o = getattr(cls, attrname)
+        if isinstance(o, type) and issubclass(o, command_type) and o.cmd:
+            results[o.cmd] = o
     return results
 
 
@@ -33,36 +42,60 @@ class CommandType(Enum):
     SET = 1
 
 
+class CachePolicy(Enum):
+    NEVER = 0
+    TTL = 1
+    UNTIL_INVALIDATED = 2
+
+
 class Command(object):
+    """Base class of all commands.
+
+    The number of arguments and the command templates are worked out once, when the class is created, so building a
+    command string is a single format call.
+    """
     cmd = ""
     cmd_alias = None
     arguments = ""
     arguments_alias = ""
     num_args = 0
     type = None
+    # Time (s) the instrument needs after this command before it accepts the next one. None uses the runner's default
+    command_delay = None
+    template = ""
+    alias_template = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.compile()
+
+    @classmethod
+    def compile(cls):
+        cls.calc_num_args()
+        cls.template = cls.cmd + " " + cls.arguments
+        if cls.cmd_alias is not None:
+            cls.alias_template = cls.cmd_alias + " " + cls.arguments_alias
 
     @classmethod
     def calc_num_args(cls):
-        cls.num_args = len(re.findall("{(\s*)}", cls.arguments))
+        cls.num_args = len(ARGUMENT_PATTERN.findall(cls.arguments))
 
     @classmethod
     def command(cls, pars=None):
-        cls.calc_num_args()
         if pars is None:
             pars = []
         cls.validate(pars)
-        if cls.cmd_alias is None:
-            return (cls.cmd + " " + cls.arguments.format(*pars)).strip()
+        if cls.alias_template is None:
+            return cls.template.format(*pars).strip()
         else:
-            return (cls.cmd_alias + " " + cls.arguments_alias.format(*pars)).strip()
+            return cls.alias_template.format(*pars).strip()
 
     @classmethod
     def raw_command(cls, pars=None):
-        cls.calc_num_args()
         if pars is None:
             pars = []
         cls.validate(pars)
-        return (cls.cmd + " " + cls.arguments.format(*pars)).strip()
+        return cls.template.format(*pars).strip()
 
     @classmethod
     def validate(cls, pars):
@@ -78,7 +111,7 @@ class Command(object):
         if pars is None:
             pars = []
         cls.validate(pars)
-        return (cls.cmd_alias + " " + cls.arguments_alias.format(*pars)).strip()
+        return cls.alias_template.format(*pars).strip()
 
 
 class WriteCommand(Command):
@@ -95,6 +128,8 @@ class WriteCommand(Command):
 
 class QueryCommand(Command):
     type = CommandType.GET
+    # Whether identical queries that run at the same time can share one result
+    coalesce = True
 
     @classmethod
     def execute(cls, component, cmd, pars):
@@ -105,38 +140,99 @@ class QueryCommand(Command):
         return result
 
 
-class CommandRunner(RmqResp):
+class CommandProcessor(object):
+    """Runs the commands (nested QueryCommand and WriteCommand classes) that a component defines.
+
+    The table of commands is built once per class, when the class is created.
+
+    Identical queries (same command and parameters) that arrive while one of them is already running share its
+    result. With a coalesce_window, a query that completed less than coalesce_window seconds ago is also reused.
+
+    A server runs one message at a time, so only the driver's own threads (e.g. the poller) run queries at the same
+    time as a client's. Identical requests of several clients are shared only with a coalesce_window: the window is
+    off by default, and set in the config of the drivers that several components read.
+
+    With a chunk_size, messages with more commands than that are run chunk_size commands at a time, so that more
+    urgent messages can be processed between the chunks.
+
+    Commands are paced: the runner only waits before a command if the previous one finished less than its delay ago.
+    The delay after a command comes from command_delays (a dict of cmd: delay), then the command's own
+    command_delay, and otherwise is command_delay for set commands and 0 for queries.
+
+    The processor is not tied to a server: CommandRunner serves the commands with the threaded RmqResp, and
+    aio_rmq_component.AioCommandRunner with the asyncio AioRmqResp.
+    """
     query_class = QueryCommand
     write_class = WriteCommand
+    get_commands = {}
+    set_commands = {}
+    all_commands = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.compile_commands()
+
+    @classmethod
+    def compile_commands(cls):
+        cls.get_commands = find_subclasses(cls, cls.query_class)
+        cls.set_commands = find_subclasses(cls, cls.write_class)
+        cls.all_commands = {**cls.get_commands, **cls.set_commands}
 
-    def __init__(self, command_queue='', command_delay=0.05, **kwargs):
-        super().__init__(command_queue, **kwargs)
-        self.get_commands = find_subclasses(self, self.query_class)
-        self.set_commands = find_subclasses(self, self.write_class)
-        self.all_commands = {**self.get_commands, **self.set_commands}
+    def __init__(self, command_delay=0.05, coalesce_window=0, chunk_size=None, command_delays=None, **kwargs):
+        super().__init__(**kwargs)
         self.command_delay = command_delay
+        self.command_delays = command_delays if command_delays is not None else {}
+        self.pacer = CommandPacer()
+        self.coalesce_window = coalesce_window
+        self.chunk_size = chunk_size
+        # Futures of the queries that are running, and the latest result objects, keyed by (cmd, pars)
+        self.pending_queries = {}
+        self.recent_queries = {}
+        self.query_lock = threading.Lock()
 
     def split_cmd(self, cmd):
         """Split the command string into a command and a set of parameters"""
-        command, *pars = list(filter(None, map(lambda x: x.strip(), re.split(',| |\?', cmd))))
+        tokens = cmd.translate(COMMAND_SEPARATORS).split()
+        if not tokens:
+            return "", []
+        command = tokens[0]
         # Put the question mark back in since it was removed in the split process
         if "?" in cmd:
             command += "?"
-        return command, pars
+        return command, tokens[1:]
+
+    def split_message(self, message):
+        try:
+            commands = message['CMD'].split(';')
+        except (AttributeError, KeyError, TypeError):
+            return [message]
+        if not self.chunk_size or len(commands) <= self.chunk_size:
+            return [message]
+        return [dict(message, CMD=';'.join(commands[i:i + self.chunk_size]))
+                for i in range(0, len(commands), self.chunk_size)]
+
+    def merge_responses(self, responses):
+        return [result for response in responses for result in response]
 
     def process_message(self, message):
         commands = message['CMD']
         results = []
-        errors = []
         try:
-            for command in commands.split(';'):
-                result, error = self.execute_command(command)
-                errors.append(error if error is not None else "")
-                results.append(result if result is not None else "")
+            results = self.execute_commands(commands.split(';'))
         except AttributeError:
             logger.exception("Received message with improper format")
         return results
 
+    def execute_commands(self, commands):
+        """Run each of the commands in turn and return the list of result objects"""
+        results = []
+        errors = []
+        for command in commands:
+            result, error = self.execute_command(command)
+            errors.append(error if error is not None else "")
+            results.append(result if result is not None else "")
+        return results
+
     def execute_command(self, command):
         """Run the command and create a result object.
         The result object will be of the form
@@ -147,26 +243,104 @@ class CommandRunner(RmqResp):
             result: object containing the response from the instrument
         }
         """
+        cmd, pars = self.split_cmd(command)
+        return self.execute_parsed_command(cmd, pars)
+
+    def execute_parsed_command(self, cmd, pars):
+        """Run a command, or share the result of an identical query that is already running"""
+        command_class = self.all_commands.get(cmd)
+        if command_class is None or command_class.type != CommandType.GET or not command_class.coalesce:
+            command_result, error = self.run_parsed_command(cmd, pars)
+            if error is None:
+                self.record_result(cmd, pars, command_result)
+            return command_result, error
+
+        key = (cmd, tuple(pars))
+        with self.query_lock:
+            command_result = self.lookup_result(cmd, pars)
+            if command_result is not None:
+                return command_result, None
+            future = self.pending_queries.get(key)
+            if future is None:
+                future = self.pending_queries[key] = Future()
+                running = True
+            else:
+                running = False
+
+        if not running:
+            return future.result()
+        return self.run_shared_query(key, future)
+
+    def run_shared_query(self, key, future):
+        """Run a query that was registered in pending_queries with future, and hand its result to whoever shares it"""
+        cmd, pars = key[0], list(key[1])
+        try:
+            command_result, error = self.run_parsed_command(cmd, pars)
+            if error is None:
+                self.record_result(cmd, pars, command_result)
+            future.set_result((command_result, error))
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.query_lock:
+                self.pending_queries.pop(key, None)
+        return command_result, error
+
+    def lookup_result(self, cmd, pars):
+        """Get a result object for the query that can be reused instead of running it, or None"""
+        if self.coalesce_window > 0:
+            command_result = self.recent_queries.get((cmd, tuple(pars)))
+            if command_result is not None and time.time() - command_result['t1'] <= self.coalesce_window:
+                return command_result
+        return None
+
+    def record_result(self, cmd, pars, command_result):
+        """Called with the result object of every command that ran without errors"""
+        command_class = self.all_commands[cmd]
+        if self.coalesce_window > 0 and command_class.type == CommandType.GET and command_class.coalesce:
+            self.recent_queries[(cmd, tuple(pars))] = command_result
+
+    def run_parsed_command(self, cmd, pars):
         result = None
         t0 = t1 = -1
-        cmd, pars = self.split_cmd(command)
         error = self.check_command(cmd, pars)
 
         if error is None:
+            # Don't send the command before the instrument is ready for it
+            self.pacer.wait()
+
             # Get time before sending command to instrument
             t0 = time.time()
 
-            result = self.all_commands[cmd].execute(self, cmd, pars)
+            try:
+                result = self.all_commands[cmd].execute(self, cmd, pars)
+            except Exception as e:
+                # Report the failure to the client rather than stopping the server
+                logger.exception("Command '{}' failed with parameters {}".format(cmd, pars))
+                error = e
 
             # Get time after receiving reply from instrument
             # Having both times allows us to get an estimate of the time at which the command ran in case the instrument
             # does not report this
             t1 = time.time()
 
-            # Set commands take time to process so there must be a time delay
-            if cmd in self.set_commands:
-                time.sleep(self.command_delay)
+            # Set commands take time to process so the next command may have to wait
+            self.pacer.command_done(self.get_command_delay(cmd))
 
+        return self.make_command_result(t0, t1, result, error)
+
+    def get_command_delay(self, cmd):
+        """Get the time the instrument needs after cmd before it accepts another command"""
+        if cmd in self.command_delays:
+            return self.command_delays[cmd]
+        command_delay = self.all_commands[cmd].command_delay
+        if command_delay is not None:
+            return command_delay
+        return self.command_delay if cmd in self.set_commands else 0
+
+    @staticmethod
+    def make_command_result(t0, t1, result, error):
         command_result = {'t0': t0,
                           't1': t1,
                           'error': str(error) if error is not None else '',
@@ -184,7 +358,16 @@ class CommandRunner(RmqResp):
             return e
 
 
+class CommandRunner(CommandProcessor, RmqResp):
+    """Serves the commands of a CommandProcessor on command_queue, with a threaded RmqResp"""
+    def __init__(self, command_queue='', **kwargs):
+        super().__init__(server_queue=command_queue, **kwargs)
+
+
 class DriverWriteCommand(WriteCommand):
+    # Set to True for commands that can change any cached query, e.g. a reset
+    clears_cache = False
+
     @classmethod
     def execute(cls, driver, cmd, pars):
         if cls.cmd_alias is None:
@@ -194,6 +377,18 @@ class DriverWriteCommand(WriteCommand):
 
 
 class DriverQueryCommand(QueryCommand):
+    # Whether the query can be joined with other queries (separated by ';') and sent in a single write/read
+    pipelined = True
+    # Whether the results are published as telemetry readings. Off for bulk transfers, e.g. a data log download
+    publish_telemetry = True
+
+    # Results of queries whose value rarely changes can be cached by the driver. With CachePolicy.TTL a result is
+    # reused for cache_ttl seconds. With either policy the cached results are dropped as soon as one of the commands
+    # in invalidated_by runs.
+    cache_policy = CachePolicy.NEVER
+    cache_ttl = 0
+    invalidated_by = ()
+
     @classmethod
     def process_result(cls, driver, cmd, pars, result):
         return result
@@ -208,12 +403,260 @@ class DriverQueryCommand(QueryCommand):
         return cls.process_result(driver, cmd, pars, result)
 
 
-class DriverCommandRunner(CommandRunner, Driver):
+class DriverCommandRunner(CommandRunner, TelemetryPublisher, Driver):
+    """Runs commands on an instrument.
+
+    In pipelined mode, consecutive queries in a message are joined with ';' and sent to the instrument in a single
+    query. The instrument's ';' separated reply is split back up and handed to each command's process_result. Only
+    instruments that support this (e.g. the Lake Shore controllers) should use it. pipeline_max_length is the longest
+    joined command string that will be sent in one go.
+
+    Queries with a cache_policy are answered from the query cache, without talking to the instrument, until their
+    result expires or is invalidated. Set use_cache to False to always query the instrument.
+
+    poll_commands is a dict of query: rate (Hz), e.g. {'KRDG? 0': 5}. Once run_poller_thread is called, a poller
+    thread runs these queries at their rate and keeps the latest result of each one. Requests for a polled query are
+    answered with the latest result as long as it is no older than poll_max_age seconds (by default, two poll
+    periods), so the load on the instrument does not depend on the number of clients.
+
+    With a telemetry_source, every query result read from the instrument (by a request or by the poller) is published
+    as telemetry once run_telemetry_thread is called, see TelemetryPublisher.
+    """
     query_class = DriverQueryCommand
     write_class = DriverWriteCommand
+    # Maps each command to the cached queries that it invalidates
+    cache_invalidation = {}
 
-    def __init__(self, driver_queue, driver_params, command_delay=0.05, **kwargs):
+    @classmethod
+    def compile_commands(cls):
+        super().compile_commands()
+        cls.cache_invalidation = {}
+        for query_cmd, command_class in cls.get_commands.items():
+            for cmd in command_class.invalidated_by:
+                cls.cache_invalidation.setdefault(cmd, []).append(query_cmd)
+
+    def __init__(self, driver_queue, driver_params, command_delay=0.05, pipelined=False, pipeline_max_length=64,
+                 use_cache=True, poll_commands=None, poll_max_age=None, **kwargs):
         super().__init__(command_queue=driver_queue,
                          command_delay=command_delay,
                          driver_params=driver_params,
                          **kwargs)
+        self.pipelined = pipelined
+        self.pipeline_max_length = pipeline_max_length
+        self.use_cache = use_cache
+        # Cached result objects, stored as {cmd: {pars: result object}}
+        self.query_cache = {}
+        # Held while talking to the instrument, since the server and poller threads share it
+        self.resource_lock = threading.RLock()
+
+        # Poll periods of the polled queries and their latest result objects, keyed by (cmd, pars)
+        self.poll_periods = {}
+        self.latest_values = {}
+        self.poll_max_age = poll_max_age
+        for command, rate in (poll_commands or {}).items():
+            cmd, pars = self.split_cmd(command)
+            if cmd not in self.get_commands or self.get_commands[cmd].type != CommandType.GET:
+                raise ValueError("Only queries can be polled, instead got '{}'".format(command))
+            error = self.check_command(cmd, pars)
+            if error is not None:
+                raise error
+            self.poll_periods[(cmd, tuple(pars))] = 1 / rate
+
+    def run_poller_thread(self):
+        """Start polling the poll_commands. Does nothing if there are none"""
+        if not self.poll_periods:
+            return
+        thread = threading.Thread(target=self.run_poller)
+        thread.start()
+
+    def run_poller(self):
+        next_poll = {key: time.time() for key in self.poll_periods}
+        while not self.done:
+            key = min(next_poll, key=next_poll.get)
+            delay = next_poll[key] - time.time()
+            if delay > 0:
+                # Sleep in short steps so that a close request is noticed
+                time.sleep(min(delay, 0.1))
+                continue
+
+            cmd, pars = key
+            try:
+                self.poll(cmd, list(pars))
+            except Exception:
+                logger.exception("Polling '{}' with parameters {} failed".format(cmd, list(pars)))
+            # Keep to the poll rate, but don't try to make up for polls that were missed
+            next_poll[key] = max(next_poll[key] + self.poll_periods[key], time.time())
+        logger.info('Poller stopped')
+
+    def poll(self, cmd, pars):
+        """Run a polled query on the instrument. Unlike a request, this never reuses a stored result, but requests for
+        the same query that arrive while it runs share its result"""
+        key = (cmd, tuple(pars))
+        with self.query_lock:
+            if key in self.pending_queries:
+                # A request is reading it already, and its result is recorded as the latest value
+                return
+            future = self.pending_queries[key] = Future()
+        self.run_shared_query(key, future)
+
+    def get_latest_value(self, cmd, pars):
+        """Get the latest result object of a polled query, or None if it is not polled or its result is too old"""
+        key = (cmd, tuple(pars))
+        command_result = self.latest_values.get(key)
+        if command_result is None:
+            return None
+
+        max_age = self.poll_max_age if self.poll_max_age is not None else 2 * self.poll_periods[key]
+        if time.time() - command_result['t1'] > max_age:
+            return None
+        return command_result
+
+    def run_parsed_command(self, cmd, pars):
+        with self.resource_lock:
+            return super().run_parsed_command(cmd, pars)
+
+    def lookup_result(self, cmd, pars):
+        command_result = self.get_latest_value(cmd, pars)
+        if command_result is not None:
+            return command_result
+        command_result = self.get_cached_result(cmd, pars)
+        if command_result is not None:
+            return command_result
+        return super().lookup_result(cmd, pars)
+
+    def record_result(self, cmd, pars, command_result):
+        if (cmd, tuple(pars)) in self.poll_periods:
+            self.latest_values[(cmd, tuple(pars))] = command_result
+        command_class = self.all_commands[cmd]
+        if command_class.type == CommandType.GET and getattr(command_class, 'publish_telemetry', True):
+            self.publish_reading(cmd, pars, command_result)
+        self.update_cache(cmd, pars, command_result)
+        super().record_result(cmd, pars, command_result)
+
+    def get_cached_result(self, cmd, pars):
+        """Get the cached result object of a query, or None if there is no valid cached result"""
+        command_result = self.query_cache.get(cmd, {}).get(tuple(pars))
+        if command_result is None:
+            return None
+
+        command_class = self.all_commands[cmd]
+        age = time.time() - command_result['t1']
+        if command_class.cache_policy == CachePolicy.TTL and age > command_class.cache_ttl:
+            return None
+        return command_result
+
+    def update_cache(self, cmd, pars, command_result):
+        """Store the result of a query with a cache policy, and drop the cached results that cmd invalidates"""
+        if not self.use_cache:
+            return
+        command_class = self.all_commands[cmd]
+
+        if getattr(command_class, 'clears_cache', False):
+            self.query_cache.clear()
+        for query_cmd in self.cache_invalidation.get(cmd, ()):
+            self.query_cache.pop(query_cmd, None)
+
+        # Empty results mean that the instrument did not give a proper reply, so they are never cached
+        if getattr(command_class, 'cache_policy', CachePolicy.NEVER) != CachePolicy.NEVER and \
+                command_result['result'] != '':
+            self.query_cache.setdefault(cmd, {})[tuple(pars)] = command_result
+
+    def execute_commands(self, commands):
+        if not self.pipelined:
+            return super().execute_commands(commands)
+
+        results = []
+        batch = []
+        batch_length = 0
+        for command in commands:
+            cmd, pars = self.split_cmd(command)
+            error = self.check_command(cmd, pars)
+            if error is not None:
+                results.extend(self.execute_pipeline(batch))
+                batch, batch_length = [], 0
+                results.append(self.make_command_result(-1, -1, None, error)[0])
+                continue
+
+            command_result = self.lookup_result(cmd, pars)
+            if command_result is not None:
+                results.extend(self.execute_pipeline(batch))
+                batch, batch_length = [], 0
+                results.append(command_result)
+                continue
+
+            command_class = self.all_commands[cmd]
+            if not (issubclass(command_class, DriverQueryCommand) and command_class.pipelined):
+                results.extend(self.execute_pipeline(batch))
+                batch, batch_length = [], 0
+                results.append(self.execute_parsed_command(cmd, pars)[0])
+                continue
+
+            instrument_command = command_class.command(pars)
+            # Account for the ';' separator
+            if batch and batch_length + len(instrument_command) + 1 > self.pipeline_max_length:
+                results.extend(self.execute_pipeline(batch))
+                batch, batch_length = [], 0
+            batch.append((command_class, cmd, pars, instrument_command))
+            batch_length += len(instrument_command) + 1
+        results.extend(self.execute_pipeline(batch))
+        return results
+
+    def batch_queries(self, queries):
+        """Group instrument queries that can be joined with ';' and sent in one go. Without pipelining, every query
+        is sent on its own"""
+        if not self.pipelined:
+            return [[query] for query in queries]
+        batches = []
+        batch_length = 0
+        for query in queries:
+            # Account for the ';' separator
+            if not batches or batch_length + len(query) + 1 > self.pipeline_max_length:
+                batches.append([])
+                batch_length = 0
+            batches[-1].append(query)
+            batch_length += len(query) + 1
+        return batches
+
+    def execute_pipeline(self, batch):
+        """Send a batch of queries to the instrument in a single query and return their result objects"""
+        if not batch:
+            return []
+        if len(batch) == 1:
+            command_class, cmd, pars, instrument_command = batch[0]
+            return [self.execute_parsed_command(cmd, pars)[0]]
+
+        joined_command = ';'.join(instrument_command for _, _, _, instrument_command in batch)
+        with self.resource_lock:
+            self.pacer.wait()
+            t0 = time.time()
+            try:
+                replies = self.resource.query(joined_command)
+            except Exception as e:
+                # Report the failure to the client of every command in the batch rather than stopping the server.
+                # Running the queries one at a time would only wait for the same instrument to fail again
+                logger.exception("Pipelined query '{}' failed".format(joined_command))
+                t1 = time.time()
+                return [self.make_command_result(t0, t1, None, e)[0] for _ in batch]
+            finally:
+                self.pacer.command_done(max(self.get_command_delay(cmd) for _, cmd, _, _ in batch))
+            t1 = time.time()
+
+        replies = replies.split(';')
+        if len(replies) != len(batch):
+            logger.warning("Got {} replies to {} pipelined queries, running them one at a time".format(
+                len(replies), len(batch)))
+            return [self.execute_parsed_command(cmd, pars)[0] for _, cmd, pars, _ in batch]
+
+        results = []
+        for (command_class, cmd, pars, instrument_command), reply in zip(batch, replies):
+            try:
+                result = command_class.process_result(self, cmd, pars, reply.strip())
+            except Exception as e:
+                # Only this command failed, the replies of the others are still good
+                logger.exception("Command '{}' failed with parameters {}".format(cmd, pars))
+                results.append(self.make_command_result(t0, t1, None, e)[0])
+                continue
+            command_result = self.make_command_result(t0, t1, result, None)[0]
+            self.record_result(cmd, pars, command_result)
+            results.append(command_result)
+        return results
@@ -15,8 +15,12 @@ class Driver(object):
         super().__init__(**kwargs)
 
     def create_resource(self, driver_params):
-        rm = visa.ResourceManager(driver_params.get('library', ''))
-        self.resource = rm.open_resource(driver_params['address'])
+        # An already opened resource (e.g. a simulated instrument) can be passed instead of an address
+        if 'resource' in driver_params:
+            self.resource = driver_params['resource']
+        else:
+            rm = visa.ResourceManager(driver_params.get('library', ''))
+            self.resource = rm.open_resource(driver_params['address'])
 
         if 'baud_rate' in driver_params:
             self.resource.baud_rate = driver_params['baud_rate']
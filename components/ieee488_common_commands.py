@@ -1,4 +1,4 @@
-from components import WriteCommand, QueryCommand, validate_range, DriverWriteCommand, DriverQueryCommand
+from components import WriteCommand, QueryCommand, validate_range, DriverWriteCommand, DriverQueryCommand, CachePolicy
 
 
 class IEEE488_CommonCommands(object):
@@ -33,6 +33,7 @@ class IEEE488_CommonCommands(object):
 
     class GetIdentification(DriverQueryCommand):
         cmd = "*IDN?"
+        cache_policy = CachePolicy.UNTIL_INVALIDATED
 
     class SetOperationComplete(DriverWriteCommand):
         cmd = "*OPC"
@@ -46,6 +47,7 @@ class IEEE488_CommonCommands(object):
 
     class ResetInstrument(DriverWriteCommand):
         cmd = "*RST"
+        clears_cache = True
 
     class SetServiceRequestEnable(DriverWriteCommand):
         cmd = "*SRE"
@@ -0,0 +1,212 @@
+import numpy as np
+
+from components import validate_range, DriverWriteCommand, DriverQueryCommand, CachePolicy, logger
+
+
+def validate_curve_number(curve, curves):
+    if int(curve) not in curves:
+        raise ValueError("Curve must be one of {}, instead got {}".format(curves, curve))
+
+
+def validate_curve_point(index):
+    validate_range(int(index), 1, 200)
+
+
+class LakeShoreCurveCommands(object):
+    """Sensor curve commands of the Lake Shore instruments. To use this class, include it in the Driver's definition:
+    class SomeDriver(LakeShoreCurveCommands, DriverCommandRunner):
+
+    READCURVE? and WRITECURVE transfer a whole curve in one request, running the point by point loop in the driver.
+    The driver keeps a copy of every curve it reads or writes, and WRITECURVE only rewrites the points that differ
+    from it. Points past the end of a shorter new curve are cleared.
+
+    The curve numbers of the commands are checked against the curves of the driver's instrument.
+    """
+    # Number of breakpoints in a curve, the curves of the instrument and the ones that can be written
+    curve_points = 200
+    curves = range(1, 60)
+    user_curves = range(21, 60)
+    # Relative difference under which a point is considered unchanged, the instrument rounds the values it stores
+    curve_tolerance = 1e-5
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Points of the curves on the instrument, as {curve: (units, temperatures)}
+        self.curve_cache = {}
+
+    def check_command(self, cmd, pars):
+        error = super().check_command(cmd, pars)
+        if error is None and cmd in self.curve_commands():
+            try:
+                validate_curve_number(pars[0], self.curves)
+            except ValueError as e:
+                logger.exception("Command '{}' failed validation with parameters {}".format(cmd, pars))
+                return e
+        return error
+
+    @classmethod
+    def curve_commands(cls):
+        """The commands whose first parameter is a curve number"""
+        return (cls.GetCurveHeader.cmd, cls.SetCurveHeader.cmd, cls.GetCurveDataPoint.cmd, cls.SetCurveDataPoint.cmd,
+                cls.DeleteCurve.cmd, cls.ReadCurve.cmd, cls.WriteCurve.cmd)
+
+    def record_result(self, cmd, pars, command_result):
+        # Curves that are changed point by point no longer match their copy
+        if cmd in (self.SetCurveDataPoint.cmd, self.DeleteCurve.cmd):
+            self.curve_cache.pop(int(pars[0]), None)
+        super().record_result(cmd, pars, command_result)
+
+    def read_curve(self, curve):
+        """Read the breakpoints of a curve, up to the first empty point. Returns (units, temperatures) arrays"""
+        queries = [self.GetCurveDataPoint.command([curve, index]) for index in range(1, self.curve_points + 1)]
+        points = []
+        with self.resource_lock:
+            for batch in self.batch_queries(queries):
+                self.pacer.wait()
+                replies = self.resource.query(';'.join(batch)).split(';')
+                points.extend(tuple(float(value) for value in reply.split(',')) for reply in replies)
+                if (0, 0) in points:
+                    break
+
+        if (0, 0) in points:
+            points = points[:points.index((0, 0))]
+        points = np.array(points, dtype=np.float64).reshape((-1, 2))
+        units, temperatures = points[:, 0], points[:, 1]
+        self.curve_cache[curve] = (units, temperatures)
+        return units, temperatures
+
+    def write_curve(self, curve, units, temperatures):
+        """Write the breakpoints of a user curve. Returns the number of points that were written"""
+        if curve not in self.user_curves:
+            raise ValueError("Curve must be a user curve {}, instead got {}".format(self.user_curves, curve))
+        units = np.asarray(units, dtype=np.float64)
+        temperatures = np.asarray(temperatures, dtype=np.float64)
+        if units.shape != temperatures.shape or units.ndim != 1 or len(units) > self.curve_points:
+            raise ValueError("Curve must be at most {} pairs of units and temperature".format(self.curve_points))
+
+        if curve not in self.curve_cache:
+            self.read_curve(curve)
+        old_units, old_temperatures = self.curve_cache.pop(curve)
+
+        # Compare the curves over the longer of the two, so that the leftover points of the old curve are cleared
+        length = max(len(units), len(old_units))
+        new_points = np.zeros((length, 2))
+        new_points[:len(units)] = np.column_stack((units, temperatures))
+        old_points = np.zeros((length, 2))
+        old_points[:len(old_units)] = np.column_stack((old_units, old_temperatures))
+        changed = np.flatnonzero(~np.isclose(new_points, old_points, rtol=self.curve_tolerance, atol=0).all(axis=1))
+
+        for index in changed:
+            pars = [curve, index + 1, '{:.6g}'.format(new_points[index, 0]), '{:.6g}'.format(new_points[index, 1])]
+            command_result, error = self.run_parsed_command(self.SetCurveDataPoint.cmd, pars)
+            if error is not None:
+                raise error
+
+        self.curve_cache[curve] = (units, temperatures)
+        return len(changed)
+
+    class GetCurveHeader(DriverQueryCommand):
+        cmd = "CRVHDR?"
+        arguments = "{}"
+        cache_policy = CachePolicy.UNTIL_INVALIDATED
+        invalidated_by = ("CRVHDR", "CRVDEL")
+
+        @classmethod
+        def _validate(cls, pars):
+            int(pars[0])
+
+        @classmethod
+        def process_result(cls, driver, cmd, pars, result):
+            resp = list(map(lambda x: x.strip(), result.split(',')))
+            return {"name": resp[0],
+                    "serial": resp[1],
+                    "format": int(resp[2]),
+                    "limit": float(resp[3]),
+                    "coefficient": int(resp[4])}
+
+    class SetCurveHeader(DriverWriteCommand):
+        cmd = "CRVHDR"
+        arguments = "{},{},{},{},{},{}"
+
+        @classmethod
+        def _validate(cls, pars):
+            int(pars[0])
+
+    class GetCurveDataPoint(DriverQueryCommand):
+        cmd = "CRVPT?"
+        arguments = "{},{}"
+
+        @classmethod
+        def _validate(cls, pars):
+            int(pars[0])
+            validate_curve_point(pars[1])
+
+        @classmethod
+        def process_result(cls, driver, cmd, pars, result):
+            resp = list(map(lambda x: x.strip(), result.split(',')))
+            return {"units": float(resp[0]),
+                    "temp": float(resp[1])}
+
+    class SetCurveDataPoint(DriverWriteCommand):
+        cmd = "CRVPT"
+        arguments = "{},{},{},{}"
+
+        @classmethod
+        def _validate(cls, pars):
+            int(pars[0])
+            validate_curve_point(pars[1])
+
+    class DeleteCurve(DriverWriteCommand):
+        cmd = "CRVDEL"
+        arguments = "{}"
+
+        @classmethod
+        def _validate(cls, pars):
+            int(pars[0])
+
+    class ReadCurve(DriverQueryCommand):
+        """Reads all the breakpoints of a curve"""
+        cmd = "READCURVE?"
+        arguments = "{}"
+        pipelined = False
+        publish_telemetry = False
+
+        @classmethod
+        def _validate(cls, pars):
+            int(pars[0])
+
+        @classmethod
+        def execute(cls, driver, cmd, pars):
+            units, temperatures = driver.read_curve(int(pars[0]))
+            return {"units": units.tolist(),
+                    "temp": temperatures.tolist()}
+
+    class WriteCurve(DriverWriteCommand):
+        """Writes a whole user curve, given as the curve number followed by the units and temperature of each point:
+        WRITECURVE 21,units_1,temp_1,units_2,temp_2,..."""
+        cmd = "WRITECURVE"
+
+        @classmethod
+        def validate(cls, pars):
+            if len(pars) < 3 or len(pars) % 2 == 0:
+                raise ValueError("Expected a curve followed by pairs of units and temperature, instead got {} "
+                                 "parameters".format(len(pars)))
+            int(pars[0])
+            for par in pars[1:]:
+                float(par)
+
+        @classmethod
+        def command(cls, pars=None):
+            if pars is None:
+                pars = []
+            cls.validate(pars)
+            return "{} {}".format(cls.cmd, ",".join(str(par) for par in pars))
+
+        @classmethod
+        def raw_command(cls, pars=None):
+            return cls.command(pars)
+
+        @classmethod
+        def execute(cls, driver, cmd, pars):
+            points = np.array(pars[1:], dtype=np.float64).reshape((-1, 2))
+            return driver.write_curve(int(pars[0]), points[:, 0], points[:, 1])
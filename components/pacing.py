@@ -0,0 +1,27 @@
+import threading
+import time
+
+
+class CommandPacer(object):
+    """Keeps instruments from receiving commands faster than they can handle them.
+
+    Rather than sleeping after every command, the pacer records when each command finished and how long the
+    instrument needs before the next command (the gap). wait() only sleeps for whatever is left of the gap, so the
+    time spent between commands (e.g. handling messages) counts towards it, and a command that arrives after the gap
+    has passed runs straight away.
+    """
+    def __init__(self):
+        self.ready_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Wait until the instrument is ready for the next command"""
+        with self.lock:
+            delay = self.ready_time - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def command_done(self, gap):
+        """Record that a command just finished, and that the instrument needs gap seconds before the next one"""
+        with self.lock:
+            self.ready_time = max(self.ready_time, time.time() + gap)
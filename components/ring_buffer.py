@@ -0,0 +1,80 @@
+import numpy as np
+
+
+class RingBuffer(object):
+    """Fixed capacity history of (t0, t1, value) samples, where t0 and t1 are the times before and after the reading.
+
+    Every sample is stored twice, capacity samples apart, in an array twice the capacity. The latest n samples are
+    then always a contiguous slice of the array, so window returns a view instead of a copy, and append is O(1).
+    Windows are views, so they change with later appends. Copy a window if it has to be kept.
+    """
+    dtype = np.dtype([('t0', np.float64), ('t1', np.float64), ('value', np.float64)])
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("Capacity must be at least 1, instead got {}".format(capacity))
+        self.capacity = capacity
+        self.data = np.zeros(2 * capacity, dtype=self.dtype)
+        # Position the next sample is written to, and the number of samples in the buffer
+        self.index = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, t0, t1, value):
+        sample = (t0, t1, value)
+        self.data[self.index] = sample
+        self.data[self.index + self.capacity] = sample
+        self.index = (self.index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def clear(self):
+        self.index = 0
+        self.count = 0
+
+    def window(self, n=None):
+        """Get the latest n samples (all of them by default), oldest first"""
+        if n is None or n > self.count:
+            n = self.count
+        end = self.index + self.capacity
+        return self.data[end - n:end]
+
+    def window_since(self, t):
+        """Get the samples read at or after time t (by their t1), oldest first"""
+        samples = self.window()
+        return samples[np.searchsorted(samples['t1'], t, side='left'):]
+
+    def latest(self):
+        """Get the latest sample, or None if the buffer is empty"""
+        if not self.count:
+            return None
+        return self.data[self.index + self.capacity - 1]
+
+    def rate_of_change(self, duration, now=None):
+        """Get the rate of change (per second) of the samples of the last duration seconds, from a least squares fit.
+        Returns None if there are fewer than two samples"""
+        samples = self.window_since(self.reference_time(now) - duration)
+        if len(samples) < 2:
+            return None
+        # The reading happened somewhere between t0 and t1
+        t = (samples['t0'] + samples['t1']) / 2
+        t = t - t.mean()
+        denominator = np.dot(t, t)
+        if denominator == 0:
+            return None
+        return float(np.dot(t, samples['value'] - samples['value'].mean()) / denominator)
+
+    def rolling_mean(self, duration, now=None):
+        """Get the mean of the samples of the last duration seconds, or None if there are none"""
+        samples = self.window_since(self.reference_time(now) - duration)
+        if not len(samples):
+            return None
+        return float(samples['value'].mean())
+
+    def reference_time(self, now):
+        # Windows end at the latest sample unless a time is given
+        if now is not None:
+            return now
+        latest = self.latest()
+        return latest['t1'] if latest is not None else 0
@@ -1,22 +1,28 @@
-import pika
-import time
-import json
+import heapq
 import threading
+import time
 import logging
-from queue import Queue, PriorityQueue
+import uuid
+from concurrent.futures import Future, TimeoutError
+from queue import Queue, PriorityQueue, Empty
+
+from .transport import RmqTransport
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-logger.info('Current pika version is {}'.format(pika.__version__))
 
 
 class RmqComponent(object):
     """Base class for RabbitMQ components.
     Each component runs its own RabbitMQ connection in its own thread (RabbitMQ is NOT thread safe).
+
+    The connections are opened by the component's transport. By default this is an RmqTransport connected to the
+    broker on localhost, but any Transport can be passed in, e.g. a LocalTransport to run without a broker.
     """
-    def __init__(self, **kwargs):
+    def __init__(self, transport=None, **kwargs):
         super().__init__(**kwargs)
+        self.transport = transport if transport is not None else RmqTransport()
         self.done = False   # Flag to tell if the thread should be shut down
 
     def close(self):
@@ -25,125 +31,338 @@ class RmqComponent(object):
         self.done = True
 
 
+class ScheduledMessage(object):
+    """A message waiting to be processed by a response server.
+
+    The message is split into chunks that are processed one at a time, and the responses of the chunks are merged
+    into a single response once they are all done. Streamed messages instead get the response of each chunk as soon
+    as it is ready.
+    """
+    def __init__(self, properties, chunks, stream=False):
+        self.properties = properties
+        self.chunks = chunks
+        self.stream = stream
+        self.responses = []
+
+
 class RmqResp(RmqComponent):
-    """The RmqResp class represents a response server, which sends responses to the client"""
-    def __init__(self, server_queue, **kwargs):
+    """The RmqResp class represents a response server, which sends responses to the client
+
+    By default the server is in consumer mode: it registers a consumer with basic_consume and blocks until the broker
+    pushes a message, so an idle server does not use any CPU. prefetch_count limits the number of unacknowledged
+    messages the broker will push to the server, and consumer_timeout is the longest the server will block before
+    checking whether it has been asked to close. Without consumer_mode the server polls its queue with basic_get.
+
+    Messages can have a priority (0 to max_priority, higher is more urgent), given by the priority message property
+    or by a 'PRIORITY' entry in the message. The broker hands over urgent messages first, and the server keeps up to
+    prefetch_count received messages in a priority queue so that it always processes the most urgent one next.
+    Messages that split_message breaks into several chunks go back in the queue after each chunk, so urgent messages
+    can run between the chunks of a long one. A chunk whose response is_final_response ends the message early.
+
+    A message with a true 'STREAM' entry is answered chunk by chunk: the response of every chunk but the last is sent
+    as a partial reply (with a 'partial' header) as soon as it is ready, and the last one is the final reply.
+    """
+    def __init__(self, server_queue, consumer_mode=True, prefetch_count=10, consumer_timeout=1, max_priority=10,
+                 **kwargs):
         super().__init__(**kwargs)
         self.response_server_queue = server_queue
-        self.response_thread_queue = Queue()
+        # Messages waiting to be processed, ordered by (-priority, arrival order)
+        self.response_thread_queue = PriorityQueue()
+        self.consumer_mode = consumer_mode
+        self.prefetch_count = prefetch_count
+        self.consumer_timeout = consumer_timeout
+        self.max_priority = max_priority
+        self.message_count = 0
 
     def run_server_thread(self):
         thread = threading.Thread(target=self.setup_and_run_server)
         thread.start()
 
     def init_server_queues(self):
-        self.server_channel.queue_delete(queue=self.response_server_queue)
-        self.server_channel.queue_declare(queue=self.response_server_queue)
+        self.server_connection.declare_queue(self.response_server_queue, max_priority=self.max_priority)
         logger.info('Declared queue: {}'.format(self.response_server_queue))
 
     def setup_and_run_server(self):
-        self.server_connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
+        self.server_connection = self.transport.connect()
         logger.info('Server Connection opened')
-        logger.info('Creating a new server channel')
-        self.server_channel = self.server_connection.channel()
 
         # Initialise queues here - this is a user-supplied function
         self.init_server_queues()
 
+        if self.consumer_mode:
+            self.server_connection.set_prefetch(self.prefetch_count)
+
         self.run_response_server()
 
     def run_response_server(self):
         try:
             while not self.done:
-                # Wait for next message from client
-                message, properties = self.receive_message()
-                # Custom user processing code is provided by the 'process_response' method
-                response = self.process_message(message)
-                self.send_response(response, properties)
+                if self.response_thread_queue.empty():
+                    # Wait for next message from client
+                    message, properties = self.receive_message()
+                    if properties is None:
+                        # The server was asked to close while waiting for a message
+                        break
+                    self.schedule_message(message, properties)
+                # Pick up the messages that have already arrived so that the most urgent one is processed first
+                self.receive_waiting_messages()
+                self.process_next_chunk()
         finally:
-            self.server_channel.close()
-            logger.info('Server Channel closed')
             self.server_connection.close()
             logger.info('Server Connection closed')
 
+    def schedule_message(self, message, properties):
+        priority = self.get_priority(message, properties)
+        self.message_count += 1
+        stream = isinstance(message, dict) and bool(message.get('STREAM'))
+        self.response_thread_queue.put((-priority, self.message_count,
+                                        ScheduledMessage(properties, self.split_message(message), stream)))
+
+    def receive_waiting_messages(self):
+        while self.response_thread_queue.qsize() < self.prefetch_count:
+            if self.consumer_mode:
+                message, properties = self.server_connection.consume(self.response_server_queue, 0)
+            else:
+                message, properties = self.server_connection.get(self.response_server_queue)
+            if properties is None:
+                break
+            logger.info('Received a message: {} | {}'.format(message, properties.reply_to))
+            self.schedule_message(message, properties)
+
+    def process_next_chunk(self):
+        priority, count, scheduled_message = self.response_thread_queue.get_nowait()
+        # Custom user processing code is provided by the 'process_response' method
+        chunk = scheduled_message.chunks.pop(0)
+        response = self.process_message(chunk)
+        if scheduled_message.chunks and self.is_final_response(chunk, response):
+            scheduled_message.chunks = []
+
+        if scheduled_message.stream:
+            self.send_response(response, scheduled_message.properties, partial=bool(scheduled_message.chunks))
+        else:
+            scheduled_message.responses.append(response)
+
+        if scheduled_message.chunks:
+            # Let more urgent messages run before the next chunk
+            self.response_thread_queue.put((priority, count, scheduled_message))
+        else:
+            if not scheduled_message.stream:
+                self.send_response(self.merge_responses(scheduled_message.responses), scheduled_message.properties)
+            self.server_connection.acknowledge(scheduled_message.properties)
+
+    def get_priority(self, message, properties):
+        priority = getattr(properties, 'priority', None)
+        if priority is None and isinstance(message, dict):
+            priority = message.get('PRIORITY')
+        try:
+            return min(max(int(priority), 0), self.max_priority)
+        except (TypeError, ValueError):
+            return 0
+
+    def split_message(self, message):
+        """Split a message into chunks that are processed separately. By default messages are not split"""
+        return [message]
+
+    def merge_responses(self, responses):
+        """Merge the responses of the chunks of a message into the response that is sent back"""
+        return responses[0]
+
+    def is_final_response(self, chunk, response):
+        """Whether the response to a chunk ends its message, so that the remaining chunks are dropped. By default
+        every chunk runs"""
+        return False
+
     def process_message(self, message):
         return None
 
     def receive_message(self):
         """
-        Gets a json message. This method can be overridden if a different message type is
-        required.
+        Gets a message. In consumer mode this blocks until a message arrives, otherwise the queue is polled.
         """
         message = None
         properties = None
         while not self.done:
-            # Process message queue events, returning as soon as possible
-            self.server_connection.process_data_events(time_limit=0)
-
-            method, properties, body = self.server_channel.basic_get(queue=self.response_server_queue,
-                                                              no_ack=True)
+            if self.consumer_mode:
+                # The wait is interrupted every consumer_timeout seconds so that a close request is noticed
+                message, properties = self.server_connection.consume(self.response_server_queue,
+                                                                     self.consumer_timeout)
+            else:
+                message, properties = self.server_connection.get(self.response_server_queue)
             # Return as soon as we get a valid message
-            if method is not None:
-                print(method, properties, body)
-                message = json.loads(body.decode('utf-8'))
-                logger.info('Received a message: {} | {}'.format(body, properties.reply_to))
+            if properties is not None:
+                logger.info('Received a message: {} | {}'.format(message, properties.reply_to))
                 break
 
         return message, properties
 
-    def send_response(self, response, properties):
-        logger.info('Sending response: {}'.format(json.dumps(response)))
-        self.server_channel.basic_publish('', routing_key=properties.reply_to, body=json.dumps(response))
+    def send_response(self, response, properties, partial=False):
+        logger.info('Sending response: {}'.format(response))
+        # Reply in the encoding the client used for the request
+        self.server_connection.publish(properties.reply_to, response,
+                                       correlation_id=properties.correlation_id,
+                                       content_type=properties.content_type,
+                                       headers={'partial': True} if partial else None)
 
 
 class RmqReq(RmqComponent):
     """The RmqReq class represents a request client, which sends messages to a server
     and waits for a response.
 
-    Messages are sent via send_direct_message, and are received via process_direct_reply
+    Messages are sent via send_direct_message, and are received via process_direct_reply.
+    Each message is tagged with a correlation id, so many requests can be in flight at the same time, even to different
+    server queues. send_direct_message returns a Future that is resolved with the matching reply. An optional callback
+    is also called with the reply (from the client thread).
+
+    Streamed requests (see RmqResp) also get partial replies before the final one. These are handed to the
+    partial_callback of the request, and the Future is resolved with the final reply.
+
+    A request that gets no reply for request_timeout seconds (by default, or the timeout given to
+    send_direct_message) expires: it is forgotten and its Future raises a TimeoutError, so requests to a server that
+    stopped answering don't pile up. Every partial reply of a streamed request restarts its timeout.
     """
-    def __init__(self, **kwargs):
+    def __init__(self, reply_poll_interval=0.01, client_timeout=1, request_timeout=30, **kwargs):
         super().__init__(**kwargs)
-        self.server_response = None
         self.request_thread_queue = Queue()
+        # Requests that have been sent but not yet replied to, keyed by correlation id, as
+        # (future, callback, partial_callback, timeout, expiry time)
+        self.pending_requests = {}
+        # Heap of the (expiry time, correlation id) of the pending requests. Requests that were replied to, or whose
+        # expiry time was pushed back, are left in and skipped
+        self.request_expiries = []
+        self.pending_requests_lock = threading.Lock()
+        self.request_timeout = request_timeout
+        self.reply_poll_interval = reply_poll_interval
+        self.client_timeout = client_timeout
 
     def run_client_thread(self):
         thread = threading.Thread(target=self.setup_client)
         thread.start()
 
     def setup_client(self):
-        self.client_connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
+        self.client_connection = self.transport.connect()
         logger.info('Client Connection opened')
-        logger.info('Creating a new client channel')
-        self.client_channel = self.client_connection.channel()
 
         # Initialise queues here - this is a user-supplied function
         self.init_client_queues()
 
-        while True:
-            queue_name, message = self.request_thread_queue.get()
+        try:
+            while not self.done:
+                if self.pending_requests:
+                    # Wait for replies. This returns early as soon as a reply has been dispatched
+                    self.client_connection.process_events(self.reply_poll_interval)
+                    self.publish_requests(block=False)
+                    self.expire_requests(time.time())
+                else:
+                    # Nothing is in flight, so sleep until the next request is made
+                    self.publish_requests(block=True)
+                    self.client_connection.process_events(0)
+        finally:
+            self.cancel_pending_requests()
+            self.client_connection.close()
+            logger.info('Client Connection closed')
+
+    def publish_requests(self, block):
+        """Publish all the requests that are waiting in the request thread queue"""
+        try:
+            request = self.request_thread_queue.get(block=block, timeout=self.client_timeout)
+            while True:
+                self.publish_request(*request)
+                request = self.request_thread_queue.get_nowait()
+        except Empty:
+            pass
 
-            """Wrapper for the basic_publish method specifically for sending a direct reply-to message"""
-            self.client_channel.basic_publish(exchange='',
-                                              routing_key=queue_name,
-                                              body=message,
-                                              properties=pika.BasicProperties(
-                                                  reply_to='amq.rabbitmq.reply-to'
-                                              ))
+    def publish_request(self, queue_name, message, correlation_id, priority):
+        """Publish a message that is replied to on this client's reply queue"""
+        self.client_connection.publish(queue_name, message, reply_to=self.reply_to, correlation_id=correlation_id,
+                                       priority=priority)
 
-            # Process events until we get a reply back from the server
-            self.processed = False
-            while not self.processed:
-                self.client_connection.process_data_events(time_limit=0)
+    def send_direct_message(self, queue_name, message, callback=None, priority=None, partial_callback=None,
+                            timeout=None):
+        """Queue a message to be sent to queue_name and return a Future for the reply
+
+        This method is thread safe and does not block. Call result() on the returned Future to wait for the reply.
+        Servers process messages with a higher priority first. The request expires after timeout seconds without a
+        reply (request_timeout by default, 0 never expires).
+        """
+        if timeout is None:
+            timeout = self.request_timeout
+        correlation_id = uuid.uuid4().hex
+        future = Future()
+        # Lets cancel_request find the request
+        future.correlation_id = correlation_id
+        with self.pending_requests_lock:
+            expiry = self.push_expiry(correlation_id, timeout)
+            self.pending_requests[correlation_id] = (future, callback, partial_callback, timeout, expiry)
+        self.request_thread_queue.put((queue_name, message, correlation_id, priority))
+        return future
 
-    def send_direct_message(self, queue_name, message):
-        self.request_thread_queue.put((queue_name, message))
+    def push_expiry(self, correlation_id, timeout):
+        """Schedule the expiry of a request timeout seconds from now. Returns the expiry time"""
+        if not timeout:
+            return None
+        expiry = time.time() + timeout
+        heapq.heappush(self.request_expiries, (expiry, correlation_id))
+        return expiry
+
+    def expire_requests(self, now):
+        """Forget the requests that have had no reply since their expiry time, and fail their Futures"""
+        expired = []
+        with self.pending_requests_lock:
+            while self.request_expiries and self.request_expiries[0][0] <= now:
+                expiry, correlation_id = heapq.heappop(self.request_expiries)
+                request = self.pending_requests.get(correlation_id)
+                if request is not None and request[4] == expiry:
+                    del self.pending_requests[correlation_id]
+                    expired.append(request)
+        for future, callback, partial_callback, timeout, expiry in expired:
+            future.set_exception(TimeoutError("No reply within {} s".format(timeout)))
+
+    def cancel_request(self, future):
+        """Forget a request that is no longer waited for, e.g. after the wait for its reply timed out. A late reply is
+        dropped"""
+        with self.pending_requests_lock:
+            request = self.pending_requests.pop(getattr(future, 'correlation_id', None), None)
+        # Otherwise the reply has arrived, and the Future is being resolved
+        if request is not None:
+            future.cancel()
+
+    def cancel_pending_requests(self):
+        with self.pending_requests_lock:
+            pending_requests = list(self.pending_requests.values())
+            self.pending_requests.clear()
+            self.request_expiries.clear()
+        for future, callback, partial_callback, timeout, expiry in pending_requests:
+            future.cancel()
 
     def init_client_queues(self):
         """Create the direct-reply consumer"""
-        self.client_channel.basic_consume(self.process_direct_reply, queue='amq.rabbitmq.reply-to', no_ack=True)
+        self.reply_to = self.client_connection.consume_replies(self.process_direct_reply)
+
+    def process_direct_reply(self, message, properties):
+        """Resolve the request that the direct reply belongs to"""
+        partial = bool((getattr(properties, 'headers', None) or {}).get('partial'))
+        with self.pending_requests_lock:
+            if partial:
+                request = self.pending_requests.get(properties.correlation_id)
+                if request is not None:
+                    # The stream is still alive, so its timeout starts again
+                    future, callback, partial_callback, timeout, expiry = request
+                    expiry = self.push_expiry(properties.correlation_id, timeout)
+                    self.pending_requests[properties.correlation_id] = (future, callback, partial_callback, timeout,
+                                                                        expiry)
+            else:
+                request = self.pending_requests.pop(properties.correlation_id, None)
+                if not self.pending_requests:
+                    self.request_expiries.clear()
+        if request is None:
+            logger.warning('Received a reply with an unknown correlation id: {}'.format(properties.correlation_id))
+            return
 
-    def process_direct_reply(self, channel, method, properties, body):
-        """User-supplied function that processes the direct-reply events"""
-        self.server_response = body
-        self.processed = True
\ No newline at end of file
+        future, callback, partial_callback, timeout, expiry = request
+        if partial:
+            if partial_callback is not None:
+                partial_callback(message)
+            return
+        if callback is not None:
+            callback(message)
+        future.set_result(message)
@@ -0,0 +1,70 @@
+import json
+import logging
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class JsonCodec(object):
+    content_type = 'application/json'
+
+    @staticmethod
+    def encode(message):
+        return json.dumps(message).encode('utf-8')
+
+    @staticmethod
+    def decode(body):
+        return json.loads(body.decode('utf-8'))
+
+
+class MsgpackCodec(object):
+    """Binary encoding. Floats are sent as 8 byte doubles instead of being formatted as text"""
+    content_type = 'application/msgpack'
+
+    @staticmethod
+    def encode(message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    @staticmethod
+    def decode(body):
+        return msgpack.unpackb(body, raw=False)
+
+
+codecs = {JsonCodec.content_type: JsonCodec}
+if msgpack is not None:
+    codecs[MsgpackCodec.content_type] = MsgpackCodec
+
+
+class DecodeError(ValueError):
+    """A received message that can't be decoded, because its content type is not supported or its body is invalid"""
+    pass
+
+
+def get_codec(content_type):
+    """Get the codec to encode a message with. Messages without a content type, or with one that is not supported by
+    this process, are encoded as JSON"""
+    if content_type is None:
+        return JsonCodec
+    try:
+        return codecs[content_type]
+    except KeyError:
+        logger.warning('Content type {} is not supported, falling back to {}'.format(content_type,
+                                                                                    JsonCodec.content_type))
+        return JsonCodec
+
+
+def decode(body, content_type):
+    """Decode a received message body. Bodies without a content type are treated as JSON. Raises DecodeError if the
+    content type is not supported by this process, or if the body is not valid for it"""
+    codec = JsonCodec if content_type is None else codecs.get(content_type)
+    if codec is None:
+        raise DecodeError('Content type {} is not supported'.format(content_type))
+    try:
+        return codec.decode(body)
+    except Exception as e:
+        raise DecodeError('Invalid {} message: {}'.format(codec.content_type, e))
@@ -0,0 +1,104 @@
+import threading
+from queue import Queue, Empty
+
+from .rmq_component import RmqComponent, logger
+
+
+class TelemetryPublisher(RmqComponent):
+    """Publishes readings to a topic exchange, so that any number of observers can follow them without adding
+    traffic to the instrument.
+
+    Readings are published with the routing key telemetry.<source>.<command>.<parameters>, e.g.
+    telemetry.LS218.KRDG.3 for 'KRDG? 3' on the LS218. Observers subscribe with binding keys such as
+    telemetry.LS218.# or telemetry.*.KRDG.*, see TelemetrySubscriber.
+
+    Nothing is published unless a telemetry_source is given. publish_reading is thread safe and does not block, the
+    readings are published by the telemetry thread.
+    """
+    def __init__(self, telemetry_source=None, telemetry_exchange='telemetry', **kwargs):
+        super().__init__(**kwargs)
+        self.telemetry_source = telemetry_source
+        self.telemetry_exchange = telemetry_exchange
+        self.telemetry_thread_queue = Queue()
+
+    def run_telemetry_thread(self):
+        """Start publishing readings. Does nothing if there is no telemetry_source"""
+        if self.telemetry_source is None:
+            return
+        thread = threading.Thread(target=self.setup_and_run_telemetry)
+        thread.start()
+
+    def setup_and_run_telemetry(self):
+        self.telemetry_connection = self.transport.connect()
+        logger.info('Telemetry Connection opened')
+        self.telemetry_connection.declare_exchange(self.telemetry_exchange)
+
+        try:
+            while not self.done:
+                try:
+                    routing_key, message = self.telemetry_thread_queue.get(timeout=1)
+                except Empty:
+                    continue
+                self.telemetry_connection.publish_topic(self.telemetry_exchange, routing_key, message)
+        finally:
+            self.telemetry_connection.close()
+            logger.info('Telemetry Connection closed')
+
+    def get_routing_key(self, cmd, pars):
+        # Routing keys are made of words separated by dots, so dots in the parameters are replaced
+        words = ['telemetry', self.telemetry_source, cmd.rstrip('?')]
+        words.extend(str(par).replace('.', '_') for par in pars)
+        return '.'.join(words)
+
+    def publish_reading(self, cmd, pars, command_result):
+        """Queue the result object of a query to be published"""
+        if self.telemetry_source is None:
+            return
+        message = dict(command_result, SOURCE=self.telemetry_source, CMD=' '.join([cmd] + [str(par) for par in pars]))
+        self.telemetry_thread_queue.put((self.get_routing_key(cmd, pars), message))
+
+
+class TelemetrySubscriber(RmqComponent):
+    """Receives the readings published by TelemetryPublishers.
+
+    telemetry_keys are the binding keys of the readings to receive, where '*' stands for one word and '#' for any
+    number of words. Each reading is handed to process_telemetry (from the subscriber thread) as the published
+    message: the t0, t1, error and result of the query, plus its SOURCE and CMD. process_timeout is called whenever no
+    reading arrived for telemetry_timeout seconds.
+    """
+    def __init__(self, telemetry_keys=('telemetry.#',), telemetry_exchange='telemetry', telemetry_timeout=1,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.telemetry_keys = telemetry_keys
+        self.telemetry_exchange = telemetry_exchange
+        self.telemetry_timeout = telemetry_timeout
+
+    def run_subscriber_thread(self):
+        thread = threading.Thread(target=self.setup_and_run_subscriber)
+        thread.start()
+
+    def setup_and_run_subscriber(self):
+        self.subscriber_connection = self.transport.connect()
+        logger.info('Subscriber Connection opened')
+        telemetry_queue = self.subscriber_connection.subscribe(self.telemetry_exchange, self.telemetry_keys)
+
+        try:
+            while not self.done:
+                message, properties = self.subscriber_connection.consume(telemetry_queue, self.telemetry_timeout)
+                if properties is None:
+                    self.process_timeout()
+                    continue
+                try:
+                    self.process_telemetry(message)
+                except Exception:
+                    logger.exception('Failed to process telemetry: {}'.format(message))
+                self.subscriber_connection.acknowledge(properties)
+        finally:
+            self.subscriber_connection.close()
+            logger.info('Subscriber Connection closed')
+
+    def process_telemetry(self, message):
+        pass
+
+    def process_timeout(self):
+        pass
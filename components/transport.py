@@ -0,0 +1,425 @@
+import asyncio
+import logging
+import threading
+import uuid
+from queue import Queue, Empty
+
+import pika
+
+from .serialization import JsonCodec, DecodeError, get_codec, decode, codecs
+
+
+logger = logging.getLogger(__name__)
+logger.info('Current pika version is {}'.format(pika.__version__))
+
+
+class Transport(object):
+    """A transport carries messages between the components.
+
+    RmqResp and RmqReq open one connection per thread with connect(). Messages are handed to the connection as Python
+    objects. It is up to the transport to decide whether (and how) they are serialized.
+    """
+    def connect(self):
+        raise NotImplementedError()
+
+
+class Connection(object):
+    """A connection opened by a Transport. A connection must only be used by the thread that opened it.
+
+    Received messages come with a properties object that has (at least) reply_to, correlation_id, content_type and
+    headers attributes. Servers reply with the content type of the request so that clients choose the encoding.
+    """
+    def declare_queue(self, queue, max_priority=None):
+        raise NotImplementedError()
+
+    def set_prefetch(self, prefetch_count):
+        pass
+
+    def get(self, queue):
+        """Return the next (message, properties) on the queue without blocking, or (None, None) if it is empty"""
+        raise NotImplementedError()
+
+    def consume(self, queue, timeout):
+        """Block for up to timeout seconds for the next (message, properties), returns (None, None) on timeout.
+        With a timeout of 0 only messages that have already arrived are returned"""
+        raise NotImplementedError()
+
+    def acknowledge(self, properties):
+        """Acknowledge a message returned by consume, given its properties"""
+        pass
+
+    def publish(self, queue, message, reply_to=None, correlation_id=None, content_type=None, priority=None,
+                headers=None):
+        raise NotImplementedError()
+
+    def consume_replies(self, callback):
+        """Call callback(message, properties) for every reply sent to this connection. Returns the reply_to name"""
+        raise NotImplementedError()
+
+    def process_events(self, time_limit):
+        """Dispatch reply callbacks, waiting for up to time_limit seconds. Returns early once a reply was dispatched"""
+        raise NotImplementedError()
+
+    def declare_exchange(self, exchange):
+        """Declare a topic exchange"""
+        raise NotImplementedError()
+
+    def publish_topic(self, exchange, routing_key, message):
+        """Publish a message to every queue bound to the topic exchange with a matching binding key"""
+        raise NotImplementedError()
+
+    def subscribe(self, exchange, binding_keys):
+        """Create a queue that receives the messages published to the topic exchange with routing keys that match
+        any of binding_keys. The queue is deleted when the connection closes. Returns the queue name, the messages are
+        read from it with consume"""
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class RmqTransport(Transport):
+    """Transport through a RabbitMQ broker.
+
+    Messages are encoded with the codec for content_type, which is sent in the AMQP content_type property. Received
+    messages are decoded according to their own content_type, and anything without one is treated as JSON. Messages
+    that can't be decoded (e.g. msgpack sent to a process without msgpack) are rejected and dropped, and the
+    connection carries on with the next one.
+    """
+    def __init__(self, host='localhost', content_type=JsonCodec.content_type):
+        self.host = host
+        if content_type not in codecs:
+            logger.warning('Content type {} is not supported, using {}'.format(content_type, JsonCodec.content_type))
+            content_type = JsonCodec.content_type
+        self.content_type = content_type
+
+    def connect(self):
+        return RmqConnection(pika.ConnectionParameters(self.host), self.content_type)
+
+
+class RmqConnection(Connection):
+    def __init__(self, parameters, content_type=JsonCodec.content_type):
+        self.content_type = content_type
+        self.connection = pika.BlockingConnection(parameters)
+        logger.info('Connection opened')
+        self.channel = self.connection.channel()
+        logger.info('Created a new channel')
+        self.consumer = None
+        # Delivery tags of the consumed messages that have not been acknowledged yet, keyed by id(properties)
+        self.delivery_tags = {}
+
+    def declare_queue(self, queue, max_priority=None):
+        self.channel.queue_delete(queue=queue)
+        arguments = {'x-max-priority': max_priority} if max_priority else None
+        self.channel.queue_declare(queue=queue, arguments=arguments)
+
+    def set_prefetch(self, prefetch_count):
+        # Only let the broker push prefetch_count messages before they are acknowledged
+        self.channel.basic_qos(prefetch_count=prefetch_count)
+
+    def get(self, queue):
+        # Process message queue events, returning as soon as possible
+        self.connection.process_data_events(time_limit=0)
+
+        method, properties, body = self.channel.basic_get(queue=queue, no_ack=True)
+        if method is None:
+            return None, None
+        try:
+            return decode(body, properties.content_type), properties
+        except DecodeError as e:
+            logger.error('Dropped a message from {}: {}'.format(queue, e))
+            return None, None
+
+    def consume(self, queue, timeout):
+        if not timeout:
+            # Only return a message that has already been delivered to the consumer
+            if self.consumer is None:
+                return None, None
+            self.connection.process_data_events(time_limit=0)
+            if not self.channel.get_waiting_message_count():
+                return None, None
+        elif self.consumer is None:
+            self.consumer = self.channel.consume(queue, no_ack=False, inactivity_timeout=timeout)
+
+        method, properties, body = next(self.consumer)
+        if method is None:
+            return None, None
+        try:
+            message = decode(body, properties.content_type)
+        except DecodeError as e:
+            logger.error('Rejected a message from {}: {}'.format(queue, e))
+            self.channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            return None, None
+        # The message is acknowledged once the response has been sent
+        self.delivery_tags[id(properties)] = method.delivery_tag
+        return message, properties
+
+    def acknowledge(self, properties):
+        delivery_tag = self.delivery_tags.pop(id(properties), None)
+        if delivery_tag is not None:
+            self.channel.basic_ack(delivery_tag=delivery_tag)
+
+    def publish(self, queue, message, reply_to=None, correlation_id=None, content_type=None, priority=None,
+                headers=None):
+        if content_type is None:
+            content_type = self.content_type
+        codec = get_codec(content_type)
+        self.channel.basic_publish(exchange='',
+                                   routing_key=queue,
+                                   body=codec.encode(message),
+                                   properties=pika.BasicProperties(
+                                       reply_to=reply_to,
+                                       correlation_id=correlation_id,
+                                       content_type=codec.content_type,
+                                       priority=priority,
+                                       headers=headers
+                                   ))
+
+    def consume_replies(self, callback):
+        """Create the direct-reply consumer"""
+        def on_reply(channel, method, properties, body):
+            try:
+                message = decode(body, properties.content_type)
+            except DecodeError as e:
+                logger.error('Dropped the reply to {}: {}'.format(properties.correlation_id, e))
+                return
+            callback(message, properties)
+
+        self.channel.basic_consume(on_reply, queue='amq.rabbitmq.reply-to', no_ack=True)
+        return 'amq.rabbitmq.reply-to'
+
+    def process_events(self, time_limit):
+        self.connection.process_data_events(time_limit=time_limit)
+
+    def declare_exchange(self, exchange):
+        self.channel.exchange_declare(exchange=exchange, exchange_type='topic')
+
+    def publish_topic(self, exchange, routing_key, message):
+        codec = get_codec(self.content_type)
+        self.channel.basic_publish(exchange=exchange,
+                                   routing_key=routing_key,
+                                   body=codec.encode(message),
+                                   properties=pika.BasicProperties(content_type=codec.content_type))
+
+    def subscribe(self, exchange, binding_keys):
+        self.declare_exchange(exchange)
+        # Let the broker name the queue. An exclusive queue is deleted when the connection closes
+        queue = self.channel.queue_declare(queue='', exclusive=True).method.queue
+        for binding_key in binding_keys:
+            self.channel.queue_bind(queue=queue, exchange=exchange, routing_key=binding_key)
+        return queue
+
+    def close(self):
+        if self.consumer is not None:
+            self.channel.cancel()
+            self.consumer = None
+        self.channel.close()
+        logger.info('Channel closed')
+        self.connection.close()
+        logger.info('Connection closed')
+
+
+class MessageProperties(object):
+    def __init__(self, reply_to=None, correlation_id=None, content_type=None, priority=None, headers=None):
+        self.reply_to = reply_to
+        self.correlation_id = correlation_id
+        self.content_type = content_type
+        self.priority = priority
+        self.headers = headers
+
+
+def topic_matches(binding_key, routing_key):
+    """Match a routing key against an AMQP topic binding key, where '*' stands for exactly one word and '#' for zero or
+    more words"""
+    return match_topic_words(binding_key.split('.'), routing_key.split('.'))
+
+
+def match_topic_words(pattern, words):
+    if not pattern:
+        return not words
+    if pattern[0] == '#':
+        return any(match_topic_words(pattern[1:], words[i:]) for i in range(len(words) + 1))
+    if not words:
+        return False
+    return pattern[0] in ('*', words[0]) and match_topic_words(pattern[1:], words[1:])
+
+
+class LocalQueue(Queue):
+    """A queue of a LocalBroker. Besides the threads blocking in get, asyncio tasks can wait for messages with
+    wait_async, which doesn't block their event loop."""
+    def __init__(self):
+        super().__init__()
+        # (loop, future) of the tasks waiting for a message
+        self.waiters = []
+
+    def _put(self, item):
+        # Called by put with the queue's mutex held
+        super()._put(item)
+        waiters, self.waiters = self.waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self.wake_waiter, future)
+
+    async def wait_async(self, timeout):
+        """Wait for up to timeout seconds until the queue isn't empty. Returns whether it isn't. Another consumer may
+        still take the message first, so get it with get_nowait"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.mutex:
+            if self._qsize():
+                return True
+            self.waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            with self.mutex:
+                if (loop, future) in self.waiters:
+                    self.waiters.remove((loop, future))
+            return False
+
+    @staticmethod
+    def wake_waiter(future):
+        # The wait may have timed out in the meantime
+        if not future.done():
+            future.set_result(None)
+
+
+class LocalBroker(object):
+    """Holds the queues shared by the LocalTransport connections of one process, and the bindings of the topic
+    exchanges.
+
+    By default messages are passed by reference. With a content_type, every message is encoded when it is published
+    (in the content type of the message, or else content_type) and decoded when it is received, as it would be
+    through RabbitMQ. Messages then cost the same serialization time as with a real broker, e.g. for benchmarks.
+    """
+    def __init__(self, content_type=None):
+        if content_type is not None and content_type not in codecs:
+            logger.warning('Content type {} is not supported, using {}'.format(content_type, JsonCodec.content_type))
+            content_type = JsonCodec.content_type
+        self.content_type = content_type
+        self.queues = {}
+        # Bindings of each exchange, as {exchange: [(binding key, queue)]}
+        self.bindings = {}
+        self.lock = threading.Lock()
+
+    def get_queue(self, queue):
+        with self.lock:
+            if queue not in self.queues:
+                self.queues[queue] = LocalQueue()
+            return self.queues[queue]
+
+    def delete_queue(self, queue):
+        with self.lock:
+            self.queues.pop(queue, None)
+            for exchange, bindings in self.bindings.items():
+                self.bindings[exchange] = [binding for binding in bindings if binding[1] != queue]
+
+    def bind_queue(self, exchange, binding_key, queue):
+        with self.lock:
+            self.bindings.setdefault(exchange, []).append((binding_key, queue))
+
+    def route(self, exchange, routing_key):
+        """Get the queues that a message published with routing_key goes to"""
+        with self.lock:
+            queues = [queue for binding_key, queue in self.bindings.get(exchange, ())
+                      if topic_matches(binding_key, routing_key)]
+            # A queue gets the message once, even if several of its bindings match
+            return [self.queues[queue] for queue in dict.fromkeys(queues) if queue in self.queues]
+
+
+default_broker = LocalBroker()
+
+
+class LocalTransport(Transport):
+    """In-process transport. Components using the same broker (by default, every LocalTransport in the process) can
+    exchange messages without a RabbitMQ broker.
+
+    Unless the broker has a content_type, messages are passed by reference and are never serialized, so they must not
+    be modified once they are published.
+    """
+    def __init__(self, broker=None):
+        self.broker = broker if broker is not None else default_broker
+
+    def connect(self):
+        return LocalConnection(self.broker)
+
+
+class LocalConnection(Connection):
+    def __init__(self, broker):
+        self.broker = broker
+        self.reply_queue = None
+        self.reply_callback = None
+        self.subscriptions = []
+
+    def declare_queue(self, queue, max_priority=None):
+        # Unlike the RabbitMQ queues, an existing queue is kept so that requests sent before the server started
+        # are not lost
+        self.broker.get_queue(queue)
+
+    def get(self, queue):
+        return self.consume(queue, 0)
+
+    def consume(self, queue, timeout):
+        try:
+            if timeout:
+                message, properties = self.broker.get_queue(queue).get(timeout=timeout)
+            else:
+                message, properties = self.broker.get_queue(queue).get_nowait()
+        except Empty:
+            return None, None
+        if self.broker.content_type is None:
+            return message, properties
+        try:
+            return decode(message, properties.content_type), properties
+        except DecodeError as e:
+            logger.error('Dropped a message from {}: {}'.format(queue, e))
+            return None, None
+
+    def encode(self, message, content_type):
+        """Encode a message if the broker serializes messages. Returns the message and its content type"""
+        if self.broker.content_type is None:
+            return message, content_type
+        codec = get_codec(content_type if content_type is not None else self.broker.content_type)
+        return codec.encode(message), codec.content_type
+
+    def publish(self, queue, message, reply_to=None, correlation_id=None, content_type=None, priority=None,
+                headers=None):
+        message, content_type = self.encode(message, content_type)
+        self.broker.get_queue(queue).put((message, MessageProperties(reply_to, correlation_id, content_type,
+                                                                     priority, headers)))
+
+    def consume_replies(self, callback):
+        self.reply_queue = 'local.reply.{}'.format(uuid.uuid4().hex)
+        self.reply_callback = callback
+        self.broker.get_queue(self.reply_queue)
+        return self.reply_queue
+
+    def process_events(self, time_limit):
+        if self.reply_queue is None:
+            return
+        message, properties = self.consume(self.reply_queue, time_limit)
+        while properties is not None:
+            self.reply_callback(message, properties)
+            message, properties = self.consume(self.reply_queue, 0)
+
+    def declare_exchange(self, exchange):
+        pass
+
+    def publish_topic(self, exchange, routing_key, message):
+        message, content_type = self.encode(message, None)
+        for queue in self.broker.route(exchange, routing_key):
+            queue.put((message, MessageProperties(content_type=content_type)))
+
+    def subscribe(self, exchange, binding_keys):
+        queue = 'local.subscription.{}'.format(uuid.uuid4().hex)
+        self.broker.get_queue(queue)
+        for binding_key in binding_keys:
+            self.broker.bind_queue(exchange, binding_key, queue)
+        self.subscriptions.append(queue)
+        return queue
+
+    def close(self):
+        if self.reply_queue is not None:
+            self.broker.delete_queue(self.reply_queue)
+        for queue in self.subscriptions:
+            self.broker.delete_queue(queue)
@@ -1,26 +1,149 @@
+import asyncio
+import inspect
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
 class State(object):
+    """A state of a StateMachine. The machine keeps one instance of each state and reuses it every time the state is
+    entered, so per-visit attributes have to be (re)set in enter.
+
+    run is called every tick_period seconds while the state is current (0 runs it back to back). The state changes
+    when a condition is set that is in transitions ({condition: next state class}), or when run sets done and there
+    is a done_state. next can be overridden for anything a table can't express.
+    """
+    tick_period = 1
+    transitions = {}
+    done_state = None
+
     def __init__(self, component):
         self.component = component
         self.done = False
 
+    def enter(self):
+        """Called every time the state becomes the current state, before its first run"""
+        pass
+
     def run(self):
         raise NotImplementedError()
 
     def next(self, condition):
-        raise NotImplementedError()
+        """Get the next state class, and whether the condition was used up to get there"""
+        if condition in self.transitions:
+            return self.transitions[condition], True
+        if self.done and self.done_state is not None:
+            return self.done_state, False
+        return type(self), False
 
 
 class StateMachine(object):
+    """Runs the current state at the state's tick period, and sleeps in between.
+
+    set_condition wakes the machine up straight away, so a state change requested from another thread (e.g. by a
+    command) doesn't wait for the end of the tick. The states that can be reached from the initial state, through
+    their transitions and done states, are created once when the machine is created.
+    """
     def __init__(self, component, initial_state):
         self.component = component
-        self.current_state = initial_state(self.component)
+        self.states = {}
+        self.add_states(initial_state)
         self.condition = None
+        self.condition_lock = threading.Lock()
+        self.wake_event = threading.Event()
+        self.stopped = False
+        self.current_state = self.get_state(initial_state)
+        self.current_state.enter()
+
+    def add_states(self, state):
+        """Create the state and the states that can be reached from it"""
+        pending = [state]
+        while pending:
+            state = pending.pop()
+            if state is None or state in self.states:
+                continue
+            self.states[state] = state(self.component)
+            pending.extend(state.transitions.values())
+            pending.append(state.done_state)
+
+    def get_state(self, state):
+        # States that are only reached through an overridden next are created the first time they are used
+        if state not in self.states:
+            self.add_states(state)
+        return self.states[state]
+
+    def set_condition(self, condition):
+        """Request a state change. Thread safe, the machine reacts before the end of the current tick"""
+        with self.condition_lock:
+            self.condition = condition
+        self.wake_event.set()
+
+    def stop(self):
+        self.stopped = True
+        self.wake_event.set()
+
+    def step(self):
+        """Run the current state once, then change state if needed. Returns True if the state changed"""
+        self.current_state.run()
+        return self.update_state()
+
+    def update_state(self):
+        with self.condition_lock:
+            condition = self.condition
+        if not self.current_state.done and condition is None:
+            return False
+
+        state, used_condition = self.current_state.next(condition)
+        if used_condition:
+            with self.condition_lock:
+                # Keep a condition that was set in the meantime
+                if self.condition == condition:
+                    self.condition = None
+        if state is type(self.current_state):
+            return False
+
+        self.current_state = self.get_state(state)
+        self.current_state.done = False
+        self.current_state.enter()
+        return True
 
     def run(self):
-        while True:
-            self.current_state.run()
-            if self.current_state.done or self.condition is not None:
-                state, used_condition = self.current_state.next(self.condition)
-                self.current_state = state(self.component)
-                if used_condition:
-                    self.condition = None
\ No newline at end of file
+        while not self.stopped:
+            try:
+                changed = self.step()
+            except Exception:
+                # E.g. a driver that doesn't answer. The state runs again at the next tick, unless a condition takes
+                # the machine out of it
+                logger.exception('State {} failed'.format(type(self.current_state).__name__))
+                changed = self.update_state()
+            if not changed and self.current_state.tick_period:
+                self.wake_event.wait(self.current_state.tick_period)
+            self.wake_event.clear()
+
+    async def step_async(self):
+        result = self.current_state.run()
+        if inspect.isawaitable(result):
+            await result
+        return self.update_state()
+
+    async def run_async(self):
+        """Run the state machine as a task in an event loop, e.g. next to the tasks of an AioControllerComponent.
+
+        The states must not block the event loop, so states that wait (e.g. for a driver's reply) have coroutine run
+        methods. Between ticks control is handed back to the event loop, and set_condition only takes effect at the
+        next tick.
+        """
+        while not self.stopped:
+            try:
+                changed = await self.step_async()
+            except asyncio.CancelledError:
+                # The component closed while the state waited for a reply
+                if not self.stopped:
+                    raise
+                break
+            except Exception:
+                logger.exception('State {} failed'.format(type(self.current_state).__name__))
+                changed = self.update_state()
+            await asyncio.sleep(0 if changed else self.current_state.tick_period)
@@ -0,0 +1,204 @@
+"""Latency and throughput benchmark of the command path, against the simulated instruments.
+
+Each command is timed through three paths:
+ - process_message: the driver's CommandRunner, called directly
+ - rmq: an RmqReq round trip to the driver's RmqResp server
+ - controller: MagnetController.send_message_and_get_reply to the driver
+with one client, then with several concurrent clients. The messages go through a LocalTransport, so no RabbitMQ
+broker is needed. By default the rmq and controller paths run once with the messages passed as Python objects, and
+once for each available encoding (json, and msgpack if it is installed), where the messages are encoded and decoded
+like they are through RabbitMQ. --encoding picks the runs.
+
+For each run the p50 and p99 latency, the commands per second and the CPU time per command (of the whole process, so
+including the driver's threads) are reported, and can be written as JSON with --output. Passing an earlier output as
+--baseline compares the runs against it, and the exit code is 1 if any of them got slower by more than --tolerance.
+
+By default the simulated instruments answer instantly (--time-scale 0), so the numbers are the overhead of the
+software. Use --time-scale 1 to include the simulated serial line.
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from components import LocalTransport, LocalBroker, RmqReq, codecs
+from LS218Driver import LS218Driver
+from SMSPowerSupplyDriver import SMSPowerSupplyDriver
+from MagnetController import MagnetController
+from simulators import SimulatedResource, LS218Simulator, SMS120CSimulator
+
+
+DRIVERS = {
+    'LS218': (LS218Driver, LS218Simulator, 'KRDG? 0'),
+    'SMS': (SMSPowerSupplyDriver, SMS120CSimulator, 'OUTP? T'),
+}
+
+# Content type of each encoding. With 'objects' the messages are not serialized
+ENCODINGS = {'objects': None, 'json': 'application/json', 'msgpack': 'application/msgpack'}
+
+# Lower is better for these, higher is better for commands_per_second
+COSTS = ('p50_ms', 'p99_ms', 'cpu_per_command_ms')
+
+
+def summarize(name, latencies, errors, wall_time, cpu_time):
+    latencies = np.asarray(latencies)
+    return {'name': name,
+            'commands': len(latencies),
+            'errors': errors,
+            'p50_ms': float(np.percentile(latencies, 50) * 1e3),
+            'p99_ms': float(np.percentile(latencies, 99) * 1e3),
+            'commands_per_second': len(latencies) / wall_time,
+            'cpu_per_command_ms': cpu_time / len(latencies) * 1e3}
+
+
+def run_clients(name, send, clients, requests):
+    """Call send(client) requests times from each of the client threads. send returns the reply of the command"""
+    latencies = [[] for _ in range(clients)]
+    errors = [0] * clients
+
+    def run(client):
+        for _ in range(requests):
+            t0 = time.perf_counter()
+            reply = send(client)
+            latencies[client].append(time.perf_counter() - t0)
+            if not reply or reply[0]['error']:
+                errors[client] += 1
+
+    threads = [threading.Thread(target=run, args=(client,)) for client in range(clients)]
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - wall_start
+    cpu_time = time.process_time() - cpu_start
+
+    return summarize(name, [latency for client in latencies for latency in client], sum(errors), wall_time, cpu_time)
+
+
+def available_encodings():
+    return [encoding for encoding, content_type in ENCODINGS.items() if content_type is None or content_type in codecs]
+
+
+def run_benchmark(driver_name, command, clients, requests, time_scale, encoding='objects'):
+    driver_class, simulator_class, default_command = DRIVERS[driver_name]
+    command = command or default_command
+    queue_name = 'Benchmark.{}.driver'.format(driver_name)
+    # A broker of its own, so that nothing else in the process gets in the way
+    transport = LocalTransport(LocalBroker(ENCODINGS[encoding]))
+
+    driver = driver_class(queue_name, {'resource': SimulatedResource(simulator_class(), time_scale)},
+                          transport=transport, consumer_mode=True)
+    rmq_clients = [RmqReq(transport=transport) for _ in range(clients)]
+    for client in rmq_clients:
+        client.run_client_thread()
+    controller = MagnetController({'controller_queue': 'Benchmark.controller',
+                                   'power_supply_driver': queue_name,
+                                   'magnet_temperature_driver': queue_name,
+                                   'hall_sensor_driver': queue_name,
+                                   'magnet_temperature_channel': 3,
+                                   'persistent_heater_switch_temperature_channel': 4,
+                                   'magnet_safe_temperatures': '[0, 6.5, 9, 4.15]',
+                                   # The quench monitor would add its own reads to the ones being timed
+                                   'quench_check_period': 0},
+                                  transport=transport, consumer_mode=True)
+
+    paths = [
+        ('process_message', lambda client: driver.process_message({'CMD': command})),
+        ('rmq', lambda client: rmq_clients[client].send_direct_message(queue_name, {'CMD': command}).result()),
+        ('controller', lambda client: controller.send_message_and_get_reply(queue_name, command)),
+    ]
+    if ENCODINGS[encoding] is not None:
+        # process_message doesn't go through the transport, so it is the same for every encoding
+        paths = paths[1:]
+
+    results = []
+    try:
+        # Let the threads connect, and warm up every path before timing it
+        time.sleep(0.5)
+        for path, send in paths:
+            run_clients(path, send, 1, min(requests, 10))
+            for path_clients in sorted({1, clients}):
+                name = '{}.{}.{}_clients'.format(driver_name, path, path_clients)
+                if ENCODINGS[encoding] is not None:
+                    name += '.' + encoding
+                results.append(run_clients(name, send, path_clients, requests))
+    finally:
+        for component in [driver, controller] + rmq_clients:
+            component.close()
+    return results
+
+
+def format_result(result):
+    return '{name:<40} p50 {p50_ms:8.3f} ms  p99 {p99_ms:8.3f} ms  {commands_per_second:9.1f} commands/s  ' \
+           'CPU {cpu_per_command_ms:7.3f} ms/command  errors {errors}'.format(**result)
+
+
+def compare(results, baseline, tolerance):
+    """Compare results against the results of a baseline run. Returns the regressions"""
+    baseline = {result['name']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        reference = baseline.get(result['name'])
+        if reference is None:
+            continue
+        for metric in COSTS + ('commands_per_second',):
+            ratio = result[metric] / reference[metric] if reference[metric] else float('inf')
+            worse = ratio > 1 + tolerance if metric in COSTS else ratio < 1 / (1 + tolerance)
+            print('{:<40} {:<20} {:10.3f} -> {:10.3f} ({:+6.1%}){}'.format(
+                result['name'], metric, reference[metric], result[metric], ratio - 1, '  REGRESSION' if worse else ''))
+            if worse:
+                regressions.append((result['name'], metric))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--driver', choices=sorted(DRIVERS), action='append',
+                        help='Driver to benchmark, can be repeated (default: all)')
+    parser.add_argument('--command', help='Command to send (default: a typical reading of the driver)')
+    parser.add_argument('--clients', type=int, default=4, help='Number of concurrent clients')
+    parser.add_argument('--requests', type=int, default=200, help='Number of commands per client')
+    parser.add_argument('--time-scale', type=float, default=0, help='Scale of the simulated instrument delays')
+    parser.add_argument('--encoding', choices=available_encodings(), action='append',
+                        help='Encoding of the messages, can be repeated (default: all)')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare the results with this earlier JSON output')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative slowdown counted as a regression')
+    args = parser.parse_args()
+
+    # The components log every connection at INFO level
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = []
+    for driver_name in args.driver or sorted(DRIVERS):
+        for encoding in args.encoding or available_encodings():
+            results.extend(run_benchmark(driver_name, args.command, args.clients, args.requests, args.time_scale,
+                                         encoding))
+
+    for result in results:
+        print(format_result(result))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'time': time.time(),
+                       'time_scale': args.time_scale,
+                       'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        regressions = compare(results, baseline, args.tolerance)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,127 @@
+"""Fixtures and helpers shared by the tests.
+
+The components run on a LocalTransport with a broker of their own, so no RabbitMQ broker is needed, and the simulated
+instruments answer instantly.
+
+    python -m pytest test/test_*.py
+"""
+import importlib
+import logging
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# The components configure the root logger when they are imported, which here is before pytest sets up its log
+# capture. A handler of our own makes that a no-op, so the logs of the components' threads go through pytest
+logging.getLogger().addHandler(logging.NullHandler())
+
+from components import LocalTransport, LocalBroker, RmqReq, TelemetrySubscriber
+from LS218Driver import LS218Driver
+from simulators import SimulatedResource, LS218Simulator
+
+
+# Seconds to wait for a reply before failing a test
+TIMEOUT = 5
+
+
+class RecordingResource(SimulatedResource):
+    """A simulated resource that answers instantly and records the queries.
+
+    Queries that fail(query) is true for raise, like an instrument that stopped answering, and queries wait while
+    released is clear, like a slow instrument.
+    """
+    def __init__(self, instrument):
+        super().__init__(instrument, time_scale=0)
+        self.fail = None
+        self.queries = []
+        self.released = threading.Event()
+        self.released.set()
+
+    def query(self, message):
+        self.queries.append(message)
+        self.released.wait(TIMEOUT)
+        if self.fail is not None and self.fail(message):
+            raise IOError("Timeout expired before operation completed")
+        return super().query(message)
+
+
+class TelemetryRecorder(TelemetrySubscriber):
+    """Records the commands of the telemetry readings it receives"""
+    def __init__(self, **kwargs):
+        super().__init__(telemetry_timeout=0.1, **kwargs)
+        self.readings = []
+
+    def process_telemetry(self, message):
+        self.readings.append(message['CMD'])
+
+
+def make_ls218(transport, resource=None, **kwargs):
+    # The driver starts its own threads
+    if resource is None:
+        resource = RecordingResource(LS218Simulator())
+    kwargs = dict({'consumer_timeout': 0.1, 'command_delay': 0}, **kwargs)
+    return LS218Driver('Test.LS218.driver', {'resource': resource}, transport=transport, **kwargs)
+
+
+def close_driver(driver):
+    driver.resource.released.set()
+    driver.close()
+
+
+def request(client, queue, command, **message):
+    """Send a command and wait for the list of result objects"""
+    return client.send_direct_message(queue, dict(message, CMD=command)).result(TIMEOUT)
+
+
+def wait_for(condition):
+    deadline = time.time() + TIMEOUT
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture(autouse=True)
+def component_log_dir(tmp_path, monkeypatch):
+    # Components log to a file next to their module. The tests' logs go to a directory of their own instead
+    monkeypatch.setattr(importlib.import_module('components.components'), 'dir_path', str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def transport():
+    # A broker of its own, so that the queues of one test don't leak into the next
+    return LocalTransport(LocalBroker())
+
+
+@pytest.fixture
+def client(transport):
+    client = RmqReq(transport=transport)
+    client.run_client_thread()
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def ls218(transport):
+    driver = make_ls218(transport)
+    yield driver
+    close_driver(driver)
+
+
+@pytest.fixture
+def make_driver(transport):
+    """Makes LS218 drivers with other settings, and closes them after the test"""
+    drivers = []
+
+    def make_driver(**kwargs):
+        drivers.append(make_ls218(transport, **kwargs))
+        return drivers[-1]
+
+    yield make_driver
+    for driver in drivers:
+        close_driver(driver)
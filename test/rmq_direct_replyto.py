@@ -23,8 +23,8 @@ class Producer(rmq.RmqReq):
         self.count += 1
         time.sleep(1)
 
-    def process_direct_reply(self, channel, method, properties, body):
-        LOGGER.info("Producer got back: " + str(body))
+    def process_direct_reply(self, message, properties):
+        LOGGER.info("Producer got back: " + str(message))
 
 
 class Consumer(rmq.RmqResp):
@@ -0,0 +1,675 @@
+"""Simulated LS218, LS350 and SMS120C instruments, for running the drivers and controllers without the hardware.
+
+The simulators model what matters for the performance of the drivers: the time the instrument takes to answer, the
+time the characters take on the serial line at the configured baud rate, and the minimum time the instrument needs
+between two commands (commands that arrive sooner are counted as overruns).
+
+A simulator can be used in two ways:
+ - Wrapped in a SimulatedResource and passed to a driver instead of an address:
+       LS218Driver('LS218.driver', {'resource': SimulatedResource(LS218Simulator())})
+ - Through pyvisa-mock, with the devices in instruments.yaml (only if pyvisa-mock is installed)
+
+time_scale speeds up (< 1) or slows down (> 1) the communication delays, 0 removes them altogether. The physics of the
+instruments (drifts, ramps) always run in real time.
+"""
+from collections import deque
+import importlib
+import logging
+import math
+import random
+import re
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def timeout_error():
+    """The error pyvisa raises when the instrument doesn't answer"""
+    try:
+        import pyvisa
+        return pyvisa.errors.VisaIOError(pyvisa.constants.StatusCode.error_timeout)
+    except ImportError:
+        return IOError("Timeout expired before operation completed")
+
+
+class SimulatedInstrument(object):
+    """Base of the simulators. Subclasses implement handle, which returns the reply to a message (or None)"""
+    # Serial settings the instrument expects
+    baud_rate = 9600
+    data_bits = 7
+    parity = 'odd'
+    stop_bits = 1
+    write_termination = '\r\n'
+    read_termination = '\r\n'
+    # Seconds between the end of a message and the start of the reply
+    latency = 0.01
+    # Seconds the instrument needs after a message before it can take the next one
+    command_interval = 0.05
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.time_scale = 1.0
+        self.ready_time = 0
+        self.commands = 0
+        self.overruns = 0
+        self.lock = threading.RLock()
+
+    def receive(self, message, now):
+        """Handle a message that finished arriving at time now. Returns the reply, or None"""
+        with self.lock:
+            self.commands += 1
+            if now < self.ready_time:
+                self.overruns += 1
+                logger.warning("Message '{}' arrived {:.3f}s too early".format(message, self.ready_time - now))
+            self.ready_time = now + self.command_interval * self.time_scale
+            return self.handle(message, now)
+
+    def handle(self, message, now):
+        raise NotImplementedError()
+
+    def unsolicited(self, now):
+        """Messages the instrument sent on its own since the last call"""
+        return []
+
+    def busy(self, now, duration):
+        """Keep the instrument from taking messages for duration seconds"""
+        self.ready_time = max(self.ready_time, now + duration * self.time_scale)
+
+
+class SimulatedResource(object):
+    """Stands in for the pyvisa resource of a serial instrument.
+
+    Writes and reads take as long as the characters (and terminations) take at the resource's baud rate, and replies
+    are not available before the instrument's latency has passed. A read with no reply waiting times out like pyvisa.
+    """
+    CR = '\r'
+    LF = '\n'
+
+    def __init__(self, instrument, time_scale=1.0):
+        self.instrument = instrument
+        self.time_scale = time_scale
+        instrument.time_scale = time_scale
+        self.baud_rate = instrument.baud_rate
+        self.data_bits = instrument.data_bits
+        self.parity = instrument.parity
+        self.stop_bits = instrument.stop_bits
+        self.termination = instrument.read_termination
+        # Milliseconds, like pyvisa
+        self.timeout = 2000
+        # Replies waiting to be read, as (time they are available, reply)
+        self.replies = deque()
+        self.lock = threading.Lock()
+
+    def character_time(self):
+        """Seconds per character: a start bit, the data bits, the parity bit and the stop bits"""
+        parity_bits = 0 if not self.parity or self.parity == 'none' else 1
+        # pyvisa's StopBits are in tenths of bits
+        stop_bits = self.stop_bits / 10 if self.stop_bits >= 10 else self.stop_bits
+        return (1 + self.data_bits + parity_bits + stop_bits) / self.baud_rate
+
+    def sleep(self, duration):
+        if duration > 0 and self.time_scale:
+            time.sleep(duration * self.time_scale)
+
+    def write(self, message):
+        with self.lock:
+            self.sleep((len(message) + len(self.instrument.write_termination)) * self.character_time())
+            now = time.time()
+            for unsolicited in self.instrument.unsolicited(now):
+                self.replies.append((now, unsolicited))
+            reply = self.instrument.receive(message, now)
+            if reply is not None:
+                self.replies.append((now + self.instrument.latency * self.time_scale, reply))
+            return len(message) + len(self.instrument.write_termination)
+
+    def read(self):
+        with self.lock:
+            if not self.replies:
+                self.sleep(self.timeout / 1000)
+                raise timeout_error()
+            available, reply = self.replies.popleft()
+            delay = available - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.sleep((len(reply) + len(self.instrument.read_termination)) * self.character_time())
+            return reply
+
+    def query(self, message):
+        self.write(message)
+        return self.read()
+
+    def clear(self):
+        with self.lock:
+            self.replies.clear()
+
+    def close(self):
+        pass
+
+
+class LakeShoreSimulator(SimulatedInstrument):
+    """Common behaviour of the Lake Shore instruments.
+
+    Messages hold one or more commands separated by ';', and the replies to the queries among them are sent back
+    together, separated by ';'. Each command is handled by the method query_<NAME> or write_<NAME> (without the '*'
+    of common commands), called with the command's parameters as strings. Unknown or invalid commands are ignored,
+    like the instrument does.
+    """
+    idn = "LSCI,MODEL000,0000000,1.0"
+    command_pattern = re.compile(r'^(\*?[A-Za-z]+)(\??)\s*(.*)$')
+
+    def __init__(self):
+        super().__init__()
+        # Curve headers as {curve: [name, serial, format, limit, coefficient]} and points as {curve: [[units, temp]]}
+        self.curve_headers = {}
+        self.curve_points = {}
+
+    def handle(self, message, now):
+        replies = []
+        for command in message.split(';'):
+            match = self.command_pattern.match(command.strip())
+            if not match:
+                continue
+            name, query, arguments = match.groups()
+            pars = [par.strip() for par in arguments.split(',')] if arguments.strip() else []
+            method = getattr(self, ('query_' if query else 'write_') + name.lstrip('*').upper(), None)
+            if method is None:
+                logger.warning("Unknown command '{}'".format(command))
+                continue
+            try:
+                result = method(now, *pars)
+            except (ValueError, TypeError, IndexError, KeyError):
+                logger.warning("Invalid command '{}'".format(command))
+                continue
+            if query:
+                replies.append(str(result))
+        return ';'.join(replies) if replies else None
+
+    def elapsed(self, now):
+        return now - self.start_time
+
+    def query_IDN(self, now):
+        return self.idn
+
+    def query_OPC(self, now):
+        return 1
+
+    def write_RST(self, now):
+        pass
+
+    def write_CLS(self, now):
+        pass
+
+    def query_CRVHDR(self, now, curve):
+        name, serial, data_format, limit, coefficient = self.curve_headers.get(int(curve), ['', '', 2, 325.0, 1])
+        return "{:<15},{:<10},{},{:+.3f},{}".format(name, serial, data_format, limit, coefficient)
+
+    def write_CRVHDR(self, now, curve, name, serial, data_format, limit, coefficient):
+        self.curve_headers[int(curve)] = [name, serial, int(data_format), float(limit), int(coefficient)]
+
+    def query_CRVPT(self, now, curve, index):
+        points = self.curve_points.get(int(curve), [])
+        units, temperature = points[int(index) - 1] if int(index) <= len(points) else (0, 0)
+        return "{:+.6g},{:+.6g}".format(units, temperature)
+
+    def write_CRVPT(self, now, curve, index, units, temperature):
+        points = self.curve_points.setdefault(int(curve), [])
+        index = int(index)
+        if index < 1 or index > 200:
+            raise ValueError()
+        points.extend([(0, 0)] * (index - len(points)))
+        points[index - 1] = (float(units), float(temperature))
+
+    def write_CRVDEL(self, now, curve):
+        self.curve_headers.pop(int(curve), None)
+        self.curve_points.pop(int(curve), None)
+
+
+class LS218Simulator(LakeShoreSimulator):
+    """Eight input temperature monitor. Each input reads a temperature (plus noise) that drifts at a set rate, and
+    the data log fills with one record per log interval"""
+    idn = "LSCI,MODEL218S,0000001,1.0"
+    baud_rate = 9600
+    inputs = 8
+    # Standard deviation of the readings, in K
+    noise = 0.001
+
+    def __init__(self, temperatures=(4.2, 4.2, 4.3, 4.5, 20.0, 40.0, 77.0, 295.0), log_interval=10):
+        super().__init__()
+        # Temperatures (K) and drift rates (K/s) of the inputs, from the time they were set
+        self.temperatures = list(temperatures)
+        self.rates = [0.0] * self.inputs
+        self.set_times = [self.start_time] * self.inputs
+        self.log_interval = log_interval
+        self.curves = [1] * self.inputs
+
+    def set_temperature(self, channel, temperature, rate=0.0):
+        """Make an input read temperature from now on, drifting at rate K/s"""
+        with self.lock:
+            self.temperatures[channel - 1] = temperature
+            self.rates[channel - 1] = rate
+            self.set_times[channel - 1] = time.time()
+
+    def temperature(self, channel, now):
+        index = int(channel) - 1
+        if index < 0:
+            raise ValueError()
+        drift = self.rates[index] * (now - self.set_times[index])
+        return max(self.temperatures[index] + drift + random.gauss(0, self.noise), 0)
+
+    def readings(self, channel, now, convert):
+        if int(channel) == 0:
+            return ','.join("{:+.4E}".format(convert(self.temperature(i, now))) for i in range(1, self.inputs + 1))
+        return "{:+.4E}".format(convert(self.temperature(channel, now)))
+
+    def query_KRDG(self, now, channel):
+        return self.readings(channel, now, lambda kelvin: kelvin)
+
+    def query_CRDG(self, now, channel):
+        return self.readings(channel, now, lambda kelvin: kelvin - 273.15)
+
+    def query_SRDG(self, now, channel):
+        # A rough silicon diode response, in V
+        return self.readings(channel, now, lambda kelvin: max(1.7 - 0.0045 * kelvin, 0.1))
+
+    def query_INCRV(self, now, channel):
+        return self.curves[int(channel) - 1]
+
+    def write_INCRV(self, now, channel, curve):
+        self.curves[int(channel) - 1] = int(curve)
+
+    def query_INTYPE(self, now, group):
+        return 0
+
+    def query_FILTER(self, now, channel):
+        return "1,10,2"
+
+    def query_ALARMST(self, now, channel):
+        return "0,0"
+
+    def query_BAUD(self, now):
+        return 1
+
+    def query_LOG(self, now):
+        return 1
+
+    def query_LOGSET(self, now):
+        return "1,0,0,{},{}".format(self.log_interval, self.inputs)
+
+    def query_LOGNUM(self, now):
+        return int(self.elapsed(now) // self.log_interval)
+
+    def query_LOGVIEW(self, now, record, reading):
+        record, reading = int(record), int(reading)
+        if record < 1 or record > self.query_LOGNUM(now) or reading < 1 or reading > self.inputs:
+            raise ValueError()
+        record_time = self.start_time + record * self.log_interval
+        return "{},{:+.4E},0,1".format(time.strftime('%m/%d/%y,%H:%M:%S', time.localtime(record_time)),
+                                       self.temperature(reading, record_time))
+
+
+class LS350Simulator(LakeShoreSimulator):
+    """Temperature controller with four inputs and four outputs. Input A follows the setpoint of output 1 with a first
+    order response while its heater is on, and relaxes to the base temperature when it is off. Setpoints ramp at the
+    set rate when ramping is on"""
+    idn = "LSCI,MODEL350,0000001,1.0"
+    baud_rate = 57600
+    channels = 'ABCD'
+    noise = 0.001
+    # Temperature with the heater off (K) and time constant of input A (s)
+    base_temperature = 4.0
+    time_constant = 30.0
+
+    def __init__(self):
+        super().__init__()
+        self.temperatures = [self.base_temperature, 4.5, 10.0, 295.0]
+        self.setpoints = [self.base_temperature] * 4
+        self.ramp_targets = [self.base_temperature] * 4
+        self.heater_ranges = [0] * 4
+        # Ramps as [on, rate (K/min)]
+        self.ramps = [[0, 0.0] for _ in range(4)]
+        self.pids = [[50.0, 20.0, 0.0] for _ in range(4)]
+        self.brightness = 32
+        self.update_time = self.start_time
+
+    def update(self, now):
+        """Move the setpoints and input A forward to time now"""
+        dt = now - self.update_time
+        if dt <= 0:
+            return
+        self.update_time = now
+        for output in range(4):
+            on, rate = self.ramps[output]
+            step = rate / 60 * dt if on and rate > 0 else math.inf
+            difference = self.ramp_targets[output] - self.setpoints[output]
+            self.setpoints[output] += max(-step, min(step, difference))
+        target = self.setpoints[0] if self.heater_ranges[0] else self.base_temperature
+        self.temperatures[0] = target + (self.temperatures[0] - target) * math.exp(-dt / self.time_constant)
+
+    def channel_index(self, channel):
+        return self.channels.index(channel.upper())
+
+    def output_index(self, output):
+        index = int(output) - 1
+        if index < 0 or index > 3:
+            raise ValueError()
+        return index
+
+    def readings(self, channel, now, convert):
+        self.update(now)
+        if channel == '0':
+            indices = range(len(self.channels))
+        else:
+            indices = [self.channel_index(channel)]
+        return ','.join("{:+08.3f}".format(convert(self.temperatures[index] + random.gauss(0, self.noise)))
+                        for index in indices)
+
+    def query_KRDG(self, now, channel):
+        return self.readings(channel, now, lambda kelvin: kelvin)
+
+    def query_CRDG(self, now, channel):
+        return self.readings(channel, now, lambda kelvin: kelvin - 273.15)
+
+    def query_SRDG(self, now, channel):
+        return self.readings(channel, now, lambda kelvin: 1000 / max(kelvin, 0.1))
+
+    def query_RDGST(self, now, channel):
+        self.channel_index(channel)
+        return "000"
+
+    def query_BRIGT(self, now):
+        return self.brightness
+
+    def write_BRIGT(self, now, brightness):
+        self.brightness = int(brightness)
+
+    def query_SETP(self, now, output):
+        self.update(now)
+        return "{:+08.3f}".format(self.setpoints[self.output_index(output)])
+
+    def write_SETP(self, now, output, value):
+        self.update(now)
+        index = self.output_index(output)
+        self.ramp_targets[index] = float(value)
+
+    def query_RANGE(self, now, output):
+        return self.heater_ranges[self.output_index(output)]
+
+    def write_RANGE(self, now, output, heater_range):
+        self.update(now)
+        self.heater_ranges[self.output_index(output)] = int(heater_range)
+
+    def query_RAMP(self, now, output):
+        on, rate = self.ramps[self.output_index(output)]
+        return "{},{:+.3f}".format(on, rate)
+
+    def write_RAMP(self, now, output, on, rate):
+        self.update(now)
+        self.ramps[self.output_index(output)] = [int(on), float(rate)]
+
+    def query_RAMPST(self, now, output):
+        self.update(now)
+        index = self.output_index(output)
+        return 1 if self.ramps[index][0] and self.setpoints[index] != self.ramp_targets[index] else 0
+
+    def query_HTR(self, now, output):
+        self.update(now)
+        index = self.output_index(output)
+        if not self.heater_ranges[index]:
+            return "+000.00"
+        # Enough power to hold the setpoint, plus a proportional term while it is being approached
+        error = self.setpoints[index] - self.temperatures[index] if index == 0 else 0
+        power = 0.1 * self.setpoints[index] + self.pids[index][0] * error
+        return "{:+07.2f}".format(max(0.0, min(100.0, power)))
+
+    def query_HTRSET(self, now, output):
+        self.output_index(output)
+        return "1,2,+0.000,1,2"
+
+    def query_PID(self, now, output):
+        return "{:+.1f},{:+.1f},{:+.1f}".format(*self.pids[self.output_index(output)])
+
+    def write_PID(self, now, output, p, i, d):
+        self.pids[self.output_index(output)] = [float(p), float(i), float(d)]
+
+
+class SMS120CSimulator(SimulatedInstrument):
+    """Superconducting magnet power supply.
+
+    Every reply is framed like the instrument's: an eight character head, a space, the message and '\\x13'. The head
+    is the time (HH:MM:SS) for status updates, '........' for the confirmation of a setting, '------->' for command
+    information and '=======>' for faults.
+
+    The output ramps towards ZERO, MID or MAX at the ramp rate, limited by the voltage limit across the magnet's
+    inductance, and holds while paused. With the persistent switch heater off the magnet keeps the current it had
+    when the heater was switched off, while the output can be ramped freely. Set unsolicited_messages to have the
+    supply report when a ramp reaches its target, as it does on its own.
+    """
+    baud_rate = 9600
+    data_bits = 8
+    parity = 'none'
+    stop_bits = 1
+    latency = 0.1
+    command_interval = 0.1
+    # Settings take a while to be taken into account
+    setting_time = 1.0
+    # Inductance of the magnet (H) and maximum output current (A)
+    inductance = 20.0
+    maximum_current = 120.0
+
+    def __init__(self, tesla_per_amp=0.08, unsolicited_messages=False):
+        super().__init__()
+        self.remote = True
+        self.tesla = True
+        self.tesla_per_amp = tesla_per_amp
+        self.current = 0.0
+        self.mid = 0.0
+        self.max = self.maximum_current
+        # Ramp rate in A/s
+        self.rate = 0.05
+        self.target = 'ZERO'
+        self.paused = False
+        self.heater = False
+        self.magnet_current = 0.0
+        self.filter = False
+        self.voltage_limit = 5.0
+        self.heater_voltage = 2.5
+        self.unsolicited_messages = unsolicited_messages
+        self.pending = []
+        self.update_time = self.start_time
+
+    def target_current(self):
+        return {'ZERO': 0.0, 'MID': self.mid, 'MAX': self.max}[self.target]
+
+    def ramp_rate(self):
+        """Rate the output actually ramps at (A/s)"""
+        return min(self.rate, self.voltage_limit / self.inductance)
+
+    def ramping(self):
+        return not self.paused and self.current != self.target_current()
+
+    def update(self, now):
+        """Move the output forward to time now"""
+        dt = now - self.update_time
+        if dt <= 0:
+            return
+        self.update_time = now
+        if not self.ramping():
+            return
+        target = self.target_current()
+        step = self.ramp_rate() * dt
+        self.current += max(-step, min(step, target - self.current))
+        if self.heater:
+            self.magnet_current = self.current
+        if self.current == target and self.unsolicited_messages:
+            self.pending.append(self.frame(self.clock(now), "RAMP STATUS: HOLDING ON TARGET AT {}".format(
+                self.format_value(target))))
+
+    def unsolicited(self, now):
+        with self.lock:
+            self.update(now)
+            messages, self.pending = self.pending, []
+            return messages
+
+    @staticmethod
+    def clock(now):
+        return time.strftime('%H:%M:%S', time.localtime(now))
+
+    @staticmethod
+    def frame(head, message):
+        return "{} {}\x13".format(head, message)
+
+    def units(self):
+        return 'TESLA' if self.tesla else 'AMPS'
+
+    def to_output_units(self, current):
+        return current * self.tesla_per_amp if self.tesla else current
+
+    def from_output_units(self, value):
+        return value / self.tesla_per_amp if self.tesla else value
+
+    def format_value(self, current):
+        return "{:.4f} {}".format(self.to_output_units(current), self.units())
+
+    def voltage(self):
+        return math.copysign(self.ramp_rate() * self.inductance, self.target_current() - self.current) \
+            if self.ramping() else 0.0
+
+    @staticmethod
+    def parse_switch(value):
+        return {'ON': True, '1': True, 'OFF': False, '0': False}[value.upper()]
+
+    def setting(self, now, message):
+        """Confirm a setting, the supply then takes a while before it takes the next command"""
+        self.busy(now, self.setting_time)
+        return self.frame('........', message)
+
+    def handle(self, message, now):
+        self.update(now)
+        if not self.remote:
+            return self.frame('........', "REMOTE CONTROL: DISABLED")
+
+        words = message.strip().upper().split()
+        try:
+            return self.handle_words(words, now)
+        except (ValueError, KeyError, IndexError):
+            return self.frame('=======>', "INVALID COMMAND: {}".format(message.strip()))
+
+    def handle_words(self, words, now):
+        clock = self.clock(now)
+        if words[:1] == ['GET'] and len(words) == 2:
+            item = words[1]
+            if item == 'OUTPUT':
+                return self.frame(clock, "OUTPUT: {} AT {:.1f} VOLTS".format(
+                    self.format_value(self.current), self.voltage()))
+            if item == 'MID':
+                return self.frame(clock, "MID SETTING: {}".format(self.format_value(self.mid)))
+            if item == 'MAX':
+                return self.frame(clock, "MAX SETTING: {}".format(self.format_value(self.max)))
+            if item == 'RATE':
+                return self.frame(clock, "RAMP RATE: {:.4f} A/SEC".format(self.rate))
+            if item == 'TPA':
+                return self.frame('........', "FIELD CONSTANT: {:.5f} TESLA/AMP".format(self.tesla_per_amp))
+            if item == 'VL':
+                return self.frame(clock, "VOLTAGE LIMIT: {:.1f} VOLTS".format(self.voltage_limit))
+            if item == 'HV':
+                return self.frame(clock, "HEATER OUTPUT: {:.1f} VOLTS".format(self.heater_voltage))
+
+        if words[:1] == ['SET'] and len(words) == 3:
+            item, value = words[1], float(words[2])
+            if item in ('MID', 'MAX'):
+                current = self.from_output_units(value)
+                if current < 0 or current > self.maximum_current:
+                    raise ValueError()
+                setattr(self, item.lower(), current)
+                return self.setting(now, "{} SETTING: {}".format(item, self.format_value(current)))
+            if item == 'RAMP':
+                self.rate = value
+                return self.setting(now, "RAMP RATE: {:.4f} A/SEC".format(value))
+            if item == 'TPA':
+                self.tesla_per_amp = value
+                return self.setting(now, "FIELD CONSTANT: {:.5f} TESLA/AMP".format(value))
+            if item == 'LIMIT':
+                self.voltage_limit = value
+                return self.setting(now, "VOLTAGE LIMIT: {:.1f} VOLTS".format(value))
+            if item == 'HEATER':
+                self.heater_voltage = value
+                return self.setting(now, "HEATER OUTPUT: {:.1f} VOLTS".format(value))
+
+        if words[:1] == ['RAMP'] and len(words) == 2:
+            if words[1] not in ('ZERO', 'MID', 'MAX'):
+                raise ValueError()
+            self.target = words[1]
+            self.busy(now, self.setting_time)
+            return self.frame('------->', "RAMP TARGET: {}".format(words[1]))
+
+        if words[:1] == ['TESLA'] and len(words) <= 2:
+            if len(words) == 2:
+                self.tesla = self.parse_switch(words[1])
+                return self.setting(now, "UNITS: {}".format(self.units()))
+            return self.frame('........', "UNITS: {}".format(self.units()))
+
+        if words[:1] == ['PAUSE'] and len(words) <= 2:
+            if len(words) == 2:
+                self.paused = self.parse_switch(words[1])
+                return self.setting(now, "PAUSE STATUS: {}".format('ON' if self.paused else 'OFF'))
+            return self.frame('........', "PAUSE STATUS: {}".format('ON' if self.paused else 'OFF'))
+
+        if words[:1] == ['FILTER'] and len(words) <= 2:
+            if len(words) == 2:
+                self.filter = self.parse_switch(words[1])
+                return self.setting(now, "FILTER STATUS: {}".format('ON' if self.filter else 'OFF'))
+            return self.frame('........', "FILTER STATUS: {}".format('ON' if self.filter else 'OFF'))
+
+        if words[:1] == ['HEATER'] and len(words) <= 2:
+            if len(words) == 2:
+                heater = self.parse_switch(words[1])
+                # The magnet keeps its current once the switch is closed, and the output has to match it before
+                # the switch is opened again
+                if heater and not self.heater and abs(self.current - self.magnet_current) > 0.01:
+                    return self.frame('------->', "HEATER STATUS: REFUSED, OUTPUT {} DOES NOT MATCH {}".format(
+                        self.format_value(self.current), self.format_value(self.magnet_current)))
+                self.heater = heater
+                self.busy(now, self.setting_time)
+            if self.heater:
+                return self.frame('........', "HEATER STATUS: ON")
+            if self.magnet_current:
+                return self.frame('........', "HEATER STATUS: SWITCHED OFF AT {}".format(
+                    self.format_value(self.magnet_current)))
+            return self.frame('........', "HEATER STATUS: OFF")
+
+        raise ValueError()
+
+
+try:
+    # pyvisa-mock is not a valid identifier
+    mock = importlib.import_module("pyvisa-mock")
+except ImportError:
+    mock = None
+
+if mock is not None:
+    class MockSimulatorDevice(mock.devices.Device):
+        """pyvisa-mock device backed by a simulator. The simulated delays are slept in _match"""
+        simulator_class = None
+
+        def __init__(self, name, delimiter):
+            super().__init__(name, delimiter)
+            self.simulator = self.simulator_class()
+            self.resource = SimulatedResource(self.simulator)
+
+        def _match(self, query):
+            message = query.decode('utf-8').strip()
+            self.resource.write(message)
+            if not self.resource.replies:
+                return None
+            return self.resource.read().encode('utf-8')
+
+    class LS218Device(MockSimulatorDevice):
+        simulator_class = LS218Simulator
+
+    class LS350Device(MockSimulatorDevice):
+        simulator_class = LS350Simulator
+
+    class SMS120CDevice(MockSimulatorDevice):
+        simulator_class = SMS120CSimulator
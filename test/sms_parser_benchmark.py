@@ -0,0 +1,103 @@
+"""Benchmark of the SMS reply parsing, over a corpus of replies (sms_replies.txt by default).
+
+Two things are timed for every reply of the corpus:
+ - parse: parse_reply alone (framing, numbers, units and ON/OFF state)
+ - process: parse_reply followed by the process_result of the command the reply belongs to, i.e. everything the
+   driver does with a reply once it has been read from the instrument
+
+    python sms_parser_benchmark.py --output parser.json
+    python sms_parser_benchmark.py --baseline parser.json
+"""
+import argparse
+import codecs
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from SMSPowerSupplyDriver import SMSPowerSupplyDriver, parse_reply
+
+
+class CorpusDriver(object):
+    """The little of the driver that process_result uses"""
+    tesla_per_amp = 0.08
+
+    def set_tesla_per_amp(self, tesla_per_amp):
+        pass
+
+
+def load_corpus(filename):
+    """Read the (command, reply) pairs of a corpus file"""
+    corpus = []
+    with open(filename) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            command, reply = line.split('\t', 1)
+            corpus.append((command, codecs.decode(reply, 'unicode_escape')))
+    return corpus
+
+
+def process(driver, command, reply):
+    cmd, pars = SMSPowerSupplyDriver.split_cmd(driver, command)
+    parsed = parse_reply(reply)
+    if parsed.message.startswith('REMOTE CONTROL:'):
+        return None
+    try:
+        return SMSPowerSupplyDriver.all_commands[cmd].process_result(driver, cmd, pars, parsed)
+    except ValueError:
+        # Fault reports don't match the format of the command
+        return None
+
+
+def time_loop(function, corpus, repeat):
+    """Seconds per reply of function(command, reply), best of repeat passes over the corpus"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for command, reply in corpus:
+            function(command, reply)
+        best = min(best, time.perf_counter() - start)
+    return best / len(corpus)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                         'sms_replies.txt'))
+    parser.add_argument('--repeat', type=int, default=200, help='Number of passes over the corpus')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare the results with this earlier JSON output')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative slowdown counted as a regression')
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    driver = CorpusDriver()
+    for command, reply in corpus:
+        print('{:<14} {!r:<60} -> {}'.format(command, reply, process(driver, command, reply)))
+
+    results = {'parse_us': time_loop(lambda command, reply: parse_reply(reply), corpus, args.repeat) * 1e6,
+               'process_us': time_loop(lambda command, reply: process(driver, command, reply), corpus,
+                                       args.repeat) * 1e6}
+    print()
+    print('{} replies: parse {parse_us:.2f} us/reply, parse and process {process_us:.2f} us/reply'.format(
+        len(corpus), **results))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'time': time.time(), 'replies': len(corpus), 'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = []
+        for name, value in results.items():
+            ratio = value / baseline[name]
+            print('{:<12} {:8.2f} -> {:8.2f} us ({:+6.1%}){}'.format(
+                name, baseline[name], value, ratio - 1, '  REGRESSION' if ratio > 1 + args.tolerance else ''))
+            if ratio > 1 + args.tolerance:
+                regressions.append(name)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,128 @@
+"""Tests of the asyncio components, with a controller that runs in one event loop next to a threaded driver.
+
+    python -m pytest test/test_*.py
+"""
+import asyncio
+
+import pytest
+
+from components import LocalTransport, LocalBroker, JsonCodec, QueryCommand, AioLocalTransport, AioRmqReq, \
+    AioRmqResp, AioControllerComponent
+from conftest import TIMEOUT, make_ls218, close_driver
+from state_machine.state_machine import StateMachine, State
+
+
+class StateReadTemperature(State):
+    tick_period = 0.05
+
+    async def run(self):
+        reply = await self.component.request(self.component.temperature_driver, {'CMD': 'KRDG? 3'})
+        if not reply[0]['error']:
+            self.component.temperature = reply[0]['result']
+
+
+class TemperatureMonitor(AioControllerComponent):
+    """A controller that keeps reading a temperature from a driver, and serves the latest reading"""
+    def __init__(self, controller_queue, temperature_driver, **kwargs):
+        super().__init__(controller_queue, **kwargs)
+        self.temperature_driver = temperature_driver
+        self.temperature = None
+        self.state_machine = StateMachine(self, StateReadTemperature)
+
+    async def run_controller(self):
+        await self.run(self.run_response_server(), self.setup_client(), self.state_machine.run_async())
+
+    def close(self):
+        self.state_machine.stop()
+        super().close()
+
+    class GetTemperature(QueryCommand):
+        cmd = "GetTemperature"
+
+        @classmethod
+        def execute(cls, controller, cmd, pars):
+            return controller.temperature
+
+
+class RecordingServer(AioRmqResp):
+    def __init__(self, server_queue, **kwargs):
+        super().__init__(server_queue, **kwargs)
+        self.messages = []
+
+    def process_message(self, message):
+        self.messages.append(message['CMD'])
+        return message['CMD']
+
+
+@pytest.mark.parametrize('content_type', [None, JsonCodec.content_type])
+def test_controller_runs_in_one_event_loop(content_type):
+    broker = LocalBroker(content_type)
+    driver = make_ls218(LocalTransport(broker))
+    controller = TemperatureMonitor('Test.aio.controller', driver.response_server_queue,
+                                    transport=AioLocalTransport(broker), consumer_timeout=0.1)
+
+    async def get_temperature():
+        task = asyncio.ensure_future(controller.run_controller())
+        try:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + TIMEOUT
+            while loop.time() < deadline:
+                # The controller answers its own clients while its state machine waits for the driver
+                reply = await controller.request(controller.response_server_queue, {'CMD': 'GetTemperature'},
+                                                 timeout=TIMEOUT)
+                if reply[0]['result'] != '':
+                    return reply[0]['result']
+                await asyncio.sleep(0.05)
+        finally:
+            controller.close()
+            await task
+
+    try:
+        temperature = asyncio.run(get_temperature())
+    finally:
+        close_driver(driver)
+    assert 4 < temperature < 4.5
+    assert not controller.pending_requests
+
+
+def test_request_without_reply_expires():
+    client = AioRmqReq(transport=AioLocalTransport(LocalBroker()), request_timeout=0.1)
+
+    async def request():
+        task = asyncio.ensure_future(client.run(client.setup_client()))
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await client.request('Test.nobody', {'CMD': 'KRDG? 1'})
+            assert not client.pending_requests
+        finally:
+            client.close()
+            await task
+
+    asyncio.run(request())
+
+
+def test_urgent_messages_are_processed_first():
+    transport = AioLocalTransport(LocalBroker())
+    client = AioRmqReq(transport=transport)
+    server = RecordingServer('Test.aio.server', transport=transport, prefetch_count=3, consumer_timeout=0.1)
+
+    async def send_then_serve():
+        client_task = asyncio.ensure_future(client.run(client.setup_client()))
+        await client.client_ready_event().wait()
+        futures = [client.send_direct_message(server.response_server_queue, {'CMD': 'first'}),
+                   client.send_direct_message(server.response_server_queue, {'CMD': 'second'}),
+                   client.send_direct_message(server.response_server_queue, {'CMD': 'urgent'}, priority=5)]
+        # The messages are all waiting before the server starts
+        while sum(len(queue.queue) for queue in transport.broker.queues.values()) < 3:
+            await asyncio.sleep(0.01)
+        server_task = asyncio.ensure_future(server.run(server.run_response_server()))
+        try:
+            return await asyncio.wait_for(asyncio.gather(*futures), TIMEOUT)
+        finally:
+            server.close()
+            client.close()
+            await asyncio.gather(server_task, client_task)
+
+    assert asyncio.run(send_then_serve()) == ['first', 'second', 'urgent']
+    # The waiting messages are picked up before the first one is processed, so the urgent one overtakes both
+    assert server.messages == ['urgent', 'first', 'second']
@@ -0,0 +1,200 @@
+"""Tests of the driver command path (pipelining, caching, coalescing, priorities), against the simulated instruments.
+
+    python -m pytest test/test_*.py
+"""
+import time
+
+import numpy as np
+import pytest
+
+from conftest import TIMEOUT, RecordingResource, make_ls218, close_driver, request, wait_for
+from LS218Driver import LS218Driver
+from simulators import LS218Simulator
+
+
+def held_resource():
+    """A resource whose queries wait until it is released, so that the first poll doesn't finish before the test
+    gets going"""
+    resource = RecordingResource(LS218Simulator())
+    resource.released.clear()
+    return resource
+
+
+@pytest.fixture
+def ls218(transport):
+    driver = make_ls218(transport, pipelined=True, log_chunk_records=5)
+    yield driver
+    close_driver(driver)
+
+
+def test_pipelined_queries_are_sent_together(ls218, client):
+    replies = request(client, ls218.response_server_queue, 'KRDG? 1;KRDG? 2;CRDG? 3')
+    assert [reply['error'] for reply in replies] == ['', '', '']
+    assert ls218.resource.queries[-1] == 'KRDG? 1;KRDG? 2;CRDG? 3'
+    assert 4 < replies[0]['result'] < 4.5
+    assert -270 < replies[2]['result'] < -268
+
+
+def test_failed_pipeline_reports_errors_and_keeps_serving(ls218, client):
+    ls218.resource.fail = lambda query: True
+    replies = request(client, ls218.response_server_queue, 'KRDG? 1;KRDG? 2')
+    assert len(replies) == 2
+    assert all(reply['error'] and reply['result'] == '' for reply in replies)
+
+    # The server thread is still running
+    ls218.resource.fail = None
+    replies = request(client, ls218.response_server_queue, 'KRDG? 1;KRDG? 2')
+    assert [reply['error'] for reply in replies] == ['', '']
+
+
+def test_failed_reply_in_pipeline_only_fails_its_command(ls218, client):
+    # An empty reply can't be turned into a number, the other replies of the batch are still used
+    ls218.resource.instrument.query_CRDG = lambda now, channel: ''
+    replies = request(client, ls218.response_server_queue, 'KRDG? 1;CRDG? 2;KRDG? 3')
+    assert replies[0]['error'] == '' and replies[2]['error'] == ''
+    assert replies[1]['error'] and replies[1]['result'] == ''
+    assert request(client, ls218.response_server_queue, 'KRDG? 1')[0]['error'] == ''
+
+
+def test_log_download_resumes_after_a_failed_part(ls218, client):
+    # 20 records in the data log, and record 7 can't be read
+    instrument = ls218.resource.instrument
+    instrument.start_time -= 20.5 * instrument.log_interval
+    ls218.resource.fail = lambda query: query.startswith('LOGVIEW? 7,')
+
+    records, next_record = LS218Driver.download_log(client, ls218.response_server_queue, 1, 15)
+    # The parts after the failed one are not sent, so there is no gap before the record to resume from
+    assert next_record == 7
+    assert np.array_equal(np.unique(records['record']), np.arange(1, 7))
+    assert not any(query.startswith('LOGVIEW? 11,') for query in ls218.resource.queries)
+
+    ls218.resource.fail = None
+    records, next_record = LS218Driver.download_log(client, ls218.response_server_queue, next_record, 15)
+    assert next_record == 16
+    assert np.array_equal(np.unique(records['record']), np.arange(7, 16))
+    assert len(records) == 9 * instrument.inputs
+
+
+def test_cached_query_is_only_read_again_once_invalidated(ls218, client):
+    queue = ls218.response_server_queue
+    identification = request(client, queue, '*IDN?')[0]
+    assert request(client, queue, '*IDN?')[0] == identification
+    assert ls218.resource.queries.count('*IDN?') == 1
+
+    # A reset can change any setting, so it drops the cached results
+    assert request(client, queue, '*RST')[0]['error'] == ''
+    assert request(client, queue, '*IDN?')[0]['t1'] > identification['t1']
+    assert ls218.resource.queries.count('*IDN?') == 2
+
+
+def test_cached_query_expires_after_its_ttl(ls218, client):
+    queue = ls218.response_server_queue
+    request(client, queue, 'INTYPE? A')
+    request(client, queue, 'INTYPE? A')
+    assert ls218.resource.queries.count('INTYPE? A') == 1
+
+    # Age the cached result past the TTL of INTYPE? (60 s)
+    cached = ls218.query_cache['INTYPE?'][('A',)]
+    ls218.query_cache['INTYPE?'][('A',)] = dict(cached, t1=cached['t1'] - 61)
+    request(client, queue, 'INTYPE? A')
+    assert ls218.resource.queries.count('INTYPE? A') == 2
+
+
+def test_failed_query_is_not_cached(ls218, client):
+    queue = ls218.response_server_queue
+    ls218.resource.fail = lambda query: query == '*IDN?'
+    assert request(client, queue, '*IDN?')[0]['error']
+
+    ls218.resource.fail = None
+    assert request(client, queue, '*IDN?')[0]['error'] == ''
+    assert ls218.resource.queries.count('*IDN?') == 2
+
+
+def test_recent_query_is_reused_within_the_coalesce_window(make_driver, client):
+    driver = make_driver(coalesce_window=10)
+    replies = [request(client, driver.response_server_queue, 'KRDG? 3')[0] for _ in range(3)]
+    assert replies[1] == replies[0] and replies[2] == replies[0]
+    assert driver.resource.queries.count('KRDG? 3') == 1
+
+
+def test_failed_query_is_not_reused_within_the_coalesce_window(make_driver, client):
+    driver = make_driver(coalesce_window=10)
+    driver.resource.fail = lambda query: True
+    assert request(client, driver.response_server_queue, 'KRDG? 3')[0]['error']
+    driver.resource.fail = None
+    assert request(client, driver.response_server_queue, 'KRDG? 3')[0]['error'] == ''
+    assert driver.resource.queries.count('KRDG? 3') == 2
+
+
+def test_concurrent_identical_requests_read_the_instrument_once(make_driver, client):
+    # The window of the configs: the second request waits for the server, and reuses the reading of the first
+    driver = make_driver(resource=held_resource(), coalesce_window=0.5)
+    futures = [client.send_direct_message(driver.response_server_queue, {'CMD': 'KRDG? 3'}) for _ in range(2)]
+    wait_for(lambda: 'KRDG? 3' in driver.resource.queries)
+    time.sleep(0.2)
+    driver.resource.released.set()
+
+    replies = [future.result(TIMEOUT)[0] for future in futures]
+    assert replies[0]['error'] == '' and replies[1] == replies[0]
+    assert driver.resource.queries.count('KRDG? 3') == 1
+
+
+def test_request_shares_the_running_poll_of_the_same_query(make_driver, client):
+    driver = make_driver(resource=held_resource(), poll_commands={'KRDG? 3': 0.1})
+    # The first poll starts straight away, and waits for the instrument
+    wait_for(lambda: 'KRDG? 3' in driver.resource.queries)
+    future = client.send_direct_message(driver.response_server_queue, {'CMD': 'KRDG? 3'})
+    wait_for(lambda: driver.pending_queries)
+    time.sleep(0.2)
+    driver.resource.released.set()
+
+    reply = future.result(TIMEOUT)[0]
+    assert reply == driver.latest_values[('KRDG?', ('3',))]
+    assert driver.resource.queries.count('KRDG? 3') == 1
+
+
+def test_request_gets_the_error_of_the_shared_poll_then_runs_again(make_driver, client):
+    driver = make_driver(resource=held_resource(), poll_commands={'KRDG? 3': 0.1})
+    driver.resource.fail = lambda query: True
+    wait_for(lambda: 'KRDG? 3' in driver.resource.queries)
+    future = client.send_direct_message(driver.response_server_queue, {'CMD': 'KRDG? 3'})
+    wait_for(lambda: driver.pending_queries)
+    # Give the server the time to pick the request up while the poll is still waiting
+    time.sleep(0.2)
+    driver.resource.released.set()
+    assert future.result(TIMEOUT)[0]['error']
+    assert not driver.latest_values
+
+    # The failed poll left nothing behind, so the next request reads the instrument
+    driver.resource.fail = None
+    assert request(client, driver.response_server_queue, 'KRDG? 3')[0]['error'] == ''
+    assert driver.resource.queries.count('KRDG? 3') == 2
+
+
+def test_polled_query_is_answered_from_the_latest_value(make_driver, client):
+    driver = make_driver(poll_commands={'KRDG? 3': 0.5})
+    wait_for(lambda: driver.latest_values)
+    reply = request(client, driver.response_server_queue, 'KRDG? 3')[0]
+    assert reply == driver.latest_values[('KRDG?', ('3',))]
+    assert driver.resource.queries.count('KRDG? 3') == 1
+
+
+def test_only_queries_can_be_polled(transport):
+    with pytest.raises(ValueError):
+        make_ls218(transport, poll_commands={'*RST': 1})
+
+
+def test_urgent_message_runs_between_the_chunks_of_a_long_one(make_driver, client):
+    # With the default prefetch_count, the server picks up the urgent message while it runs the long one
+    driver = make_driver(chunk_size=2)
+    driver.resource.released.clear()
+    long_message = ';'.join('KRDG? {}'.format(channel) for channel in range(1, 7))
+    long_future = client.send_direct_message(driver.response_server_queue, {'CMD': long_message})
+    wait_for(lambda: driver.resource.queries)
+    urgent_future = client.send_direct_message(driver.response_server_queue, {'CMD': 'KRDG? 8'}, priority=5)
+    time.sleep(0.2)
+    driver.resource.released.set()
+
+    assert len(long_future.result(TIMEOUT)) == 6
+    assert urgent_future.result(TIMEOUT)[0]['error'] == ''
+    assert driver.resource.queries == ['KRDG? 1', 'KRDG? 2', 'KRDG? 8', 'KRDG? 3', 'KRDG? 4', 'KRDG? 5', 'KRDG? 6']
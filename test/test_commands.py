@@ -0,0 +1,72 @@
+"""Tests of the command classes and of the command tables of the drivers, which are built once per class.
+
+    python -m pytest test/test_*.py
+"""
+import pytest
+
+import components.command_runner
+from components import Command, QueryCommand, DriverQueryCommand, LakeShoreCurveCommands
+from conftest import make_ls218
+from LS218Driver import LS218Driver
+
+
+class GetReading(QueryCommand):
+    cmd = "RDG?"
+    arguments = "{},{}"
+
+
+class GetReadingAlias(GetReading):
+    cmd_alias = "READ"
+    arguments_alias = "{} {}"
+
+
+def test_command_template_is_built_when_the_class_is_created(monkeypatch):
+    assert GetReading.num_args == 2 and GetReading.template == "RDG? {},{}"
+
+    def compile_again(cls):
+        raise AssertionError("The command was compiled again")
+
+    monkeypatch.setattr(Command, 'compile', classmethod(compile_again))
+    monkeypatch.setattr(Command, 'calc_num_args', classmethod(compile_again))
+    assert GetReading.command(['A', 1]) == "RDG? A,1"
+    with pytest.raises(ValueError):
+        GetReading.command(['A'])
+
+
+def test_subclass_has_templates_of_its_own():
+    assert GetReadingAlias.command(['A', 1]) == "READ A 1"
+    assert GetReadingAlias.raw_command(['A', 1]) == "RDG? A,1"
+    # The alias of the subclass doesn't leak into its parent
+    assert GetReading.alias_template is None and GetReading.command(['A', 1]) == "RDG? A,1"
+
+
+def test_command_table_is_built_once_per_class(transport, monkeypatch):
+    def find_subclasses(obj, command_type):
+        raise AssertionError("The command table was built again")
+
+    monkeypatch.setattr(components.command_runner, 'find_subclasses', find_subclasses)
+    driver = make_ls218(transport)
+    try:
+        assert driver.all_commands is LS218Driver.all_commands
+        assert driver.get_commands['KRDG?'] is LS218Driver.GetKelvinReading
+    finally:
+        driver.close()
+
+
+def test_subclass_that_overrides_commands_gets_its_own_table():
+    class QuietLS218Driver(LS218Driver):
+        class GetKelvinReading(LS218Driver.GetKelvinReading):
+            publish_telemetry = False
+
+        class GetQuietMode(DriverQueryCommand):
+            cmd = "QUIET?"
+
+    assert QuietLS218Driver.all_commands is not LS218Driver.all_commands
+    assert QuietLS218Driver.get_commands['KRDG?'] is QuietLS218Driver.GetKelvinReading
+    assert 'QUIET?' in QuietLS218Driver.get_commands
+    # The parent's table is unchanged
+    assert LS218Driver.get_commands['KRDG?'] is LS218Driver.GetKelvinReading
+    assert 'QUIET?' not in LS218Driver.all_commands
+    # The LS218's own version of a command of the curve mixin replaces the mixin's
+    assert LS218Driver.get_commands['CRVPT?'] is LS218Driver.GetCurveDataPoint
+    assert LS218Driver.GetCurveDataPoint is not LakeShoreCurveCommands.GetCurveDataPoint
@@ -0,0 +1,71 @@
+"""Tests of the DataLogger chunks and load_series.
+
+    python -m pytest test/test_*.py
+"""
+import os
+import time
+
+import numpy as np
+
+from components import LocalTransport, LocalBroker
+from DataLogger import DataLogger, load_series
+
+
+def reading(source, command, t1, result, error=''):
+    return {'SOURCE': source, 'CMD': command, 't0': t1 - 0.1, 't1': t1, 'error': error, 'result': result}
+
+
+def test_only_numeric_readings_are_logged(tmp_path):
+    logger = DataLogger(str(tmp_path), transport=LocalTransport(LocalBroker()))
+    logger.process_telemetry(reading('LS218', 'KRDG? 3', 1.0, 4.2))
+    logger.process_telemetry(reading('LS218', 'KRDG? 3', 2.0, ''))
+    logger.process_telemetry(reading('LS218', 'KRDG? 3', 3.0, 0, error='Timeout'))
+    logger.process_telemetry(reading('LS218', 'LOGDOWNLOAD? 1 5', 4.0, {'columns': {'record': [1, 2]}, 'error': ''}))
+    logger.process_telemetry(reading('SMS', 'OUTP? T', 5.0, {'Output': 1.5, 'Voltage': 0.2, 'Persistent': 0}))
+    logger.process_telemetry(reading('SMS', 'UNITS?', 6.0, 'T'))
+    logger.flush()
+    # A second chunk, where the same series has another non-numeric result
+    logger.process_telemetry(reading('LS218', 'KRDG? 3', 7.0, 'OVERLOAD'))
+    logger.process_telemetry(reading('LS218', 'KRDG? 3', 8.0, 4.3))
+    logger.flush()
+
+    t0, t1, value = load_series(str(tmp_path), 'LS218.KRDG.3')
+    assert t1.tolist() == [1.0, 8.0]
+    assert value.dtype == np.float64 and value.tolist() == [4.2, 4.3]
+    assert load_series(str(tmp_path), 'SMS.OUTP.T.Output')[2].tolist() == [1.5]
+    assert len(load_series(str(tmp_path), 'SMS.UNITS')[0]) == 0
+    assert len(load_series(str(tmp_path), 'LS218.LOGDOWNLOAD.1.5')[0]) == 0
+
+
+def test_lists_of_readings_are_stored_as_2d_arrays(tmp_path):
+    logger = DataLogger(str(tmp_path), transport=LocalTransport(LocalBroker()))
+    logger.process_telemetry(reading('LS218', 'KRDG? 0', 1.0, [4.2, 4.3, 4.4]))
+    logger.process_telemetry(reading('LS218', 'KRDG? 0', 2.0, [4.5, 4.6, 4.7]))
+    logger.flush()
+    value = load_series(str(tmp_path), 'LS218.KRDG.0')[2]
+    assert value.shape == (2, 3)
+
+
+def test_chunk_is_named_after_its_first_reading(tmp_path, monkeypatch):
+    logger = DataLogger(str(tmp_path), transport=LocalTransport(LocalBroker()))
+    # The first reading arrives just before midnight, and the chunk is written just after it
+    first = time.mktime((2020, 1, 31, 23, 59, 59, 0, 0, -1)) + 0.25
+    monkeypatch.setattr(time, 'time', lambda: first)
+    logger.process_telemetry(reading('LS218', 'KRDG? 3', first, 4.2))
+    monkeypatch.setattr(time, 'time', lambda: first + 1)
+    logger.flush()
+    assert os.listdir(str(tmp_path)) == ['2020-01-31']
+    assert os.listdir(str(tmp_path / '2020-01-31')) == ['235959_250000.npz']
+
+
+def test_series_of_lists_that_change_length_are_read_from_the_latest_chunks(tmp_path):
+    logger = DataLogger(str(tmp_path), transport=LocalTransport(LocalBroker()))
+    logger.process_telemetry(reading('LS218', 'KRDG? 0', 1.0, [4.2, 4.3, 4.4]))
+    logger.flush()
+    logger.process_telemetry(reading('LS218', 'KRDG? 0', 2.0, [4.5, 4.6]))
+    logger.flush()
+    logger.process_telemetry(reading('LS218', 'KRDG? 0', 3.0, [4.7, 4.8]))
+    logger.flush()
+    t0, t1, value = load_series(str(tmp_path), 'LS218.KRDG.0')
+    assert t1.tolist() == [2.0, 3.0]
+    assert value.tolist() == [[4.5, 4.6], [4.7, 4.8]]
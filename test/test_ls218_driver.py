@@ -0,0 +1,85 @@
+"""Tests of the LS218 driver's own commands (curves, readings of all inputs), against the simulated LS218.
+
+    python -m pytest test/test_*.py
+"""
+import numpy as np
+import pytest
+
+from conftest import RecordingResource, request
+from LS218Driver import LS218Driver
+from LS350Driver import LS350Driver
+from simulators import LS218Simulator
+
+
+UNITS = [0.1, 0.5, 1.0, 1.5]
+TEMPERATURES = [300.0, 200.0, 100.0, 10.0]
+
+
+def test_curve_numbers_are_those_of_the_instrument(ls218, client):
+    assert 40 in LS350Driver.curves and 40 not in LS218Driver.curves
+    reply = request(client, ls218.response_server_queue, 'READCURVE? 40')[0]
+    assert 'Curve must be one of' in reply['error']
+    assert request(client, ls218.response_server_queue, 'READCURVE? 21')[0]['error'] == ''
+
+
+def test_curve_is_read_up_to_its_first_empty_point(ls218, client):
+    ls218.resource.instrument.curve_points[21] = list(zip(UNITS, TEMPERATURES))
+    reply = request(client, ls218.response_server_queue, 'READCURVE? 21')[0]
+    assert reply['result'] == {'units': UNITS, 'temp': TEMPERATURES}
+    # The reading stops at the first empty point rather than going through the 200 points of the curve
+    assert len(ls218.resource.queries) < 10
+
+
+def test_curve_rewrite_only_sends_the_changed_points(ls218):
+    instrument = ls218.resource.instrument
+    assert ls218.write_curve(21, UNITS, TEMPERATURES) == 4
+    assert instrument.curve_points[21] == list(zip(UNITS, TEMPERATURES))
+
+    changed = [300.0, 200.0, 90.0, 10.0]
+    assert ls218.write_curve(21, UNITS, changed) == 1
+    assert instrument.curve_points[21] == list(zip(UNITS, changed))
+
+
+def test_curve_changed_point_by_point_is_read_again_before_a_rewrite(ls218, client):
+    ls218.write_curve(21, UNITS, TEMPERATURES)
+    assert request(client, ls218.response_server_queue, 'CRVPT 21,1,0.2,310')[0]['error'] == ''
+    # The copy of the curve was dropped, so the point is put back
+    assert ls218.write_curve(21, UNITS, TEMPERATURES) == 1
+    assert ls218.resource.instrument.curve_points[21][0] == (0.1, 300.0)
+
+
+def test_shorter_curve_clears_the_leftover_points(ls218, client):
+    ls218.write_curve(21, UNITS, TEMPERATURES)
+    reply = request(client, ls218.response_server_queue, 'WRITECURVE 21,0.1,300,0.5,200')[0]
+    # Only the two points past the end of the new curve changed
+    assert reply['error'] == '' and reply['result'] == 2
+    assert ls218.resource.instrument.curve_points[21] == [(0.1, 300.0), (0.5, 200.0), (0, 0), (0, 0)]
+    assert ls218.read_curve(21)[1].tolist() == [300.0, 200.0]
+
+
+@pytest.mark.parametrize('curve', [9, 40])
+def test_only_user_curves_can_be_written(ls218, curve):
+    with pytest.raises(ValueError):
+        ls218.write_curve(curve, UNITS, TEMPERATURES)
+
+
+def test_all_inputs_are_read_in_one_query(make_driver):
+    instrument = LS218Simulator(temperatures=(4.2, 4.3, 4.4, 4.5, 20.0, 40.0, 77.0, 295.0))
+    instrument.noise = 0
+    driver = make_driver(resource=RecordingResource(instrument))
+    readings, inputs = driver.read_all_inputs()
+    assert driver.resource.queries == ['KRDG? 0']
+    assert readings.shape == (8,) and readings.dtype == np.float64
+    assert inputs.tolist() == list(range(1, 9))
+    # Each reading is the one of the input at the same position
+    for channel, temperature in zip(inputs, instrument.temperatures):
+        assert readings[driver.input_index(channel)] == pytest.approx(temperature)
+
+    readings, inputs = driver.read_all_inputs(driver.GetCelsiusReading)
+    assert readings[driver.input_index(8)] == pytest.approx(295.0 - 273.15)
+
+
+def test_failed_reading_of_all_inputs_raises(ls218):
+    ls218.resource.fail = lambda query: True
+    with pytest.raises(IOError):
+        ls218.read_all_inputs()
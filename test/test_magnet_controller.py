@@ -0,0 +1,24 @@
+"""Tests of MagnetController's measurements and quench checks.
+
+    python -m pytest test/test_*.py
+"""
+from MagnetController import Measurement
+
+
+def test_measurement_keeps_each_reading_once():
+    measurement = Measurement(10)
+    measurement.update(0.9, 1.0, 4.2)
+    # The same reading again (e.g. served from a cache) and an older one are left out
+    measurement.update(0.9, 1.0, 4.2)
+    measurement.update(0.4, 0.5, 4.1)
+    measurement.update(1.9, 2.0, 4.3)
+    assert measurement.window_since(0)['t1'].tolist() == [1.0, 2.0]
+    assert measurement.value == 4.3
+
+
+def test_failed_readings_are_left_out_of_the_history():
+    measurement = Measurement(10)
+    measurement.update(0.9, 1.0, 4.2)
+    measurement.update(1.9, 2.0, '')
+    assert measurement.value == ''
+    assert measurement.window_since(0)['value'].tolist() == [4.2]
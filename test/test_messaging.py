@@ -0,0 +1,175 @@
+"""Tests of the messaging between the components (request timeouts, encodings), and of MagnetController's handling of
+drivers that don't answer.
+
+    python -m pytest test/test_*.py
+"""
+import collections
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+from components import LocalTransport, LocalBroker, LocalConnection, RmqReq, JsonCodec, DecodeError, get_codec, \
+    decode, MessageProperties
+from conftest import TIMEOUT, make_ls218, close_driver, request, wait_for
+from MagnetController import MagnetController
+
+
+class CountingTransport(LocalTransport):
+    """Counts the calls its connections make to get messages from the queues"""
+    def __init__(self, broker):
+        super().__init__(broker)
+        self.calls = collections.Counter()
+
+    def connect(self):
+        return CountingConnection(self.broker, self.calls)
+
+
+class CountingConnection(LocalConnection):
+    def __init__(self, broker, calls):
+        super().__init__(broker)
+        self.calls = calls
+
+    def get(self, queue):
+        self.calls['get'] += 1
+        return super().get(queue)
+
+    def consume(self, queue, timeout):
+        self.calls['consume'] += 1
+        return super().consume(queue, timeout)
+
+
+def make_controller(transport, ls218, **config):
+    # The power supply driver is never started, like a driver that died
+    config = dict({'controller_queue': 'Test.controller',
+                   'power_supply_driver': 'Test.SMS.driver',
+                   'magnet_temperature_driver': ls218.response_server_queue,
+                   'hall_sensor_driver': ls218.response_server_queue,
+                   'magnet_temperature_channel': 3,
+                   'persistent_heater_switch_temperature_channel': 4,
+                   'magnet_safe_temperatures': '[0, 6.5, 9, 4.15]',
+                   'request_timeout': 0.3,
+                   'quench_check_period': 0}, **config)
+    return MagnetController(config, transport=transport, consumer_timeout=0.1)
+
+
+@pytest.fixture
+def controller(transport, ls218):
+    controller = make_controller(transport, ls218)
+    yield controller
+    controller.close()
+
+
+def test_unsupported_content_type_is_only_a_fallback_for_encoding():
+    assert get_codec('application/x-unknown') is JsonCodec
+    with pytest.raises(DecodeError):
+        decode(JsonCodec.encode({'CMD': 'KRDG? 1'}), 'application/x-unknown')
+
+
+def test_invalid_body_is_a_decode_error():
+    assert decode(JsonCodec.encode({'CMD': 'KRDG? 1'}), None) == {'CMD': 'KRDG? 1'}
+    with pytest.raises(DecodeError):
+        decode(b'\x82\xa3CMD', JsonCodec.content_type)
+
+
+def test_server_drops_a_message_it_cannot_decode():
+    # The messages are encoded like they are through RabbitMQ
+    transport = LocalTransport(LocalBroker(JsonCodec.content_type))
+    driver = make_ls218(transport)
+    client = RmqReq(transport=transport)
+    client.run_client_thread()
+    try:
+        properties = MessageProperties(reply_to='Test.nobody', content_type='application/x-unknown')
+        transport.broker.get_queue(driver.response_server_queue).put((b'\x81\xa3CMD\xa7KRDG? 1', properties))
+        reply = request(client, driver.response_server_queue, 'KRDG? 1')
+        assert reply[0]['error'] == '' and 4 < reply[0]['result'] < 4.5
+    finally:
+        client.close()
+        close_driver(driver)
+
+
+def test_request_without_reply_expires(transport):
+    client = RmqReq(transport=transport, request_timeout=0.2)
+    client.run_client_thread()
+    try:
+        future = client.send_direct_message('Test.nobody', {'CMD': 'KRDG? 1'})
+        with pytest.raises(concurrent.futures.TimeoutError):
+            future.result(TIMEOUT)
+        assert not client.pending_requests
+    finally:
+        client.close()
+
+
+def test_controller_gives_up_on_a_dead_driver(controller):
+    with pytest.raises(concurrent.futures.TimeoutError):
+        controller.get_field()
+    # The request is forgotten as soon as the wait is over
+    assert not controller.pending_requests
+
+
+def test_acquire_keeps_the_readings_of_the_drivers_that_answer(controller):
+    start = time.time()
+    controller.acquire_temperatures_and_field()
+    assert time.time() - start < TIMEOUT
+    assert 4 < controller.magnet_temperature.value < 4.5
+    # The supply never answered, so there is no field reading
+    assert controller.field.value is None
+    assert controller.magnet_temperature.t1 >= start
+
+
+def test_acquire_returns_when_the_controller_closes(transport, ls218):
+    ls218.resource.released.clear()
+    controller = make_controller(transport, ls218, request_timeout=TIMEOUT)
+    errors = []
+
+    def acquire():
+        try:
+            controller.acquire_temperatures_and_field()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    wait_for(lambda: controller.pending_requests)
+    # Closing drops the requests that are still waited for
+    controller.close()
+    thread.join(TIMEOUT)
+    assert not thread.is_alive() and not errors
+    assert controller.magnet_temperature.value is None
+
+
+def test_quench_monitor_waits_for_a_stalled_driver(transport, ls218):
+    ls218.resource.released.clear()
+    controller = make_controller(transport, ls218, request_timeout=5, quench_check_period=0.05,
+                                 quench_max_temperature_age=0.5)
+    sent = []
+    send_message = controller.send_message
+
+    def count_sends(queue, command, priority=None):
+        sent.append((queue, command))
+        return send_message(queue, command, priority)
+
+    controller.send_message = count_sends
+    try:
+        time.sleep(1)
+        # The first read is still waited for, so no other one was sent
+        assert sent.count((ls218.response_server_queue, 'KRDG? 0')) <= 1
+        assert controller.tripped
+    finally:
+        controller.close()
+
+
+def test_idle_controller_blocks_until_a_request_arrives(transport, ls218, client):
+    counting_transport = CountingTransport(transport.broker)
+    controller = make_controller(counting_transport, ls218)
+    try:
+        time.sleep(0.5)
+        # The server only wakes up every consumer_timeout to check whether it was closed, rather than polling
+        assert counting_transport.calls['get'] == 0
+        assert counting_transport.calls['consume'] <= 0.5 / 0.1 + 2
+        reply = request(client, controller.response_server_queue, 'GetMagnetTemperature')
+        assert reply[0]['error'] == ''
+        assert counting_transport.calls['get'] == 0
+    finally:
+        controller.close()
@@ -0,0 +1,88 @@
+"""Tests of the RingBuffer history of samples.
+
+    python -m pytest test/test_*.py
+"""
+import numpy as np
+import pytest
+
+from components import RingBuffer
+
+
+def filled(capacity, count):
+    """A buffer with count samples, where sample i is read at t0 = i, t1 = i + 0.5 and has value 10 * i"""
+    buffer = RingBuffer(capacity)
+    for i in range(count):
+        buffer.append(i, i + 0.5, 10 * i)
+    return buffer
+
+
+def test_partially_filled_buffer_holds_only_its_samples():
+    buffer = filled(5, 3)
+    assert len(buffer) == 3
+    assert buffer.window()['value'].tolist() == [0, 10, 20]
+    assert buffer.window(2)['value'].tolist() == [10, 20]
+    # Asking for more samples than there are gives all of them
+    assert buffer.window(10)['value'].tolist() == [0, 10, 20]
+    assert buffer.latest()['value'] == 20
+
+
+def test_empty_buffer():
+    buffer = RingBuffer(3)
+    assert len(buffer) == 0 and len(buffer.window()) == 0
+    assert buffer.latest() is None
+    assert buffer.rolling_mean(10) is None and buffer.rate_of_change(10) is None
+
+
+def test_wrapped_buffer_keeps_the_latest_samples_oldest_first():
+    buffer = filled(4, 11)
+    assert len(buffer) == 4
+    assert buffer.window()['value'].tolist() == [70, 80, 90, 100]
+    assert buffer.window(3)['t0'].tolist() == [8, 9, 10]
+    assert buffer.latest()['t1'] == 10.5
+
+
+@pytest.mark.parametrize('count', [1, 4, 5, 7, 13])
+def test_window_is_a_contiguous_view(count):
+    buffer = filled(5, count)
+    window = buffer.window()
+    assert np.shares_memory(window, buffer.data) and window.flags['C_CONTIGUOUS']
+    assert window['t0'].tolist() == list(range(max(count - 5, 0), count))
+
+
+def test_window_changes_with_later_appends():
+    buffer = filled(5, 7)
+    window = buffer.window()
+    kept = window.copy()
+    buffer.append(7, 7.5, -1)
+    # The oldest sample of the window was overwritten in place, the copy is unchanged
+    assert window['value'][0] == -1
+    assert kept['value'].tolist() == [20, 30, 40, 50, 60]
+    assert buffer.window()['value'].tolist() == [30, 40, 50, 60, -1]
+
+
+def test_window_since_selects_by_the_time_after_the_reading():
+    buffer = filled(4, 6)
+    assert buffer.window_since(3.5)['t0'].tolist() == [3, 4, 5]
+    assert buffer.window_since(3.6)['t0'].tolist() == [4, 5]
+    assert len(buffer.window_since(100)) == 0
+
+
+def test_statistics_over_a_wrapped_buffer():
+    buffer = filled(4, 10)
+    # The last 2 s hold the samples read at t1 = 7.5, 8.5 and 9.5
+    assert buffer.rolling_mean(2) == pytest.approx(80)
+    assert buffer.rate_of_change(2) == pytest.approx(10)
+    assert buffer.rolling_mean(2, now=100) is None
+
+
+def test_clear_empties_the_buffer():
+    buffer = filled(3, 5)
+    buffer.clear()
+    assert len(buffer) == 0 and buffer.latest() is None
+    buffer.append(1, 1.5, 7)
+    assert buffer.window()['value'].tolist() == [7]
+
+
+def test_capacity_must_be_positive():
+    with pytest.raises(ValueError):
+        RingBuffer(0)
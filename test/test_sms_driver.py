@@ -0,0 +1,210 @@
+"""Tests of the SMS power supply driver against the simulated SMS120C.
+
+    python -m pytest test/test_*.py
+"""
+import os
+import threading
+import time
+
+import pytest
+
+from components import CommandType
+from conftest import RecordingResource, TelemetryRecorder, request, wait_for
+from SMSPowerSupplyDriver import SMSPowerSupplyDriver, SMSSetCommand, RampPlanner, RampSegment, parse_reply
+from simulators import SMS120CSimulator
+from sms_parser_benchmark import CorpusDriver, load_corpus, process
+
+
+# Ramp rates (T/s) up to each field (T), at magnet temperatures up to 4.2 K and 6 K
+RATE_TABLES = {4.2: [(2, 0.01), (6, 0.005), (9, 0.002)], 6: [(9, 0.001)]}
+
+
+def make_sms(transport, **kwargs):
+    # The simulator answers instantly, so the settings don't need to be paced
+    return SMSPowerSupplyDriver('Test.SMS.driver', {'resource': RecordingResource(SMS120CSimulator())},
+                                transport=transport, consumer_timeout=0.1,
+                                command_delays={cmd: 0 for cmd in SMSPowerSupplyDriver.all_commands}, **kwargs)
+
+
+@pytest.fixture
+def sms(transport):
+    driver = make_sms(transport, telemetry_source='SMS', coalesce_window=10)
+    yield driver
+    driver.close()
+
+
+def test_set_commands_are_typed_as_set_commands():
+    set_commands = [command_class for command_class in SMSPowerSupplyDriver.all_commands.values()
+                    if issubclass(command_class, SMSSetCommand)]
+    assert SMSPowerSupplyDriver.StartRamp in set_commands and SMSPowerSupplyDriver.StopRamp in set_commands
+    assert SMSPowerSupplyDriver.SetPauseState in set_commands
+    assert all(command_class.type == CommandType.SET and not command_class.coalesce
+               for command_class in set_commands)
+
+
+def test_set_commands_always_reach_the_instrument(sms, client, transport):
+    recorder = TelemetryRecorder(transport=transport)
+    recorder.run_subscriber_thread()
+    try:
+        # Give the subscriber time to bind its queue
+        time.sleep(0.2)
+        threads = [threading.Thread(target=request, args=(client, sms.response_server_queue, 'PAUSE 1'))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert request(client, sms.response_server_queue, 'PAUSE?')[0]['result'] == 1
+        time.sleep(0.3)
+    finally:
+        recorder.close()
+
+    # Unlike the queries, the settings are neither coalesced nor reused, and they are not readings
+    assert sms.resource.queries.count('PAUSE 1') == 3
+    assert recorder.readings == ['PAUSE?']
+
+
+def test_units_of_a_setting_are_paced_and_cached(transport, client):
+    # The supply needs a while after the units query before it takes the setting
+    command_delays = dict({cmd: 0 for cmd in SMSPowerSupplyDriver.all_commands}, **{'UNITS?': 0.3})
+    driver = SMSPowerSupplyDriver('Test.SMS.driver', {'resource': RecordingResource(SMS120CSimulator())},
+                                  transport=transport, consumer_timeout=0.1, command_delays=command_delays)
+    times = {}
+    query = driver.resource.query
+
+    def record_time(message):
+        times[message] = time.time()
+        return query(message)
+
+    driver.resource.query = record_time
+    try:
+        assert request(client, driver.response_server_queue, 'MID 1,T')[0]['error'] == ''
+        assert times['SET MID 1.0'] - times['TESLA'] >= 0.3
+        # The units are only read again once they were changed
+        assert request(client, driver.response_server_queue, 'MID 2,T')[0]['error'] == ''
+        assert driver.resource.queries.count('TESLA') == 1
+        assert request(client, driver.response_server_queue, 'UNITS A')[0]['error'] == ''
+        assert request(client, driver.response_server_queue, 'MID 0.5,T')[0]['error'] == ''
+        assert driver.resource.queries.count('TESLA') == 2
+        assert driver.resource.queries[-1] == 'SET MID 6.25'
+    finally:
+        driver.close()
+
+
+def test_ramp_is_planned_in_segments_of_constant_rate():
+    planner = RampPlanner(RATE_TABLES)
+    assert planner.plan(0, 7, 4.0) == [RampSegment(2, 0.01, pytest.approx(200)),
+                                       RampSegment(6, 0.005, pytest.approx(800)),
+                                       RampSegment(7, 0.002, pytest.approx(500))]
+    assert planner.plan(7, 1, 4.0) == [RampSegment(6, 0.002, pytest.approx(500)),
+                                       RampSegment(2, 0.005, pytest.approx(800)),
+                                       RampSegment(1, 0.01, pytest.approx(100))]
+    # A warmer magnet ramps with the table of the next temperature up
+    assert planner.plan(0, 1, 5.0) == [RampSegment(1, 0.001, pytest.approx(1000))]
+    assert planner.plan(3, 3, 4.0) == []
+
+
+@pytest.mark.parametrize('rate_tables', [{}, {4.2: []}, {4.2: [(2, 0.01), (9, 0)]}])
+def test_ramp_planner_rejects_invalid_rate_tables(rate_tables):
+    with pytest.raises(ValueError):
+        RampPlanner(rate_tables)
+
+
+@pytest.mark.parametrize('start_field, target_field, temperature', [(0, 9.5, 4.0), (0, 1, 6.5), (0, -3, 4.0),
+                                                                    (-3, 0, 4.0)])
+def test_ramp_planner_rejects_ramps_outside_the_rate_tables(start_field, target_field, temperature):
+    # Negative fields need the polarity of the supply to be reversed, which a ramp can't do
+    with pytest.raises(ValueError):
+        RampPlanner(RATE_TABLES).plan(start_field, target_field, temperature)
+
+
+def test_ramp_plan_starts_from_the_output(transport, client):
+    driver = make_sms(transport, ramp_rate_tables=RATE_TABLES)
+    try:
+        reply = request(client, driver.response_server_queue, 'RAMPPLAN? 3,4.2')[0]
+        assert reply['error'] == ''
+        assert [(segment['mid'], segment['rate']) for segment in reply['result']] == [(2, 0.01), (3, 0.005)]
+        # The limits of the rate tables are errors of the command
+        reply = request(client, driver.response_server_queue, 'RAMPPLAN? 3,10')[0]
+        assert 'no ramp rates' in reply['error'] and reply['result'] == ''
+    finally:
+        driver.close()
+
+
+def test_ramp_reaches_its_target_and_negative_targets_are_refused(transport, client):
+    # Rates the simulator can keep up with, so that the ramp is over in a couple of seconds
+    instrument = SMS120CSimulator()
+    instrument.inductance = 0.1
+    driver = SMSPowerSupplyDriver('Test.SMS.driver', {'resource': RecordingResource(instrument)}, transport=transport,
+                                  consumer_timeout=0.1,
+                                  command_delays={cmd: 0 for cmd in SMSPowerSupplyDriver.all_commands},
+                                  ramp_rate_tables={4.2: [(0.1, 0.2), (0.3, 0.1)]}, ramp_check_interval=0.1)
+    try:
+        reply = request(client, driver.response_server_queue, 'RAMPTO 0.2,4.0')[0]
+        assert reply['error'] == '' and [segment['mid'] for segment in reply['result']] == [0.1, 0.2]
+        wait_for(lambda: not driver.ramp_progress['Active'])
+        wait_for(lambda: request(client, driver.response_server_queue, 'OUTP? T')[0]['result']['Output'] ==
+                 pytest.approx(0.2))
+        assert driver.ramp_progress['Segment'] == 1
+
+        reply = request(client, driver.response_server_queue, 'RAMPTO -0.2,4.0')[0]
+        assert 'polarity' in reply['error']
+        assert not any(query.startswith('SET MID -') for query in driver.resource.queries)
+        time.sleep(0.2)
+        assert instrument.mid * instrument.tesla_per_amp == pytest.approx(0.2)
+    finally:
+        driver.close()
+
+
+def test_ramp_needs_rate_tables(sms, client):
+    for command in ('RAMPPLAN? 3,4.2', 'RAMPTO 3,4.2'):
+        reply = request(client, sms.response_server_queue, command)[0]
+        assert 'no ramp rate tables' in reply['error']
+    assert not any(query.startswith('SET MID') for query in sms.resource.queries)
+
+
+def test_replies_are_parsed_into_their_parts():
+    reply = parse_reply('12:01:15 OUTPUT: 7.9981 TESLA AT -2.3 VOLTS\r\n\x13')
+    assert reply == ('status_update', 'OUTPUT: 7.9981 TESLA AT -2.3 VOLTS', [7.9981, -2.3], 'TESLA', None)
+    reply = parse_reply('........ HEATER STATUS: SWITCHED OFF AT 56.2500 AMPS\x13')
+    assert reply == ('status_confirmation', 'HEATER STATUS: SWITCHED OFF AT 56.2500 AMPS', [56.25], 'AMPS', 'OFF')
+    reply = parse_reply('........ !!-------> RAMP TARGET: MID\x13')
+    assert reply.message_type == 'command_information' and reply.message == 'RAMP TARGET: MID'
+    assert parse_reply('=======> INVALID COMMAND: GET OUTPUT\x13').message_type == 'fault_report'
+
+
+def test_recorded_replies_are_processed():
+    corpus = load_corpus(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sms_replies.txt'))
+    results = [process(CorpusDriver(), command, reply) for command, reply in corpus]
+    # Only the reply in local mode and the fault report can't be used
+    assert [reply for (command, reply), result in zip(corpus, results) if result is None] == [
+        '........ REMOTE CONTROL: DISABLED\x13', '=======> INVALID COMMAND: GET OUTPUT\x13']
+    assert results[0] == {'Output': 0.0, 'Voltage': 0.0, 'Persistent': 0}
+    # A reply in amps is converted to the units that were asked for
+    assert results[4]['Output'] == pytest.approx(99.975 * CorpusDriver.tesla_per_amp)
+
+
+def test_unexpected_reply_is_an_error_of_the_command(sms, client):
+    sms.resource.instrument.handle = lambda message, now: SMS120CSimulator.frame('=======>', 'INVALID COMMAND')
+    reply = request(client, sms.response_server_queue, 'OUTP? T')[0]
+    assert "did not match the expected format for the 'GET OUTPUT' command" in reply['error']
+    assert reply['result'] == ''
+
+
+def test_refused_setting_is_an_error_and_stops_the_ramp(transport, client):
+    driver = make_sms(transport, ramp_rate_tables=RATE_TABLES)
+    handle = driver.resource.instrument.handle
+    driver.resource.instrument.handle = lambda message, now: SMS120CSimulator.frame(
+        '=======>', 'INVALID COMMAND: {}'.format(message)) if message.startswith('SET MID') else handle(message, now)
+    try:
+        reply = request(client, driver.response_server_queue, 'MID 1,T')[0]
+        assert "refused the 'MID' command: INVALID COMMAND: SET MID" in reply['error']
+
+        assert request(client, driver.response_server_queue, 'RAMPTO 3,4.2')[0]['error'] == ''
+        wait_for(lambda: not driver.ramp_progress['Active'])
+        progress = request(client, driver.response_server_queue, 'RAMPSTATUS?')[0]['result']
+        assert "refused the 'MID' command" in progress['Error'] and progress['Segment'] == 0
+        # The ramp stopped at the refused setting, so the supply was never told to ramp
+        assert 'RAMP MID' not in driver.resource.queries
+    finally:
+        driver.close()
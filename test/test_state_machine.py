@@ -0,0 +1,204 @@
+"""Tests of the state machine: transitions, done states, tick periods and stopping.
+
+    python -m pytest test/test_*.py
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from conftest import TIMEOUT, wait_for
+from state_machine.state_machine import StateMachine, State
+
+
+class Recorder(object):
+    """The component of the states, which records what they did"""
+    def __init__(self):
+        self.events = []
+        self.runs = {}
+
+    def record(self, state, event):
+        self.events.append((type(state).__name__, event))
+        if event == 'run':
+            self.runs[type(state).__name__] = self.runs.get(type(state).__name__, 0) + 1
+
+
+class RecordingState(State):
+    def enter(self):
+        self.component.record(self, 'enter')
+
+    def run(self):
+        self.component.record(self, 'run')
+
+
+class StateCooling(RecordingState):
+    tick_period = 0
+
+
+class StateIdle(RecordingState):
+    # Long enough that a test only ends in time if the machine is woken up
+    tick_period = 60
+    transitions = {'cool': StateCooling}
+
+
+class StateCountdown(RecordingState):
+    tick_period = 0
+    done_state = StateIdle
+
+    def enter(self):
+        super().enter()
+        self.remaining = 2
+
+    def run(self):
+        super().run()
+        self.remaining -= 1
+        self.done = self.remaining == 0
+
+
+class StateFailing(RecordingState):
+    tick_period = 0.01
+
+    def run(self):
+        super().run()
+        raise IOError("The driver didn't answer")
+
+
+StateCooling.transitions = {'idle': StateIdle, 'countdown': StateCountdown, 'fail': StateFailing}
+StateFailing.transitions = {'idle': StateIdle}
+
+
+@pytest.fixture
+def machine():
+    return StateMachine(Recorder(), StateIdle)
+
+
+def run_in_thread(machine):
+    thread = threading.Thread(target=machine.run)
+    thread.start()
+    return thread
+
+
+def test_reachable_states_are_created_once(machine):
+    assert set(machine.states) == {StateIdle, StateCooling, StateCountdown, StateFailing}
+    cooling = machine.states[StateCooling]
+    machine.set_condition('cool')
+    machine.step()
+    machine.set_condition('idle')
+    machine.step()
+    machine.set_condition('cool')
+    machine.step()
+    assert machine.current_state is cooling
+
+
+def test_transition_table_changes_state_and_uses_up_the_condition(machine):
+    assert machine.component.events == [('StateIdle', 'enter')]
+    machine.set_condition('cool')
+    assert machine.step()
+    assert isinstance(machine.current_state, StateCooling)
+    assert machine.condition is None
+    assert machine.component.events[-1] == ('StateCooling', 'enter')
+
+
+def test_condition_without_transition_is_kept(machine):
+    machine.set_condition('countdown')
+    assert not machine.step()
+    assert isinstance(machine.current_state, StateIdle)
+    # The condition is kept until a state that has a transition for it uses it
+    assert machine.condition == 'countdown'
+    machine.set_condition('cool')
+    machine.step()
+    machine.set_condition('countdown')
+    assert machine.step()
+    assert isinstance(machine.current_state, StateCountdown)
+
+
+def test_done_state_follows_a_state_that_is_done(machine):
+    machine.set_condition('cool')
+    machine.step()
+    machine.set_condition('countdown')
+    machine.step()
+    assert not machine.step()
+    assert machine.step()
+    assert isinstance(machine.current_state, StateIdle)
+
+    # The state is reset every time it is entered
+    machine.set_condition('cool')
+    machine.step()
+    machine.set_condition('countdown')
+    machine.step()
+    assert not machine.current_state.done and machine.current_state.remaining == 2
+
+
+def test_states_run_at_their_own_tick_period(machine):
+    thread = run_in_thread(machine)
+    try:
+        time.sleep(0.2)
+        # The idle state waits for its long tick, the cooling state runs back to back
+        assert machine.component.runs == {'StateIdle': 1}
+        machine.set_condition('cool')
+        wait_for(lambda: machine.component.runs.get('StateCooling', 0) > 100)
+    finally:
+        machine.stop()
+        thread.join(TIMEOUT)
+    assert not thread.is_alive()
+
+
+def test_set_condition_wakes_the_machine_up(machine):
+    thread = run_in_thread(machine)
+    try:
+        wait_for(lambda: machine.component.runs.get('StateIdle'))
+        start = time.time()
+        machine.set_condition('cool')
+        wait_for(lambda: isinstance(machine.current_state, StateCooling))
+        assert time.time() - start < 1
+    finally:
+        machine.stop()
+        thread.join(TIMEOUT)
+
+
+def test_failing_state_runs_again_at_the_next_tick(machine):
+    thread = run_in_thread(machine)
+    try:
+        machine.set_condition('cool')
+        wait_for(lambda: isinstance(machine.current_state, StateCooling))
+        machine.set_condition('fail')
+        wait_for(lambda: machine.component.runs.get('StateFailing', 0) >= 3)
+        machine.set_condition('idle')
+        wait_for(lambda: isinstance(machine.current_state, StateIdle))
+    finally:
+        machine.stop()
+        thread.join(TIMEOUT)
+    assert not thread.is_alive()
+
+
+def test_stop_ends_the_machine_during_a_long_tick(machine):
+    thread = run_in_thread(machine)
+    wait_for(lambda: machine.component.runs.get('StateIdle'))
+    start = time.time()
+    machine.stop()
+    thread.join(TIMEOUT)
+    assert not thread.is_alive() and time.time() - start < 1
+
+
+def test_machine_runs_in_an_event_loop():
+    class StateWaiting(RecordingState):
+        tick_period = 0.01
+
+        async def run(self):
+            super().run()
+            await asyncio.sleep(0)
+            self.done = self.component.runs['StateWaiting'] == 3
+
+    StateWaiting.done_state = StateCooling
+    machine = StateMachine(Recorder(), StateWaiting)
+
+    async def run_until_cooling():
+        task = asyncio.ensure_future(machine.run_async())
+        while not isinstance(machine.current_state, StateCooling):
+            await asyncio.sleep(0.01)
+        machine.stop()
+        await asyncio.wait_for(task, TIMEOUT)
+
+    asyncio.run(run_until_cooling())
+    assert machine.component.runs['StateWaiting'] == 3
@@ -0,0 +1,80 @@
+"""Tests of the telemetry: readings published to the topic exchange, and received by the subscribers whose binding
+keys match them.
+
+    python -m pytest test/test_*.py
+"""
+import time
+
+import pytest
+
+from components import LocalTransport, LocalBroker, JsonCodec, TelemetryPublisher, topic_matches
+from conftest import TelemetryRecorder, wait_for
+
+
+@pytest.mark.parametrize('binding_key, routing_key, matches', [
+    ('telemetry.LS218.KRDG.3', 'telemetry.LS218.KRDG.3', True),
+    ('telemetry.LS218.KRDG.3', 'telemetry.LS218.KRDG.4', False),
+    ('telemetry.*.KRDG.*', 'telemetry.LS350.KRDG.A', True),
+    # '*' is exactly one word
+    ('telemetry.*.KRDG.*', 'telemetry.LS218.KRDG', False),
+    ('telemetry.*.KRDG.*', 'telemetry.LS218.KRDG.3.4', False),
+    # '#' is any number of words, none included
+    ('telemetry.#', 'telemetry', True),
+    ('telemetry.#', 'telemetry.SMS.OUTP.T', True),
+    ('telemetry.#.T', 'telemetry.SMS.OUTP.T', True),
+    ('telemetry.#.T', 'telemetry.SMS.OUTP.A', False),
+    ('#', 'anything.at.all', True),
+    ('telemetry.LS218.#', 'telemetry.LS2180.KRDG', False),
+])
+def test_topic_matches(binding_key, routing_key, matches):
+    assert topic_matches(binding_key, routing_key) == matches
+
+
+def test_routing_key_is_made_of_the_source_command_and_parameters():
+    publisher = TelemetryPublisher(telemetry_source='SMS', transport=LocalTransport(LocalBroker()))
+    assert publisher.get_routing_key('OUTP?', ['T']) == 'telemetry.SMS.OUTP.T'
+    # Dots would split a parameter into several words
+    assert publisher.get_routing_key('SETP', ['1.5']) == 'telemetry.SMS.SETP.1_5'
+
+
+def reading(value):
+    return {'t0': time.time(), 't1': time.time(), 'error': '', 'result': value}
+
+
+@pytest.mark.parametrize('content_type', [None, JsonCodec.content_type])
+def test_subscribers_receive_the_readings_that_match_their_keys(content_type):
+    broker = LocalBroker(content_type)
+    transport = LocalTransport(broker)
+    subscribers = {keys: TelemetryRecorder(telemetry_keys=keys, transport=transport)
+                   for keys in [('telemetry.LS218.#',), ('telemetry.*.KRDG.*',), ('telemetry.SMS.#', 'telemetry.#.T')]}
+    publishers = [TelemetryPublisher(telemetry_source=source, transport=transport) for source in ('LS218', 'SMS')]
+    try:
+        for subscriber in subscribers.values():
+            subscriber.run_subscriber_thread()
+        # Readings are only routed to the queues that are already bound
+        wait_for(lambda: len(broker.bindings.get('telemetry', ())) == 4)
+        for publisher in publishers:
+            publisher.run_telemetry_thread()
+
+        ls218, sms = publishers
+        ls218.publish_reading('KRDG?', ['3'], reading(4.2))
+        ls218.publish_reading('CRDG?', ['3'], reading(-268.95))
+        ls218.publish_reading('KRDG?', ['0'], reading([4.2] * 8))
+        sms.publish_reading('OUTP?', ['T'], reading({'Output': 1.0}))
+        wait_for(lambda: sum(len(subscriber.readings) for subscriber in subscribers.values()) == 6)
+        time.sleep(0.1)
+
+        assert subscribers[('telemetry.LS218.#',)].readings == ['KRDG? 3', 'CRDG? 3', 'KRDG? 0']
+        assert subscribers[('telemetry.*.KRDG.*',)].readings == ['KRDG? 3', 'KRDG? 0']
+        # Both keys match the reading of the SMS, and it is received once
+        assert subscribers[('telemetry.SMS.#', 'telemetry.#.T')].readings == ['OUTP? T']
+    finally:
+        for component in list(subscribers.values()) + publishers:
+            component.close()
+
+
+def test_nothing_is_published_without_a_source():
+    broker = LocalBroker()
+    publisher = TelemetryPublisher(transport=LocalTransport(broker))
+    publisher.publish_reading('KRDG?', ['3'], reading(4.2))
+    assert publisher.telemetry_thread_queue.empty()